@@ -6,6 +6,7 @@ import math
 from PIL import Image, ImageDraw, ImageFont
 from utils.action_type import ActionType
 from utils.utils import annotate_and_save_image
+from utils import scoring
 from typing import List, Union
 
  # Based on evaluator of Qwen 2.5 VL
@@ -56,15 +57,14 @@ def is_tap_action(normalized_start_yx, normalized_end_yx):
   return distance <= _SWIPE_DISTANCE_THRESHOLD
 
 
-def check_inside(x, y, bbox_list):
-    bbox_array = np.array(bbox_list)
+def _yxhw_to_xyxy(bbox_array):
     y_min, x_min, height, width = bbox_array[:, 0], bbox_array[:, 1], bbox_array[:, 2], bbox_array[:, 3]
-    y_max, x_max = y_min + height, x_min + width
+    return np.stack([x_min, y_min, x_min + width, y_min + height], axis=1)
+
 
-    # Check whether (x, y) is inside any of the bounding boxes
-    within_x = (x_min <= x) & (x <= x_max)
-    within_y = (y_min <= y) & (y <= y_max)
-    within_bbox = within_x & within_y
+def check_inside(x, y, bbox_list):
+    bbox_array = np.array(bbox_list)
+    within_bbox = scoring.points_in_boxes([[x, y]], _yxhw_to_xyxy(bbox_array))[0]
 
     if np.any(within_bbox):
         within_bbox_coords = bbox_array[within_bbox]
@@ -351,13 +351,12 @@ class ActionEvaluator(object):
                 reference_point = gt_action_yx["x"], gt_action_yx["y"]
             else:
                 reference_point = gt_action_yx["x"], gt_action_yx["y"]
-                for bbox in gt_bbox:
-                    ymin, xmin, height, width = bbox
-                    ymax, xmax = ymin + height, xmin + width
-                    exact_match = ((ymin <= pd_action_yx["y"] <= ymax) and (xmin <= pd_action_yx["x"] <= xmax))
-                    if exact_match:
-                        reference_point = (xmax + xmin) / 2, (ymax + ymin) / 2
-                        break
+                gt_boxes = _yxhw_to_xyxy(np.array(gt_bbox, dtype=np.float64))
+                inside = scoring.points_in_boxes([[pd_action_yx["x"], pd_action_yx["y"]]], gt_boxes)[0]
+                exact_match = bool(inside.any())
+                if exact_match:
+                    xmin, ymin, xmax, ymax = gt_boxes[inside.argmax()].tolist()
+                    reference_point = (xmax + xmin) / 2, (ymax + ymin) / 2
                 if not exact_match:
                     y_gt, x_gt = gt_action_yx["y"], gt_action_yx["x"]
                     y_pd, x_pd = pd_action_yx["y"], pd_action_yx["x"]
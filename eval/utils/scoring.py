@@ -0,0 +1,26 @@
+"""Vectorized point scoring kernels of the offline evaluator.
+
+Copy of `points_in_boxes` of `rft/trainer/utils/scoring.py`, so the evaluator and the RFT rewards check
+points against boxes the same way. Keep both in sync.
+"""
+import numpy as np
+
+
+def points_in_boxes(points, boxes) -> np.ndarray:
+    '''Whether each point lies inside each box, borders included.
+
+    Args:
+        points: `[N, 2]` points as `(x, y)`.
+        boxes: `[M, 4]` boxes shared by all points or `[N, M, 4]` boxes per point, as `(left, top, right, bottom)`.
+            Boxes with NaN coordinates contain no point.
+
+    Returns:
+        `[N, M]` boolean array.
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if boxes.ndim == 2:
+        boxes = boxes[None]
+    x = points[:, 0, None]
+    y = points[:, 1, None]
+    return (boxes[..., 0] <= x) & (x <= boxes[..., 2]) & (boxes[..., 1] <= y) & (y <= boxes[..., 3])
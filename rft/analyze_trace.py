@@ -0,0 +1,197 @@
+"""Summarize the traces written by the training processes when `ARL_TRACE_DIR` is set.
+
+Reports, from the trace files of all processes:
+  - sampler utilization: share of each rank's time spent in `sample_step` (and generating), polling for
+    chunks and waiting for `SYNC_FOR_UPDATE` with a complete batch,
+  - the `greedy_gather_wait_time` backoff: how often each poll timeout is used and how often it receives data,
+  - queue waits: trainers waiting on the data workers, data workers blocked on a full result queue and the
+    local balancer provider waiting for ready chunks,
+  - sync skew: spread between the ranks receiving the same sync signal, and the delay after its broadcast,
+  - end-to-end latency from a completion being sent to the first loss computed on it.
+
+    python analyze_trace.py --trace_dir traces/ --output report.json
+"""
+import os
+import glob
+import json
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+
+def load_events(trace_dir: str) -> list[dict]:
+    '''Events of all trace files, tagged with their process as `proc`, the `<host>-<pid>` of their file.'''
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, "*.trace.json"))):
+        proc = os.path.basename(path)[:-len(".trace.json")]
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if not line or line in ("[", "]"):
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a killed process may be truncated
+                    continue
+                event["proc"] = proc
+                events.append(event)
+    return events
+
+
+def describe(values, scale: float = 1.0) -> dict:
+    '''Count and distribution of `values`, multiplied by `scale`.'''
+    if len(values) == 0:
+        return {"count": 0}
+    values = np.asarray(values, dtype=np.float64) * scale
+    return {
+        "count": len(values),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max()),
+    }
+
+
+def format_stats(stats: dict) -> str:
+    if not stats["count"]:
+        return "n=0"
+    return f"n={stats['count']:<6} mean={stats['mean']:.2f} p50={stats['p50']:.2f} p95={stats['p95']:.2f} max={stats['max']:.2f}"
+
+
+def sampler_utilization(events, names) -> dict:
+    by_rank = defaultdict(list)
+    for e in events:
+        if names.get(e["proc"], "").startswith("rank") and "ts" in e:
+            by_rank[names[e["proc"]]].append(e)
+    report = {}
+    for rank, rank_events in sorted(by_rank.items(), key=lambda x: int(x[0][4:])):
+        start = min(e["ts"] for e in rank_events)
+        end = max(e["ts"] + e.get("dur", 0) for e in rank_events)
+        wall = max(end - start, 1)
+        spans = defaultdict(float)
+        for e in rank_events:
+            if e["ph"] == "X":
+                spans[e["name"]] += e["dur"]
+        report[rank] = {
+            "wall_s": wall / 1e6,
+            "sampling": spans["sample_step"] / wall,
+            "generating": spans["generate"] / wall,
+            "rewarding": spans["rewards"] / wall,
+            "polling": spans["poll"] / wall,
+            "waiting_sync": spans["wait_sync"] / wall,
+            "waiting_data": spans["result_queue_wait"] / wall,
+        }
+    return report
+
+
+def backoff(events, names) -> dict:
+    polls = defaultdict(lambda: {"count": 0, "received": 0, "duration_ms": []})
+    for e in events:
+        if e["ph"] == "X" and e["name"] == "poll":
+            stats = polls[e["args"].get("timeout_ms", 0)]
+            stats["count"] += 1
+            stats["received"] += e["args"].get("events", 0) > 0
+            stats["duration_ms"].append(e["dur"] / 1e3)
+    total = sum(stats["count"] for stats in polls.values()) or 1
+    return {
+        str(timeout): {
+            "share": stats["count"] / total,
+            "receive_rate": stats["received"] / stats["count"],
+            "mean_duration_ms": float(np.mean(stats["duration_ms"])),
+        }
+        for timeout, stats in sorted(polls.items())
+    }
+
+
+def queue_waits(events) -> dict:
+    durations = defaultdict(list)
+    for e in events:
+        if e["ph"] == "X" and e["name"] in ("result_queue_wait", "result_queue_put", "ready_queue_wait", "load", "build_chunk"):
+            durations[e["name"]].append(e["dur"])
+    return {name: describe(values, 1e-3) for name, values in sorted(durations.items())}
+
+
+def sync_skew(events, names) -> dict:
+    received = defaultdict(list)
+    broadcast = {}
+    for e in events:
+        if e["ph"] != "i":
+            continue
+        if e["name"] == "sync" and names.get(e["proc"], "").startswith("rank"):
+            received[str(e["args"].get("sync_steps"))].append(e["ts"])
+        elif e["name"] == "sync_broadcast":
+            broadcast[str(e["args"].get("sync_steps"))] = e["ts"]
+    skews = [max(ts) - min(ts) for ts in received.values() if len(ts) > 1]
+    delays = [t - broadcast[step] for step, ts in received.items() if step in broadcast for t in ts]
+    return {"syncs": len(received), "skew_ms": describe(skews, 1e-3), "delay_after_broadcast_ms": describe(delays, 1e-3)}
+
+
+def end_to_end(events) -> dict:
+    sent, trained = {}, {}
+    for e in events:
+        if e["ph"] != "i" or e["name"] not in ("completions", "loss"):
+            continue
+        target = sent if e["name"] == "completions" else trained
+        for uuid in e["args"].get("uuids") or []:
+            if uuid is not None:
+                target[uuid] = min(target.get(uuid, e["ts"]), e["ts"])
+    latencies = [trained[uuid] - ts for uuid, ts in sent.items() if uuid in trained]
+    return {
+        "completions": len(sent),
+        "trained": len(latencies),
+        "never_trained": len(sent) - len(latencies),
+        "completion_to_loss_s": describe(latencies, 1e-6),
+    }
+
+
+def main(args):
+    events = load_events(args.trace_dir)
+    # pids are only unique within a host
+    names = {e["proc"]: e["args"]["name"] for e in events if e["ph"] == "M" and e["name"] == "process_name"}
+    print(f"Loaded {len(events)} events of {len(names)} processes from {args.trace_dir}")
+
+    report = {
+        "sampler_utilization": sampler_utilization(events, names),
+        "backoff": backoff(events, names),
+        "queue_waits_ms": queue_waits(events),
+        "sync": sync_skew(events, names),
+        "end_to_end": end_to_end(events),
+    }
+
+    print("\n== Sampler utilization (share of wall time) ==")
+    print(f"{'rank':>8} {'wall_s':>8} {'sampling':>9} {'generate':>9} {'rewards':>8} {'polling':>8} {'wait_sync':>9} {'wait_data':>9}")
+    for rank, r in report["sampler_utilization"].items():
+        print(f"{rank:>8} {r['wall_s']:8.1f} {r['sampling']:9.1%} {r['generating']:9.1%} {r['rewarding']:8.1%} "
+              f"{r['polling']:8.1%} {r['waiting_sync']:9.1%} {r['waiting_data']:9.1%}")
+
+    print("\n== greedy_gather_wait_time backoff (poll timeout) ==")
+    for timeout, r in report["backoff"].items():
+        print(f"{timeout:>8} ms: {r['share']:6.1%} of polls, receive rate {r['receive_rate']:6.1%}, "
+              f"mean {r['mean_duration_ms']:.2f} ms")
+
+    print("\n== Queue waits (ms) ==")
+    for name, r in report["queue_waits_ms"].items():
+        print(f"{name:>18}: {format_stats(r)}")
+
+    sync = report["sync"]
+    print(f"\n== Sync ({sync['syncs']} syncs, ms) ==")
+    print(f"{'skew':>18}: {format_stats(sync['skew_ms'])}")
+    print(f"{'after broadcast':>18}: {format_stats(sync['delay_after_broadcast_ms'])}")
+
+    e2e = report["end_to_end"]
+    print(f"\n== Completion to loss (s): {e2e['completions']} sent, {e2e['trained']} trained, "
+          f"{e2e['never_trained']} never trained ==")
+    print(f"{'latency':>18}: {format_stats(e2e['completion_to_loss_s'])}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace_dir", type=str, required=True)
+    parser.add_argument("--output", type=str, default=None, help="Where to write the report as JSON.")
+    main(parser.parse_args())
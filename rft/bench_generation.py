@@ -0,0 +1,118 @@
+"""Benchmark generation throughput of the sampling paths used by `AsyncRLGRPOTrainer`.
+
+Compares tokens/s of
+  - offload:  the replica is uploaded from CPU before every sampling phase and decodes eagerly
+              (the `clear_device` path),
+  - resident: the bf16 replica stays on the device and decodes eagerly,
+  - compiled: the resident replica decodes on a static cache with a compiled decoding step.
+
+    python bench_generation.py --model_name_or_path output/resume-sft --batch_size 4 --max_new_tokens 128
+"""
+import time
+import json
+import argparse
+
+import torch
+from PIL import Image
+from transformers import AutoModelForCausalLM, AutoProcessor
+from accelerate.utils.memory import clear_device_cache
+
+from trainer.utils import _prepare_messages, CompiledDecoding, reserve_on_device
+
+
+def build_inputs(processor, args):
+    image = Image.new("RGB", (args.image_width, args.image_height), color=(127, 127, 127))
+    prompt = [{"role": "user", "content": [image, "Describe the screen. " * args.prompt_repeat]}]
+    inputs = _prepare_messages([prompt] * args.batch_size, processor, args.max_prompt_length)
+    inputs.pop("image_sizes", None)
+    return inputs
+
+
+def generate(model, processor, inputs, device, args, **kwargs):
+    inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+    outputs = model.generate(
+        **inputs,
+        tokenizer=processor.tokenizer,
+        do_sample=True,
+        temperature=1.0,
+        repetition_penalty=1.05,
+        max_new_tokens=args.max_new_tokens,
+        min_new_tokens=args.max_new_tokens,
+        use_cache=True,
+        **kwargs
+    )
+    if isinstance(outputs, tuple):
+        outputs = outputs[1]
+    if not isinstance(outputs, torch.Tensor):
+        outputs = outputs.sequences
+    return outputs.numel()
+
+
+def run(mode, model, processor, inputs, device, args):
+    decoding = CompiledDecoding(args.batch_size) if mode == "compiled" else None
+    if mode == "offload":
+        model.cpu()
+        clear_device_cache(True)
+    else:
+        reserve_on_device(model, device)
+
+    timings = []
+    tokens = 0
+    for i in range(args.warmup + args.iters):
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        if mode == "offload":
+            model.to(device=device)
+        kwargs = decoding.generation_kwargs(args.batch_size) if decoding is not None else {}
+        num_tokens = generate(model, processor, inputs, device, args, **kwargs)
+        torch.cuda.synchronize()
+        if mode == "offload":
+            model.cpu()
+            clear_device_cache(True)
+        if i >= args.warmup:
+            timings.append(time.perf_counter() - start)
+            tokens += num_tokens
+
+    return {
+        "mode": mode,
+        "tokens_per_s": tokens / sum(timings),
+        "mean_latency_s": sum(timings) / len(timings),
+        "peak_memory_gb": torch.cuda.max_memory_allocated(device) / 2**30,
+    }
+
+
+def main(args):
+    device = torch.device("cuda")
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model_name_or_path, torch_dtype=torch.bfloat16, trust_remote_code=True
+    ).eval()
+    processor = AutoProcessor.from_pretrained(args.model_name_or_path, trust_remote_code=True)
+    inputs = build_inputs(processor, args)
+
+    results = []
+    with torch.no_grad():
+        for mode in args.modes:
+            torch.cuda.reset_peak_memory_stats(device)
+            result = run(mode, model, processor, inputs, device, args)
+            print(json.dumps(result))
+            results.append(result)
+
+    baseline = results[0]["tokens_per_s"]
+    for result in results:
+        print(f"{result['mode']:>10}: {result['tokens_per_s']:10.1f} tokens/s ({result['tokens_per_s'] / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--modes", nargs="+", default=["offload", "resident", "compiled"],
+                        choices=["offload", "resident", "compiled"])
+    parser.add_argument("--batch_size", type=int, default=4, help="Same as `per_device_train_batch_size`.")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--max_prompt_length", type=int, default=2048)
+    parser.add_argument("--prompt_repeat", type=int, default=16, help="Repeat the text prompt to control its length.")
+    parser.add_argument("--image_width", type=int, default=1120)
+    parser.add_argument("--image_height", type=int, default=1120)
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed iterations, also used for compilation.")
+    parser.add_argument("--iters", type=int, default=10)
+    main(parser.parse_args())
@@ -0,0 +1,87 @@
+"""Benchmark the action validator used by the rewards against the reference json5 + jsonschema path.
+
+Every completion is parsed and validated by both paths, the outcomes (the parsed action, a schema violation
+or a parse error) must be identical. Completions are read from a jsonl file, taking the `completion` field of
+each line, or the content of the last assistant turn of `conversations` for SFT/RFT data files.
+
+    python bench_validator.py --completions_file completions.jsonl --repeat 5
+"""
+import re
+import json
+import time
+import argparse
+
+import json5
+import jsonschema
+
+from trainer.utils.dataset import SCHEMA
+from trainer.utils.gui_eval import load_and_validate_action
+
+
+def reference_load_and_validate_action(res: str):
+    action_str = re.search(r'```json(.*?)```', res, re.DOTALL)
+    if action_str:
+        action_str = action_str.group(1).strip()
+    else:
+        action_str = res
+    action = json5.loads(action_str, allow_duplicate_keys=False)
+    jsonschema.validate(action, SCHEMA)
+    return action
+
+
+def outcome(fn, completion: str):
+    try:
+        return "valid", fn(completion)
+    except jsonschema.ValidationError:
+        return "invalid", None
+    except Exception:
+        return "error", None
+
+
+def load_completions(path: str) -> list[str]:
+    completions = []
+    with open(path, "r") as f:
+        for line in f:
+            item = json.loads(line)
+            if "completion" in item:
+                completion = item["completion"]
+            else:
+                completion = item["conversations"][-1]["content"]
+            # ReAct completions carry the action inside `<act>`
+            act = re.search(r'<act>(.*?)</act>', completion, re.DOTALL)
+            completions.append(act.group(1).strip() if act else completion)
+    return completions
+
+
+def run(fn, completions, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for completion in completions:
+            outcome(fn, completion)
+    return len(completions) * repeat / (time.perf_counter() - start)
+
+
+def main(args):
+    completions = load_completions(args.completions_file)
+    mismatches = 0
+    counts = {"valid": 0, "invalid": 0, "error": 0}
+    for completion in completions:
+        expected = outcome(reference_load_and_validate_action, completion)
+        got = outcome(load_and_validate_action, completion)
+        counts[expected[0]] += 1
+        if expected != got:
+            mismatches += 1
+            print(f"Mismatch on {completion!r}: expected {expected}, got {got}")
+    print(json.dumps({"completions": len(completions), **counts, "mismatches": mismatches}))
+
+    reference = run(reference_load_and_validate_action, completions, args.repeat)
+    fast = run(load_and_validate_action, completions, args.repeat)
+    print(f" reference: {reference:10.1f} completions/s")
+    print(f"      fast: {fast:10.1f} completions/s ({fast / reference:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--completions_file", type=str, required=True)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
@@ -36,6 +36,21 @@ class GRPOScriptArguments(ScriptArguments):
         default=None,
         metadata={"help": "Maximum number of pixels for the longest line of the image"},
     )
+    image_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory keeping the resized screenshots as raw pixels, filled on first load or ahead of "
+                  "training by `preprocess_dataset.py`. If `None`, screenshots are decoded and resized on every load."},
+    )
+    image_lru_size: int = field(
+        default=32,
+        metadata={"help": "Number of resized screenshots kept in memory by each data worker, so the steps of an episode "
+                  "share their history screenshots. 0 disables the in-memory cache."},
+    )
+    strict_dataset: bool = field(
+        default=False,
+        metadata={"help": "Whether invalid records raise instead of being replaced by another record. Use on data "
+                  "checked by `validate_dataset.py`."},
+    )
     eval_dataset_name: Optional[str] = field(
         default=None,
         metadata={"help": "Eval dataset name or path"}
@@ -186,6 +201,136 @@ class GRPOTrainingConfig(TrainingArguments):
         default=31,
         metadata={"help": "Wait time for greedy gather for model updating data"}
     )
+    dispatch_bucket_window: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of batches of tasks sorted together by their estimated prompt cost before dispatch, "
+                  "so each generation batch holds prompts of similar size. Multiturn continuations are still dispatched "
+                  "first. Requires a dataset implementing `prompt_cost`. If `None`, tasks are dispatched in sampler order."}
+    )
+    multiturn_completion_ttl: Optional[float] = field(
+        default=None,
+        metadata={"help": "Seconds after which history completions of multi-turn tasks not accessed anymore are evicted "
+                  "from the dispatcher. If `None`, they are kept until their last continuation is loaded."}
+    )
+    multiturn_completion_spill_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of the memory-mapped segment files backing the history completions of multi-turn "
+                  "tasks, each segment is removed once all its completions were loaded or evicted. If `None`, they are "
+                  "kept in memory."}
+    )
+    local_reprocess_workers: Optional[int] = field(
+        default=4,
+        metadata={"help": "Number of processes used by each local balancer to process prompts (chat template, "
+                  "tokenization and image slicing). If `0`, prompts are processed in a thread of the balancer."}
+    )
+    local_cache_max_bytes: Optional[int] = field(
+        default=None,
+        metadata={"help": "Maximum bytes of completions and interned prompts cached in memory by each local balancer. "
+                  "Completions beyond the budget are spilled into `local_cache_spill_dir`, together with their prompt "
+                  "once no sibling in memory references it. If `None`, the budget is unbounded."}
+    )
+    local_cache_spill_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory for the memory-mapped spill file of the local balancer cache. If `None`, "
+                  "cached completions are never spilled to disk."}
+    )
+    local_cache_spill_after: Optional[int] = field(
+        default=600,
+        metadata={"help": "Seconds after which a cached completion still waiting for its group is spilled to disk."}
+    )
+    local_cache_timeout: Optional[int] = field(
+        default=3600,
+        metadata={"help": "Seconds after which a cached completion is evicted from the local balancer and the "
+                  "global manager is notified."}
+    )
+    sent_prompt_keys: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of prompt keys each rank remembers as sent to the local balancer, whose siblings are "
+                  "sent without their prompt. If `None`, the number of completions cached by the local balancer, which "
+                  "holds at most one interned prompt per cached completion."}
+    )
+    tp_shm_dir: Optional[str] = field(
+        default="/dev/shm",
+        metadata={"help": "Directory on a tmpfs where the local balancer writes each training chunk once for all ranks "
+                  "of a tensor parallel group, which map it without copying. If `None`, every rank receives its own "
+                  "pickled copy. Only used with `tensor_parallel_size` > 1."}
+    )
+    incremental_weight_sync: bool = field(
+        default=True,
+        metadata={"help": "Whether to stream the trained weights into the device-resident inference model parameter "
+                  "by parameter, skipping frozen parameters, instead of materializing the full state dict."}
+    )
+    weight_sync_steps: int = field(
+        default=1,
+        metadata={"help": "Sync the inference model only every `weight_sync_steps` optimizer steps. Requires "
+                  "`incremental_weight_sync`."}
+    )
+    resident_inference_model: bool = field(
+        default=False,
+        metadata={"help": "Whether to keep a bf16 inference replica resident on the device in a dedicated memory "
+                  "pool, instead of moving it to CPU around every sampling phase when `clear_device` is set."}
+    )
+    compile_generation: bool = field(
+        default=False,
+        metadata={"help": "Whether to decode on a static KV cache with the decoding step compiled into CUDA graphs "
+                  "for batches of `per_device_train_batch_size`. Other batch shapes decode eagerly. Requires "
+                  "`resident_inference_model`."}
+    )
+    logprob_chunk_size: int = field(
+        default=64,
+        metadata={"help": "Number of completion positions projected by the `lm_head` at once when computing "
+                  "per-token logprobs. Lower values use less activation memory."}
+    )
+    ref_logprob_device: Optional[str] = field(
+        default=None,
+        metadata={"help": "Device used by the reference logprob service of each local balancer, e.g. `cuda:7`. When "
+                  "set and `beta > 0`, reference logprobs are computed out of band and shipped with the chunks as fp16 "
+                  "tensors, so training ranks never host or run the reference model."}
+    )
+    ref_logprob_memory_fraction: Optional[float] = field(
+        default=None,
+        metadata={"help": "Fraction of the memory of `ref_logprob_device` the reference logprob service may use, "
+                  "for sharing the device with a training rank."}
+    )
+    record_behavior_logps: bool = field(
+        default=True,
+        metadata={"help": "Whether to record the per-token logprobs of the sampling policy at generation time and use "
+                  "them as `old_per_token_logps` in the loss. If `False`, the importance ratio is always 1."}
+    )
+    max_staleness: Optional[int] = field(
+        default=None,
+        metadata={"help": "Maximum number of optimizer steps between generating a completion and training on it. "
+                  "Staler completions are handled according to `staleness_policy`. If `None`, staleness is unbounded."}
+    )
+    staleness_policy: str = field(
+        default="drop",
+        metadata={"help": "How to handle completions staler than `max_staleness`. `drop` masks them out of the loss, "
+                  "`reweight` scales their loss by `(max_staleness + 1) / (staleness + 1)`.",
+                  "choices": ["drop", "reweight"]}
+    )
+    cache_vision_embeddings: bool = field(
+        default=False,
+        metadata={"help": "Whether to keep the outputs of the vision encoder computed at generation time with the "
+                  "completions, so the policy and reference forwards of every iteration reuse them instead of encoding "
+                  "the images again. Requires `tune_vision=False`, which freezes the vision encoder and resampler."}
+    )
+    pack_sequences: bool = field(
+        default=False,
+        metadata={"help": "Whether to pack the unpadded sequences of a training batch into a single row for the policy "
+                  "forward, using varlen flash attention. Requires `attn_implementation=flash_attention_2` and transformers>=4.48.0. "
+                  "Packing is disabled if the packed logprobs of the first batch differ from the padded ones. The loss is "
+                  "still normalized per completion."}
+    )
+    reward_timeout: float = field(
+        default=10.0,
+        metadata={"help": "Seconds the built-in rewards of a sampled batch may take in total. Samples still being "
+                  "scored after this deadline get the timeout scores, and hung reward workers are killed and replaced."}
+    )
+    reward_cache_size: int = field(
+        default=4096,
+        metadata={"help": "Number of reward scores memoized by completion text, solution, bbox and resolution, so "
+                  "identical completions are scored once. 0 disables the memoization."}
+    )
     
     # Parameters that control the model and reference model
     model_init_kwargs: Optional[dict] = field(
@@ -34,6 +34,11 @@ def main(script_args, training_args, model_args):
     
     model = AutoModelForCausalLM.from_pretrained(model_id, **model_init_kwargs)
     processing_class = AutoProcessor.from_pretrained(model_id,trust_remote_code=True)
+    if not training_args.tune_vision:
+        model.vpm.requires_grad_(False)
+        if training_args.cache_vision_embeddings:
+            # the cached vision embeddings are the outputs of the resampler
+            model.resampler.requires_grad_(False)
     # processing_class.pad_token_id = processing_class.tokenizer.pad_token_id
     # if processing_class.pad_token_id is None:
     #     processing_class.tokenizer.pad_token_id =  2
@@ -165,14 +170,20 @@ def main(script_args, training_args, model_args):
         global_task_dispatch_addr=global_task_dispatch_addr,
         hist_length=training_args.hist_length,
         jsonl_file_path=script_args.dataset_name,
-        max_line_res=script_args.max_line_res,)
+        max_line_res=script_args.max_line_res,
+        image_cache_dir=script_args.image_cache_dir,
+        image_lru_size=script_args.image_lru_size,
+        strict=script_args.strict_dataset,)
     
     if script_args.eval_dataset_name is not None:
         eval_set = dataset_cls(
             global_task_dispatch_addr=global_task_dispatch_addr,
             hist_length=training_args.hist_length,
             jsonl_file_path=script_args.eval_dataset_name,
-            max_line_res=script_args.max_line_res,)
+            max_line_res=script_args.max_line_res,
+            image_cache_dir=script_args.image_cache_dir,
+            image_lru_size=script_args.image_lru_size,
+            strict=script_args.strict_dataset,)
     else:
         eval_set = None
         
@@ -0,0 +1,86 @@
+"""Preprocess an RFT dataset ahead of training.
+
+  - indexes the JSONL into `<jsonl_file>.index.npy`, so the datasets open it without parsing every line,
+  - with `--output_file`, writes the single-turn records pre-parsed by `prepare_record`, which
+    `GUIRFTDataset` reads without matching the question or decoding the action again,
+  - with `--image_cache_dir`, resizes every screenshot to `--max_line_res` into the `ImageCache` read by
+    the datasets when training with the same `--image_cache_dir` and `--max_line_res`,
+  - with `--thumbnails`, also caches the thumbnails of the history screenshots of multi-turn prompts.
+
+    python preprocess_dataset.py --jsonl_file train.jsonl --output_file train.prepared.jsonl \\
+        --image_cache_dir /data/image_cache --max_line_res 1120 --num_workers 32
+"""
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from trainer.utils.dataset import JsonlRecords, ImageCache, prepare_record, HISTORY_LINE_RES
+
+
+def cache_image(cache_dir, img_file, max_line_res):
+    try:
+        ImageCache(cache_dir).load(img_file, max_line_res)
+        return True
+    except Exception as e:
+        print("Error while loading image: ", img_file, e)
+        return False
+
+
+def main(args):
+    records = JsonlRecords(args.jsonl_file)
+    image_root = os.path.dirname(os.path.dirname(args.jsonl_file))
+    print(f"Indexed {len(records)} records of {args.jsonl_file}")
+
+    images = []
+    output = open(args.output_file, "w") if args.output_file is not None else None
+    skipped = 0
+    for index in tqdm(range(len(records)), desc="Preparing records", dynamic_ncols=True):
+        item = records[index]
+        for img_file in item["image"].values():
+            images.append(img_file if os.path.exists(img_file) else os.path.join(image_root, img_file))
+        if output is not None:
+            try:
+                record = prepare_record(item, image_root)
+                # the prepared file may be moved away from the screenshots
+                record["image"] = {img_id: os.path.abspath(img_file) for img_id, img_file in record["image"].items()}
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception:
+                skipped += 1
+    if output is not None:
+        output.close()
+        # index the prepared records right away
+        JsonlRecords(args.output_file)
+        print(f"Wrote {len(records) - skipped} prepared records to {args.output_file}, skipped {skipped}")
+
+    if args.image_cache_dir is not None:
+        images = sorted(set(images))
+        line_res = [args.max_line_res, HISTORY_LINE_RES] if args.thumbnails else [args.max_line_res]
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            for max_line_res in line_res:
+                results = list(tqdm(
+                    executor.map(
+                        cache_image,
+                        [args.image_cache_dir] * len(images),
+                        images,
+                        [max_line_res] * len(images),
+                        chunksize=64,
+                    ),
+                    total=len(images), desc=f"Caching images at {max_line_res}", dynamic_ncols=True
+                ))
+                print(f"Cached {sum(results)} of {len(images)} screenshots at {max_line_res} into {args.image_cache_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jsonl_file", type=str, required=True)
+    parser.add_argument("--output_file", type=str, default=None,
+                        help="Where to write the pre-parsed single-turn records, not supported by multi-turn training.")
+    parser.add_argument("--image_cache_dir", type=str, default=None)
+    parser.add_argument("--max_line_res", type=int, default=None, help="Same as the training `max_line_res`.")
+    parser.add_argument("--thumbnails", action="store_true",
+                        help=f"Also cache the {HISTORY_LINE_RES} px history screenshots used by multi-turn training.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    main(parser.parse_args())
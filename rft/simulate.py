@@ -0,0 +1,341 @@
+"""CPU-only simulation of the ARL coordination layer.
+
+Runs the real `GlobalSyncManager`, `LocalBalanceManager`s, the dataloader master loop and the
+`BatchGatherer` of the training ranks in one process over ipc transports. Generation and training are
+replaced by sleeps drawn from configurable distributions, so protocol and balancing changes can be
+benchmarked locally before spending cluster time:
+
+    python simulate.py --nodes 2 --gpus_per_node 4 --steps 20 --slow_nodes 1 --slowdown 2.0
+
+Random draws are seeded per rank and per task, but which rank generates which task and when chunks arrive
+depend on thread scheduling, so runs are not reproducible and benchmarks should be repeated.
+"""
+import os
+import json
+import math
+import time
+import uuid
+import pickle
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+import numpy as np
+import torch
+import zmq
+
+os.environ.setdefault("MONITOR_INTERVAL", "10")
+os.environ.setdefault("LOCAL_MONITOR_INTERVAL", "10")
+
+from trl.trainer.grpo_trainer import RepeatRandomSampler
+from trainer.zmq import GlobalSyncManager, LocalBalanceManager, BatchGatherer, TaskAndContent, TaskStatus
+from trainer.utils import GlobalDistributed0MQDataLoader, logger
+
+
+class SimLocalBalanceManager(LocalBalanceManager):
+    """Local balancer whose prompt processing only carries the fake payloads."""
+
+    def _load_processor(self):
+        return None
+
+    def _process_prompt(self, prompt):
+        return {"payload": prompt["payload"]}
+
+    def _build_chunk(self, collected, prepared):
+        return {
+            "task_ids": [d["id"] for d in collected],
+            "advantages": torch.tensor([d["advantage"] for d in collected]),
+            "policy_versions": [d["policy_version"] for d in collected],
+            "created": [d["created"] for d in collected],
+            "prompts": [p["payload"] for p in prepared],
+            "completions": [d["completion_payload"] for d in collected],
+        }
+
+
+class SimTrainer:
+    """Fake training rank, gathers its batches with the `BatchGatherer` of the trainer."""
+
+    def __init__(self, rank, node_rank, args, addrs, barrier, slowdown):
+        self.rank = rank
+        self.node_rank = node_rank
+        self.args = args
+        self.barrier = barrier
+        self.slowdown = slowdown
+        self.rng = random.Random(args.seed * 1000003 + rank)
+
+        self.num_iterations = args.num_iterations
+        self.version = 0
+
+        self.zmqctx = zmq.Context(2)
+        self.sync_signal = self.zmqctx.socket(zmq.SUB)
+        self.sync_signal.setsockopt(zmq.SUBSCRIBE, b"SYNC_FOR_UPDATE")
+        self.sync_signal.connect(addrs["global_sync"])
+
+        self.balance_send = self.zmqctx.socket(zmq.REQ)
+        self.balance_send.connect(addrs["local_collect"][node_rank])
+
+        self.balance_recv = self.zmqctx.socket(zmq.REQ)
+        self.balance_recv.connect(addrs["local_provider"][node_rank])
+
+        self.ack = self.zmqctx.socket(zmq.REQ)
+        self.ack.connect(addrs["global_collect"])
+
+        self.task_receiver = self.zmqctx.socket(zmq.REQ)
+        self.task_receiver.connect(addrs["global_dispatch"])
+
+        self.batch_gatherer = BatchGatherer(
+            sync_signal=self.sync_signal,
+            balance_recv=self.balance_recv,
+            ack=self.ack,
+            tp_group_id=rank,
+            rank=rank,
+            chunk_size=args.per_device_train_batch_size,
+            num_iterations=args.num_iterations,
+            max_items_to_cache=args.max_items_to_cache,
+            greedy_gather_wait_time=args.greedy_gather_wait_time,
+        )
+
+        self.stats = defaultdict(float)
+        self.staleness = []
+        self.ages = []
+
+    def epoch_iterator(self):
+        while True:
+            self.task_receiver.send_pyobj("REQ_TASK")
+            yield pickle.loads(self.task_receiver.recv())
+
+    def sample_step(self, tasks, model):
+        args = self.args
+        gen_time = self.rng.lognormvariate(math.log(args.gen_latency), args.gen_sigma) * self.slowdown
+        time.sleep(gen_time)
+        self.stats["gen_time"] += gen_time
+        self.stats["generated"] += len(tasks)
+
+        for task_id in tasks:
+            # difficulty is fixed per task so that whole groups can be filtered
+            difficulty = random.Random(args.seed * 7919 + task_id).betavariate(args.score_alpha, args.score_beta)
+            score = min(max(self.rng.gauss(difficulty, args.score_noise), 0.0), 1.0)
+            tac = TaskAndContent(
+                data={
+                    "id": task_id,
+                    "prompt": {"payload": bytes(args.prompt_kb * 1024)},
+                    "prompt_key": (task_id, "sim"),
+                    "completion": "",
+                    "completion_payload": bytes(args.completion_kb * 1024),
+                    "reward": score,
+                    "policy_version": self.version,
+                    "created": time.monotonic(),
+                },
+                status=TaskStatus(task_id=task_id, completion_id=uuid.uuid4(), score=score)
+            )
+            self.balance_send.send_pyobj(tac)
+            self.balance_send.recv_string()
+
+    def run(self):
+        iterator = self.epoch_iterator()
+        num_batches = self.args.gradient_accumulation_steps
+        for _ in range(self.args.steps):
+            start = time.monotonic()
+            try:
+                batch = self.batch_gatherer.gather(iterator, num_batches, lambda tasks: self.sample_step(tasks, None))
+            except AssertionError as e:
+                logger.error(f"Rank {self.rank}: {e}")
+                self.stats["invalid_syncs"] += 1
+                batch = []
+            now = time.monotonic()
+            self.stats["sampling_time"] += now - start
+
+            for chunk in batch:
+                # each chunk is repeated `num_iterations` times in the batch
+                self.stats["trained"] += len(chunk["task_ids"]) / self.num_iterations
+                self.staleness.extend(self.version - v for v in chunk["policy_versions"])
+                self.ages.extend(now - c for c in chunk["created"])
+
+            train_time = self.args.train_latency * num_batches
+            time.sleep(train_time)
+            self.stats["train_time"] += train_time
+            self.version += 1
+            # optimizer steps are collective in real training
+            self.barrier.wait()
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max()),
+    }
+
+
+def main(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    num_ranks = args.nodes * args.gpus_per_node
+    chunk_size = args.per_device_train_batch_size
+    ipc_dir = tempfile.mkdtemp(prefix="arl_sim_")
+    addrs = {
+        "global_sync": f"ipc://{ipc_dir}/global_sync",
+        "global_collect": f"ipc://{ipc_dir}/global_collect",
+        "global_dispatch": f"ipc://{ipc_dir}/global_dispatch",
+        "local_collect": [f"ipc://{ipc_dir}/local_collect_{i}" for i in range(args.nodes)],
+        "local_provider": [f"ipc://{ipc_dir}/local_provider_{i}" for i in range(args.nodes)],
+        "local_steal": [f"ipc://{ipc_dir}/local_steal_{i}" for i in range(args.nodes)],
+    }
+
+    sampler = RepeatRandomSampler(
+        data_source=range(args.num_tasks),
+        mini_repeat_count=args.num_generations,
+        batch_size=chunk_size * num_ranks * args.gradient_accumulation_steps // args.num_generations,
+        repeat_count=1,
+        seed=args.seed,
+    )
+    threading.Thread(
+        target=GlobalDistributed0MQDataLoader._master_loop,
+        args=(addrs["global_dispatch"], chunk_size, sampler),
+        daemon=True
+    ).start()
+
+    global_manager = GlobalSyncManager(
+        sync_address=addrs["global_sync"],
+        collect_address=addrs["global_collect"],
+        num_generations=args.num_generations,
+        num_to_sync=args.gradient_accumulation_steps * num_ranks * chunk_size,
+        num_nodes=args.nodes,
+    )
+    threading.Thread(target=global_manager.start, daemon=True).start()
+
+    local_managers = []
+    for i in range(args.nodes):
+        manager = SimLocalBalanceManager(
+            local_collect_address=addrs["local_collect"][i],
+            local_provider_address=addrs["local_provider"][i],
+            local_steal_port=0,
+            global_sync_address=addrs["global_sync"],
+            global_result_collect_address=addrs["global_collect"],
+            global_data_dispatch_address=addrs["global_dispatch"],
+            chunk_size=chunk_size,
+            mt_max_beam_width=1,
+            max_cache_size=args.gradient_accumulation_steps * chunk_size * args.gpus_per_node * 8,
+            processing_class_name_or_path=None,
+            max_prompt_length=0,
+            steal_threshold=args.steal_threshold,
+            timeout=args.cache_timeout,
+            reprocess_workers=0,
+            steal_address=addrs["local_steal"][i],
+        )
+        threading.Thread(target=manager.start, daemon=True).start()
+        local_managers.append(manager)
+
+    # restart the sampler before any rank requests tasks
+    dispatch = zmq.Context.instance().socket(zmq.REQ)
+    dispatch.connect(addrs["global_dispatch"])
+    dispatch.send_pyobj("RESTART")
+    dispatch.recv()
+    # let the SUB sockets finish connecting
+    time.sleep(0.5)
+
+    barrier = threading.Barrier(num_ranks)
+    trainers = []
+    for rank in range(num_ranks):
+        node_rank = rank // args.gpus_per_node
+        slowdown = args.slowdown if node_rank < args.slow_nodes else 1.0
+        trainers.append(SimTrainer(rank, node_rank, args, addrs, barrier, slowdown))
+
+    queue_depths = defaultdict(list)
+    cache_sizes = defaultdict(list)
+    done = threading.Event()
+
+    def sample_queues():
+        while not done.is_set():
+            for i, manager in enumerate(local_managers):
+                queue_depths[i].append(manager.ready_queue.qsize())
+                cache_sizes[i].append(len(manager.cached_tasks))
+            time.sleep(args.sample_interval)
+
+    threading.Thread(target=sample_queues, daemon=True).start()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=t.run, daemon=True) for t in trainers]
+    for thread in threads:
+        thread.start()
+    deadline = start + args.timeout
+    for thread in threads:
+        thread.join(timeout=max(0.0, deadline - time.monotonic()))
+    elapsed = time.monotonic() - start
+    done.set()
+    hung = sum(thread.is_alive() for thread in threads)
+
+    generated = sum(t.stats["generated"] for t in trainers)
+    trained = sum(t.stats["trained"] for t in trainers)
+    sampling_time = sum(t.stats["sampling_time"] for t in trainers)
+    gen_time = sum(t.stats["gen_time"] for t in trainers)
+    train_time = sum(t.stats["train_time"] for t in trainers)
+    busy = gen_time + train_time
+    report = {
+        "wall_time": elapsed,
+        "hung_ranks": hung,
+        "steps": min(t.version for t in trainers),
+        "invalid_syncs": int(sum(t.stats["invalid_syncs"] for t in trainers)),
+        "completions_generated": int(generated),
+        "completions_trained": int(trained),
+        "generate_throughput": generated / elapsed,
+        "train_throughput": trained / elapsed,
+        "rank_utilization": busy / max(sampling_time + train_time, 1e-6),
+        "sampling_wait_fraction": (sampling_time - gen_time) / max(sampling_time + train_time, 1e-6),
+        "filtered_groups": global_manager.filtered_count,
+        "drop_rate": global_manager.filtered_count * args.num_generations / max(global_manager.recv_count, 1),
+        "evicted": global_manager.evict_count,
+        "staleness_steps": _percentiles([s for t in trainers for s in t.staleness]),
+        "completion_age_s": _percentiles([a for t in trainers for a in t.ages]),
+        "queue_depth": {f"node{i}": _percentiles(v) for i, v in queue_depths.items()},
+        "cache_size": {f"node{i}": _percentiles(v) for i, v in cache_sizes.items()},
+        "stealing": {f"node{i}": m.stealer.summary() for i, m in enumerate(local_managers)},
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "report": report}, f, indent=2)
+    shutil.rmtree(ipc_dir, ignore_errors=True)
+    # the managers run forever in daemon threads
+    os._exit(1 if hung else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--gpus_per_node", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=20, help="Optimizer steps to simulate.")
+    parser.add_argument("--per_device_train_batch_size", type=int, default=4)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    parser.add_argument("--num_generations", type=int, default=8)
+    parser.add_argument("--num_iterations", type=int, default=1)
+    parser.add_argument("--num_tasks", type=int, default=4096)
+    parser.add_argument("--max_items_to_cache", type=int, default=4)
+    parser.add_argument("--greedy_gather_wait_time", type=int, default=20, help="Milliseconds.")
+    parser.add_argument("--steal_threshold", type=int, default=1)
+    parser.add_argument("--cache_timeout", type=int, default=3600)
+    parser.add_argument("--gen_latency", type=float, default=0.5, help="Median seconds per generation batch.")
+    parser.add_argument("--gen_sigma", type=float, default=0.3, help="Log-normal sigma of generation latency.")
+    parser.add_argument("--train_latency", type=float, default=0.3, help="Seconds per micro batch.")
+    parser.add_argument("--slow_nodes", type=int, default=0, help="Number of nodes generating slower.")
+    parser.add_argument("--slowdown", type=float, default=2.0, help="Generation latency factor of slow nodes.")
+    parser.add_argument("--score_alpha", type=float, default=2.0, help="Beta prior of task difficulty.")
+    parser.add_argument("--score_beta", type=float, default=2.0, help="Beta prior of task difficulty.")
+    parser.add_argument("--score_noise", type=float, default=0.2, help="Std of completion scores within a task.")
+    parser.add_argument("--prompt_kb", type=int, default=256, help="Size of the fake processed prompt.")
+    parser.add_argument("--completion_kb", type=int, default=4, help="Size of the fake completion.")
+    parser.add_argument("--sample_interval", type=float, default=0.2, help="Queue depth sampling interval.")
+    parser.add_argument("--timeout", type=float, default=600, help="Abort the simulation after this many seconds.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=str, default=None, help="Write the report to a JSON file.")
+    main(parser.parse_args())
@@ -5,12 +5,13 @@ import zmq
 import torch
 import datetime
 import pickle
+import time
 import uuid
 import transformers
 import copy
 
 from typing import Any, Callable, Optional, Union, Sized, List, Dict
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from multiprocessing import Process
 from packaging import version
 import contextlib
@@ -27,7 +28,9 @@ from transformers import (
     PreTrainedModel,
     PreTrainedTokenizerBase,
     TrainerCallback,
-    Trainer
+    Trainer,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor
 )
 from transformers.trainer import seed_worker,DataLoader,is_datasets_available
 
@@ -62,8 +65,8 @@ if is_vllm_available():
 
 
 from configs import GRPOTrainingConfig
-from .utils import logger, Timer, _prepare_messages,_process_inputs,_create_inputs, no_sync, GlobalDistributed0MQDataLoader
-from .zmq import global_sync_proc, local_balance_proc, TaskAndContent, TaskStatus
+from .utils import logger, Timer, RewardEngine, component_engine, _prepare_messages,_process_inputs,_create_inputs,_prompt_key, no_sync, GlobalDistributed0MQDataLoader, WeightSyncEngine, CompiledDecoding, reserve_on_device, compute_per_token_logps, SampledLogpsRecorder, tracer
+from .zmq import global_sync_proc, local_balance_proc, TaskAndContent, TaskStatus, BatchGatherer
 
 RewardFunc = Union[str, PreTrainedModel, Callable[[list, list], list[float]]]
 
@@ -197,7 +200,31 @@ class AsyncRLGRPOTrainer(Trainer):
         # Multi-step
         self.num_iterations = args.num_iterations  # = 𝜇 in the GRPO paper
         self.max_items_to_cache = args.max_items_to_cache
-        self.cached_data = []
+        # Off-policy correction
+        self.record_behavior_logps = args.record_behavior_logps
+        self.logprob_chunk_size = args.logprob_chunk_size
+        self.max_staleness = args.max_staleness
+        self.staleness_policy = args.staleness_policy
+        if self.staleness_policy not in ("drop", "reweight"):
+            raise ValueError(f"Unknown staleness_policy {self.staleness_policy}, expected `drop` or `reweight`.")
+        # Vision embeddings are reusable only if the vision encoder is not trained
+        self.cache_vision_embeddings = args.cache_vision_embeddings
+        if self.cache_vision_embeddings and any(
+            param.requires_grad for name, param in model.named_parameters() if name.startswith(("vpm.", "resampler."))
+        ):
+            logger.warning("`cache_vision_embeddings` requires a frozen vision encoder (`tune_vision=False`), disable it.")
+            self.cache_vision_embeddings = False
+        # Packed sequences are separated by the varlen kernels of flash attention only
+        self.pack_sequences = args.pack_sequences
+        if self.pack_sequences and getattr(model.config, "_attn_implementation", None) != "flash_attention_2":
+            logger.warning("`pack_sequences` requires `attn_implementation=flash_attention_2`, disable it.")
+            self.pack_sequences = False
+        # the language model must forward `cu_seq_lens_*` to flash attention, else the packed samples attend to each other
+        if self.pack_sequences and version.parse(transformers.__version__) < version.parse("4.48.0"):
+            logger.warning("`pack_sequences` requires transformers>=4.48.0 to pass the sequence boundaries to flash attention, disable it.")
+            self.pack_sequences = False
+        # packed and padded logprobs are compared once on the first training batch, see `compute_loss`
+        self.pack_sequences_checked = False
         self.device_mesh = device_mesh
         self.rank = dist.get_rank()
         if self.device_mesh is not None:
@@ -208,6 +235,7 @@ class AsyncRLGRPOTrainer(Trainer):
             self.tp_size = 1
             self.tp_group_id = dist.get_rank()
             self.tp_rank = 0
+        tracer.set_process_name(f"rank{self.rank}")
         # The trainer estimates the number of FLOPs (floating-point operations) using the number of elements in the
         # input tensor associated with the key "input_ids". However, in GRPO, the sampled data does not include the
         # "input_ids" key. Instead, the available keys is "prompt". As a result, the trainer issues the warning:
@@ -251,6 +279,25 @@ class AsyncRLGRPOTrainer(Trainer):
             self.inference_model = create_reference_model(model).cpu()
             if self.accelerator.is_fsdp2:
                 self.accelerator.no_sync = MethodType(no_sync,self.accelerator)
+        # Keep a bf16 replica resident on the device, optionally with compiled decoding
+        self.resident_inference_model = args.resident_inference_model and self.inference_model is not None
+        self.inference_memory_pool = None
+        self.compiled_decoding = None
+        if self.resident_inference_model:
+            self.inference_model.to(dtype=torch.bfloat16)
+            self.inference_memory_pool = reserve_on_device(self.inference_model, self.accelerator.device)
+            if args.compile_generation:
+                self.compiled_decoding = CompiledDecoding(args.per_device_train_batch_size)
+        elif args.compile_generation:
+            logger.warning("`compile_generation` requires `resident_inference_model`, decode eagerly.")
+        # optimizer step of the weights held by the inference model
+        self.inference_version = 0
+        self.weight_sync = None
+        if self.inference_model is not None and args.incremental_weight_sync:
+            self.weight_sync = WeightSyncEngine(self.inference_model, self.accelerator.device, sync_every=args.weight_sync_steps)
+            if not self.weight_sync.supported:
+                logger.warning("The inference model holds distributed tensors, fall back to full state dict weight sync.")
+                self.weight_sync = None
 
 
         # Gradient accumulation requires scaled loss. Normally, loss scaling in the parent class depends on whether the
@@ -268,7 +315,9 @@ class AsyncRLGRPOTrainer(Trainer):
         self.beta = args.beta
         self.ref_model = None
         self.update_ref_model = False
-        if self.beta == 0 or is_peft_model(model):
+        # Reference logprobs are computed by the local balancers, training ranks never host the reference model
+        self.ref_logprob_service = self.beta > 0 and args.ref_logprob_device is not None
+        if self.beta == 0 or is_peft_model(model) or self.ref_logprob_service:
             # If PEFT is used, the reference model is not needed since the adapter can be disabled
             # to revert to the initial model.
             self.ref_model = None
@@ -282,6 +331,11 @@ class AsyncRLGRPOTrainer(Trainer):
         if not isinstance(reward_funcs, list):
             reward_funcs = [reward_funcs]
         self.reward_funcs = reward_funcs
+        # the built-in rewards are evaluated together, parsing each completion once
+        reward_names = [getattr(reward_func, "reward_name", None) for reward_func in reward_funcs]
+        self.reward_engine = RewardEngine(
+            reward_names, timeout=args.reward_timeout, cache_size=args.reward_cache_size
+        ) if all(reward_names) else None
 
 
         if self.ref_model is not None:
@@ -317,6 +371,8 @@ class AsyncRLGRPOTrainer(Trainer):
             
         self.accelerator.wait_for_everyone()
         
+        # completions cached by the local balancer, each one holds a reference to its interned prompt
+        local_cache_size = args.gradient_accumulation_steps * args.per_device_train_batch_size * torch.cuda.device_count() * 8
         if self.accelerator.is_local_main_process:
             self.local_balance_proc = Process(
                 target=local_balance_proc,
@@ -329,10 +385,21 @@ class AsyncRLGRPOTrainer(Trainer):
                     "global_data_dispatch_address":self.global_data_dispatch_address,
                     "chunk_size": args.per_device_train_batch_size,
                     "mt_max_beam_width": args.mt_max_beam_width,
-                    "max_cache_size": args.gradient_accumulation_steps * args.per_device_train_batch_size * torch.cuda.device_count() * 8,
+                    "max_cache_size": local_cache_size,
                     "processing_class_name_or_path": model.name_or_path,
                     "max_prompt_length": args.max_prompt_length,
-                    "tp_size": self.tp_size
+                    "tp_size": self.tp_size,
+                    "timeout": args.local_cache_timeout,
+                    "reprocess_workers": args.local_reprocess_workers,
+                    "max_cache_bytes": args.local_cache_max_bytes,
+                    "spill_dir": args.local_cache_spill_dir,
+                    "spill_after": args.local_cache_spill_after,
+                    "ref_model_name_or_path": model.name_or_path if self.ref_logprob_service else None,
+                    "ref_model_init_kwargs": model_init_kwargs,
+                    "ref_device": args.ref_logprob_device,
+                    "ref_memory_fraction": args.ref_logprob_memory_fraction,
+                    "ref_chunk_size": args.logprob_chunk_size,
+                    "tp_shm_dir": args.tp_shm_dir
                 }
             )
             self.local_balance_proc.start()
@@ -359,12 +426,22 @@ class AsyncRLGRPOTrainer(Trainer):
         self.ack = self.zmqctx.socket(zmq.REQ)
         self.ack.connect(self.global_result_collect_address)
         
-        self.poller = zmq.Poller()
-        self.poller.register(self.sync_signal,zmq.POLLIN)
-        self.poller.register(self.balance_recv,zmq.POLLIN)
-        self.poller.register(self.ack, zmq.POLLIN)
+        self.batch_gatherer = BatchGatherer(
+            sync_signal=self.sync_signal,
+            balance_recv=self.balance_recv,
+            ack=self.ack,
+            tp_group_id=self.tp_group_id,
+            rank=self.rank,
+            chunk_size=self.chunk_size,
+            num_iterations=self.num_iterations,
+            max_items_to_cache=self.max_items_to_cache,
+            greedy_gather_wait_time=self.greedy_gather_wait_time,
+        )
         
-        self.recv_idx = 0
+        # keys of prompts already sent to the local balancer, siblings are sent without prompt
+        self.sent_prompt_keys = OrderedDict()
+        # the balancer keeps at most one prompt per cached completion, remembering more keys only causes PROMPT_MISSING round trips
+        self.max_sent_prompt_keys = args.sent_prompt_keys if args.sent_prompt_keys is not None else local_cache_size
         
         if self.device_mesh is not None:
             tp_group = dist.get_process_group_ranks(self.device_mesh.get_group("tp"))
@@ -381,92 +458,7 @@ class AsyncRLGRPOTrainer(Trainer):
             self._signature_columns = ["prompt"]
 
     def _async_sampling(self, unwrapped_model, epoch_iterator, num_batches):
-        # initial batch fill
-        current_batch = [self.cached_data.pop() for _ in range(min(num_batches, len(self.cached_data)))]
-        if len(current_batch) < num_batches:
-            # first send sync request
-            self.balance_recv.send_pyobj((self.tp_group_id,self.rank,self.recv_idx))
-
-        waiting_for_ack = False
-        # `wait_time_ms` will hold our dynamic timeout (in milliseconds)
-        wait_time_ms = 0
-
-        while True:
-            # poll with the current wait_time
-            socks = dict(self.poller.poll(timeout=wait_time_ms))
-
-            # 1) handle ack-only sockets if we’re waiting for one
-            if waiting_for_ack and self.ack in socks:
-                self.ack.recv()
-                waiting_for_ack = False
-
-            # 2) if we successfully received backward data, reset wait_time and refill cache
-            if self.balance_recv in socks and not waiting_for_ack:
-                data: dict = self.balance_recv.recv_pyobj()                
-                batch_samples = [data] * self.num_iterations
-                self.recv_idx += 1
-                self.ack.send_pyobj(self.chunk_size)
-                waiting_for_ack = True
-                logger.debug("Worker {} Received backward data".format(self.rank))
-                
-                wait_time_ms = self.greedy_gather_wait_time
-                
-                if len(current_batch) < num_batches:
-                    needed = num_batches - len(current_batch)
-                    current_batch.extend(batch_samples[:needed])
-                    self.cached_data.extend(batch_samples[needed:])
-                    # if still short, ask for more
-                    if len(current_batch) < num_batches and len(self.cached_data) < self.max_items_to_cache:
-                        self.balance_recv.send_pyobj((self.tp_group_id,self.rank,self.recv_idx))
-                    else:
-                        wait_time_ms = 0 # reset wait_time_ms to 0 to avoid waiting for more data
-                else:
-                    self.cached_data.extend(batch_samples)
-                    wait_time_ms = 0 # reset wait_time_ms to 0 to avoid waiting for more data
-
-                # immediately go back to polling (no sampling yet)
-                continue
-
-            # 3) if we get the sync signal, verify and break out
-            if self.sync_signal in socks:
-                try:
-                    parts = self.sync_signal.recv_multipart()
-                    wid, d = parts
-                    sync_steps = pickle.loads(d)
-                except:
-                    logger.error(f"Receive Undcodeable Sync singal: {parts}")
-                    sync_steps = "UNKNOWN"
-                    wid = "UNKNOWN".encode()
-                    
-                assert len(current_batch) == num_batches, (
-                    f"INVALID SYNC at step {sync_steps} with "
-                    f"{len(current_batch)} + {len(self.cached_data)} backward data"
-                )
-                logger.debug(
-                    f"Worker {self.rank} Received sync signal {wid.decode()} "
-                    f"with {len(current_batch)} + {len(self.cached_data)} backward data"
-                )
-                break
-
-            # 4) no backward data arrived within wait_time_ms
-            if wait_time_ms > 0:
-                # exponential back‐off: halve the wait time, but don’t go below zero
-                wait_time_ms = int(max(0, wait_time_ms / 2))
-                # skip sampling until wait_time_ms decays to 0
-                continue
-
-            # 5) wait_time_ms has decayed to zero → do a sample step
-            try:
-                inputs = next(epoch_iterator)
-                self.sample_step(inputs, unwrapped_model)
-            except StopIteration:
-                # iterator is exhausted
-                continue
-                
-        if waiting_for_ack:
-            self.ack.recv()
-
-        return current_batch
+        return self.batch_gatherer.gather(epoch_iterator, num_batches, lambda inputs: self.sample_step(inputs, unwrapped_model))
 
     def _iter_data_sampling(self, epoch_iterator, num_batches):
         # important: at this point:
@@ -499,13 +491,17 @@ class AsyncRLGRPOTrainer(Trainer):
     
     
             if self.beta > 0 and not self.control.should_evaluate:
-                self.ref_model = self.ref_model.to(device=self.accelerator.device)
+                if self.ref_model is not None:
+                    self.ref_model = self.ref_model.to(device=self.accelerator.device)
                 for data in batch_samples:
+                    if "ref_per_token_logps" in data:
+                        # precomputed by the reference logprob service of the local balancer
+                        continue
                     if self.ref_model is not None:
-                        ref_per_token_logps = self._get_per_token_logps(self.ref_model, data["prompt_inputs"])
+                        ref_per_token_logps = self._get_per_token_logps(self.ref_model, data["prompt_inputs"], data["completion_mask"].size(1))
                     else:
                         with self.accelerator.unwrap_model(self.model_wrapped).disable_adapter() as unwrapped_model:
-                            ref_per_token_logps = self._get_per_token_logps(unwrapped_model, data["prompt_inputs"])
+                            ref_per_token_logps = self._get_per_token_logps(unwrapped_model, data["prompt_inputs"], data["completion_mask"].size(1))
                     
                     data["ref_per_token_logps"] = ref_per_token_logps.detach().cpu()
                 
@@ -519,13 +515,16 @@ class AsyncRLGRPOTrainer(Trainer):
     def prepare_generation(self, model_wrapped, clear_device: bool = None, update_inference_model: bool = True):
         clear_device = clear_device if clear_device is not None else self.clear_device
         if clear_device:
-            self.inference_model.cpu()
+            if not self.resident_inference_model:
+                self.inference_model.cpu()
             clear_device_cache(True)
         device = self.accelerator.device
 
         if self.accelerator.distributed_type == DistributedType.DEEPSPEED:
             
             with unwrap_model_for_generation(model_wrapped, self.accelerator, gather_deepspeed3_params=self.ds3_gather_for_generation) as unwrapped_model:
+                # generates with the live trained weights
+                self.inference_version = self.state.global_step
                 if self.gradient_checkpointing:
                     unwrapped_model = self._disable_gradient_checkpointing(unwrapped_model, self.args)
                 
@@ -538,21 +537,26 @@ class AsyncRLGRPOTrainer(Trainer):
         elif self.accelerator.distributed_type == DistributedType.FSDP:
             if self.accelerator.is_fsdp2:
                 
-                if update_inference_model:
-                    state_dict = model_wrapped.state_dict()
-                    class wrappeddict(dict):
-                        def __getitem__(self, key):
-                            d = super().__getitem__(key)
-                            if isinstance(d,torch.distributed.tensor.DTensor):
-                                return d.to(device=device).full_tensor().detach().to(dtype=torch.bfloat16,device=device)
-                            else:
-                                return d
+                class wrappeddict(dict):
+                    def __getitem__(self, key):
+                        d = super().__getitem__(key)
+                        if isinstance(d,torch.distributed.tensor.DTensor):
+                            return d.to(device=device).full_tensor().detach().to(dtype=torch.bfloat16,device=device)
+                        else:
+                            return d
                 
-                    state_dict = wrappeddict(state_dict)
+                if update_inference_model and self.weight_sync is None:
+                    state_dict = wrappeddict(model_wrapped.state_dict())
                     self.inference_model.load_state_dict(state_dict,strict=True)
+                    self.inference_version = self.state.global_step
                     if self.update_ref_model:
                         self.ref_model.load_state_dict(state_dict,strict=True)
                         self.update_ref_model = False
+                elif update_inference_model:
+                    self._sync_inference_model(model_wrapped)
+                    if self.update_ref_model:
+                        self.ref_model.load_state_dict(wrappeddict(model_wrapped.state_dict()),strict=True)
+                        self.update_ref_model = False
                         
                 self.inference_model.eval()
                 
@@ -560,12 +564,15 @@ class AsyncRLGRPOTrainer(Trainer):
                 
                 
             else:
-                if update_inference_model:
+                if update_inference_model and self.weight_sync is not None:
+                    self._sync_inference_model(model_wrapped)
+                elif update_inference_model:
                     cfg = FullStateDictConfig(offload_to_cpu=False, rank0_only=False)
                     with FSDP.state_dict_type(model_wrapped, StateDictType.FULL_STATE_DICT, cfg):
                         full_state = model_wrapped.state_dict()
                 
                     self.inference_model.load_state_dict(full_state,strict=True)
+                    self.inference_version = self.state.global_step
                     del full_state
 
                 yield self.inference_model.to(device=device)
@@ -574,9 +581,22 @@ class AsyncRLGRPOTrainer(Trainer):
             raise NotImplementedError(f"Unsupported distributed_type {self.accelerator.distributed_type}")
         
         if clear_device:
-            self.inference_model.cpu()
+            if not self.resident_inference_model:
+                self.inference_model.cpu()
             clear_device_cache(True)
 
+    def _sync_inference_model(self, model_wrapped):
+        """Stream the trained weights into the device-resident inference model every `weight_sync_steps` steps."""
+        if not self.weight_sync.should_sync(self.state.global_step):
+            return
+        self.inference_model.to(device=self.accelerator.device)
+        self.weight_sync.sync(model_wrapped, self.state.global_step)
+        self.inference_version = self.state.global_step
+        logger.debug(
+            f"Worker {self.rank} synced {self.weight_sync.last_sync_bytes / 2**30:.2f} GB of weights "
+            f"in {self.weight_sync.last_sync_time:.2f}s"
+        )
+
     def get_batch_samples(self, epoch_iterator, num_batches):
         # TODO: Support num_items_in_batch
         gen = self._iter_data_sampling(epoch_iterator, num_batches)
@@ -607,8 +627,12 @@ class AsyncRLGRPOTrainer(Trainer):
         prompt_inputs.pop('image_sizes',None)
         
         logger.debug(f"Worker {self.rank} Start Sampling {len(inputs)} Tasks.")
+        # the inference model holds the weights after `inference_version` optimizer steps
+        policy_version = self.inference_version
+        record_behavior_logps = self.record_behavior_logps and not self.control.should_evaluate
+        logps_recorder = SampledLogpsRecorder() if record_behavior_logps else None
         # Start Generation
-        completion_ids = model.generate(
+        generation_kwargs = dict(
             **prompt_inputs,
             tokenizer=self.processing_class.tokenizer,
             do_sample = True,
@@ -616,13 +640,47 @@ class AsyncRLGRPOTrainer(Trainer):
             repetition_penalty = 1.05,
             max_new_tokens = self.max_completion_length,
             use_cache=True,
-            synced_gpus=False if self.ds3_gather_for_generation else True
+            synced_gpus=False if self.ds3_gather_for_generation else True,
         )
+        if logps_recorder is not None:
+            # record the sampled tokens under the logits before the repetition penalty, as the training forward sees them
+            generation_kwargs["repetition_penalty"] = 1.0
+            generation_kwargs["logits_processor"] = LogitsProcessorList([logps_recorder, RepetitionPenaltyLogitsProcessor(1.05)])
+        if self.args.cache_implementation is not None:
+            generation_kwargs["cache_implementation"] = self.args.cache_implementation
+        vision_hidden_states = None
+        if self.cache_vision_embeddings and not self.control.should_evaluate and hasattr(model, "get_vllm_embedding"):
+            # encode the images once, generation and the training forwards of the completions reuse the outputs
+            _, vision_hidden_states = model.get_vllm_embedding(prompt_inputs)
+            generation_kwargs["vision_hidden_states"] = vision_hidden_states
+            # prompts without images have an empty list
+            vision_hidden_states = [v.cpu() if isinstance(v, torch.Tensor) else v for v in vision_hidden_states]
+        compiled_kwargs = {}
+        if self.compiled_decoding is not None and model is self.inference_model:
+            compiled_kwargs = self.compiled_decoding.generation_kwargs(prompt_inputs["input_ids"].size(0))
+        generate_start = time.time()
+        try:
+            completion_ids = model.generate(**generation_kwargs, **compiled_kwargs)
+        except Exception as e:
+            if not compiled_kwargs:
+                raise
+            # shapes or ops the compiler can not handle, fall back to eager decoding
+            self.compiled_decoding.disable(e)
+            if logps_recorder is not None:
+                logps_recorder.reset()
+            completion_ids = model.generate(**generation_kwargs)
+        tracer.complete("generate", generate_start, tasks=[inp["id"] for inp in inputs])
         
         logger.debug(f"Worker {self.rank} Sampling {len(inputs)} Tasks for time: {datetime.datetime.now() - s_time}")
         
         if isinstance(completion_ids, tuple):
-            completion_ids = completion_ids[1].sequences
+            completion_ids = completion_ids[1]
+        behavior_logps = None
+        if logps_recorder is not None:
+            # logprobs of the sampled tokens under the unprocessed logits of the sampling policy
+            behavior_logps = logps_recorder.finish(completion_ids if isinstance(completion_ids, torch.Tensor) else completion_ids.sequences).cpu()
+        if not isinstance(completion_ids, torch.Tensor):
+            completion_ids = completion_ids.sequences
 
         # Decode the generated completions
         completions = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True)
@@ -630,17 +688,36 @@ class AsyncRLGRPOTrainer(Trainer):
             completions = [[{"role": "assistant", "content": completion}] for completion in completions]
         
         # Compute the rewards
+        rewards_start = time.time()
         rewards_per_func = torch.zeros(len(inputs), len(self.reward_funcs), device=device)
         # print(rewards_per_func.shape)
         prompts = [inp["prompt"] for inp in inputs]
-        for i, reward_func in enumerate(self.reward_funcs):
-            reward_kwargs = {key: [] for key in inputs[0].keys() if key not in ["prompt", "completion"]}
-            for key in reward_kwargs:
-                for item in inputs:
-                    reward_kwargs[key].append(item[key])
-            output_reward_func = reward_func(prompts=prompts, completions=completions, **reward_kwargs)
-            rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+        reward_kwargs = {key: [] for key in inputs[0].keys() if key not in ["prompt", "completion"]}
+        for key in reward_kwargs:
+            for item in inputs:
+                reward_kwargs[key].append(item[key])
+        mode = "eval" if self.control.should_evaluate else "train"
+        if self.reward_engine is not None:
+            output_reward_funcs = self.reward_engine(prompts=prompts, completions=completions, **reward_kwargs)
+            rewards_per_func[:] = torch.from_numpy(output_reward_funcs).to(dtype=torch.float32, device=device)
+            for key, value in self.reward_engine.stats.items():
+                self._metrics[mode][key].append(value)
+        else:
+            reward_start = time.perf_counter()
+            for i, reward_func in enumerate(self.reward_funcs):
+                func_start = time.perf_counter()
+                output_reward_func = reward_func(prompts=prompts, completions=completions, **reward_kwargs)
+                rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+                self._metrics[mode][f"rewards/latency/{reward_func.__name__}"].append(time.perf_counter() - func_start)
+                reward_name = getattr(reward_func, "reward_name", None)
+                if reward_name is not None:
+                    # built-in rewards mixed with custom ones run on their shared per-component engine
+                    stats = component_engine(reward_name).stats
+                    self._metrics[mode][f"rewards/memo_hit_rate/{reward_name}"].append(stats["rewards/memo_hit_rate"])
+                    self._metrics[mode][f"rewards/timeouts/{reward_name}"].append(stats["rewards/timeouts"])
+            self._metrics[mode]["rewards/latency"].append(time.perf_counter() - reward_start)
         rewards = rewards_per_func.mean(dim=1)
+        tracer.complete("rewards", rewards_start)
         
         # Log the metrics
         # mode = "eval" if self.control.should_evaluate else "train"
@@ -666,13 +743,24 @@ class AsyncRLGRPOTrainer(Trainer):
         
         rewards = rewards.cpu()
         # process and send them to local balance
+        send_start = time.time()
+        completion_uuids = []
         for idx,item in enumerate(inputs):
+            prompt_key = _prompt_key(item["id"], item["prompt"])
+            prompt = item["prompt"]
+            if vision_hidden_states is not None:
+                # the local balancer keeps them in place of the pixel values, see `_prepare_prompt`
+                prompt = {"messages": prompt, "vision_hidden_states": vision_hidden_states[idx]}
             tac = TaskAndContent(
                 data={
                     **item,
+                    "prompt": prompt,
+                    "prompt_key": prompt_key,
                     "completion": completions[idx][0]['content'],
                     "completion_ids": completion_ids[idx].cpu(),
                     "reward": rewards[idx].item(),
+                    "policy_version": policy_version,
+                    **({"behavior_logps": behavior_logps[idx]} if behavior_logps is not None else {}),
                 },
                 status=TaskStatus(
                     task_id=item["id"],
@@ -680,44 +768,62 @@ class AsyncRLGRPOTrainer(Trainer):
                     score=rewards[idx].item()
                 )
             )
+            completion_uuids.append(tac.status.completion_id.hex)
+            if prompt_key in self.sent_prompt_keys:
+                # the local balancer interns prompts by key, send it only once per group
+                tac.data.pop("prompt")
             # with Timer("Sending Completions"):
             # send it
             self.balance_send.send_pyobj(tac)
-            _ = self.balance_send.recv_string()
+            if self.balance_send.recv_string() == "PROMPT_MISSING":
+                tac.data["prompt"] = prompt
+                self.balance_send.send_pyobj(tac)
+                self.balance_send.recv_string()
+            
+            self.sent_prompt_keys[prompt_key] = None
+            self.sent_prompt_keys.move_to_end(prompt_key)
+            if len(self.sent_prompt_keys) > self.max_sent_prompt_keys:
+                self.sent_prompt_keys.popitem(last=False)
+        tracer.complete("send", send_start)
+        tracer.instant("completions", uuids=completion_uuids, tasks=[inp["id"] for inp in inputs])
         del prompt_inputs,inputs
 
-    def _get_per_token_logps(self, model, inputs):
-        
-        attention_mask = inputs["attention_mask"]
-        position_ids = attention_mask.long().cumsum(-1) - 1
-        position_ids.masked_fill_(attention_mask == 0, 1)
-        inputs = self._prepare_inputs({
-            "input_ids": inputs["input_ids"],
-            "image_bound": inputs["image_bound"],
-            "tgt_sizes": inputs["tgt_sizes"],
-            "pixel_values": inputs["pixel_values"],
-            "attention_mask": attention_mask,
-            "position_ids": position_ids,
-        })
-
-        logits = model(data=inputs, use_cache=False).logits
-        
-        # if self.accelerator.is_main_process:
-        #     import pdb; pdb.set_trace()
-        # self.accelerator.wait_for_everyone()
-        
-        # assert not torch.any(torch.isnan(logits)), "{}".format(torch.isnan(logits).sum())
-        
-        logits = logits[:, :-1, :]
-        input_ids = inputs["input_ids"][:, 1:]
-        per_token_logps = []
-        for logits_row, input_ids_row in zip(logits, input_ids):
-            log_probs = logits_row.log_softmax(dim=-1)
-            token_log_prob = torch.gather(log_probs, dim=1, index=input_ids_row.unsqueeze(1)).squeeze(1)
-            per_token_logps.append(token_log_prob)
-        del inputs
-        return torch.stack(per_token_logps)
+    def _get_per_token_logps(self, model, inputs, logits_to_keep):
+        """Log-probabilities of the last `logits_to_keep` tokens (the completion) of `input_ids`.
+
+        Only the completion positions are projected by the `lm_head`, in chunks, so the full `[B, L, V]` logits
+        are never materialized.
+        """
+        per_token_logps = compute_per_token_logps(
+            model, inputs, logits_to_keep, chunk_size=self.logprob_chunk_size, prepare_inputs=self._prepare_inputs,
+            pack=self.pack_sequences and self.pack_sequences_checked
+        )
+        # assert not torch.any(torch.isnan(per_token_logps)), "{}".format(torch.isnan(per_token_logps).sum())
+        return per_token_logps
 
+    @torch.no_grad()
+    def _check_packed_logps(self, model, inputs, logits_to_keep, tolerance=0.05):
+        """Whether packed logprobs match the padded ones, i.e. the model keeps the packed samples apart.
+
+        Runs on all ranks, packing is disabled everywhere if any rank sees a mismatch.
+        """
+        packed = compute_per_token_logps(
+            model, inputs, logits_to_keep, chunk_size=self.logprob_chunk_size, prepare_inputs=self._prepare_inputs, pack=True
+        )
+        padded = compute_per_token_logps(
+            model, inputs, logits_to_keep, chunk_size=self.logprob_chunk_size, prepare_inputs=self._prepare_inputs, pack=False
+        )
+        mask = inputs["attention_mask"][:, -logits_to_keep:].to(padded.device).bool()
+        error = (packed.float() - padded.float()).abs()[mask].mean() if mask.any() else padded.new_zeros(())
+        error = error.float().reshape(1)
+        if dist.is_initialized():
+            dist.all_reduce(error, op=dist.ReduceOp.MAX)
+        if error.item() > tolerance:
+            logger.warning(f"Packed logprobs differ from the padded ones by {error.item():.4f} on average, the model does "
+                           "not separate packed sequences, disable `pack_sequences`.")
+            return False
+        logger.info(f"Packed logprobs match the padded ones ({error.item():.4f} mean absolute difference).")
+        return True
     
     def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
         if return_outputs:
@@ -728,6 +834,9 @@ class AsyncRLGRPOTrainer(Trainer):
         prompt_len = inputs["prompt_len"]
         advantages = inputs["advantages"]
         completion_mask = inputs["completion_mask"]
+        if mode == "train" and "completion_uuids" in inputs:
+            # end of the journey of the completions, see `analyze_trace.py`
+            tracer.instant("loss", uuids=inputs["completion_uuids"])
         step_ids = inputs.get("step_ids",torch.zeros((1,1),device=self.accelerator.device))
         
         log_dict = {
@@ -738,11 +847,35 @@ class AsyncRLGRPOTrainer(Trainer):
             "advantages": advantages.to(dtype=torch.float)
         }
         
-        per_token_logps = self._get_per_token_logps(model, prompt_inputs)
-        # Get rid of the prompt (-1 because of the shift done in get_per_token_logps)
-        per_token_logps = per_token_logps[:, prompt_len - 1:]
-
-        old_per_token_logps = per_token_logps.detach()
+        if self.pack_sequences and not self.pack_sequences_checked:
+            # collective, the ranks reach the first loss together unlike the reference forwards of the sampling
+            self.pack_sequences = self._check_packed_logps(model, prompt_inputs, completion_mask.size(1))
+            self.pack_sequences_checked = True
+
+        # Only the completion positions are projected
+        per_token_logps = self._get_per_token_logps(model, prompt_inputs, completion_mask.size(1))
+
+        if "old_per_token_logps" in inputs:
+            # logprobs recorded by the sampling policy, the ratio corrects for completions generated by stale weights
+            old_per_token_logps = inputs["old_per_token_logps"].to(per_token_logps.dtype)
+            if self.pack_sequences:
+                # padded positions of packed logprobs are zero, keep their ratio at 1
+                old_per_token_logps = old_per_token_logps.masked_fill(completion_mask == 0, 0.0)
+        else:
+            old_per_token_logps = per_token_logps.detach()
+        
+        # Per-sample loss weights according to the staleness of the completions
+        sample_weights = torch.ones_like(advantages, dtype=torch.float)
+        if "policy_versions" in inputs and not self.control.should_evaluate:
+            staleness = (self.state.global_step - inputs["policy_versions"]).to(torch.float)
+            log_dict["staleness"] = staleness
+            if self.max_staleness is not None:
+                is_stale = staleness > self.max_staleness
+                if self.staleness_policy == "drop":
+                    sample_weights = sample_weights.masked_fill(is_stale, 0.0)
+                else:
+                    sample_weights = torch.where(is_stale, (self.max_staleness + 1) / (staleness + 1), sample_weights)
+                log_dict["staleness/stale_ratio"] = is_stale.to(torch.float)
         
         # Compute the policy ratio and clipped version
         coef_1 = torch.exp(per_token_logps - old_per_token_logps)
@@ -754,7 +887,7 @@ class AsyncRLGRPOTrainer(Trainer):
         # Add KL penalty if beta > 0, skip kl calculation during evaluation (it has no function)
         if self.beta > 0 and not self.control.should_evaluate:
             ref_per_token_logps = inputs["ref_per_token_logps"]
-            ref_per_token_logps = ref_per_token_logps[:, prompt_len - 1:].detach()
+            ref_per_token_logps = ref_per_token_logps.detach().to(per_token_logps.dtype)
 
             per_token_kl = torch.exp(ref_per_token_logps - per_token_logps) - (ref_per_token_logps - per_token_logps) - 1
             per_token_loss = per_token_loss + self.beta * per_token_kl
@@ -765,12 +898,15 @@ class AsyncRLGRPOTrainer(Trainer):
             # self._metrics[mode]["kl"].append(self.accelerator.gather_for_metrics(mean_kl).mean().item())
 
         # Compute final loss
-        loss = ((per_token_loss * completion_mask).sum(dim=1) / completion_mask.sum(dim=1)).mean()
+        per_sample_loss = (per_token_loss * completion_mask).sum(dim=1) / completion_mask.sum(dim=1)
+        loss = (per_sample_loss * sample_weights).sum() / (sample_weights > 0).sum().clamp(min=1)
 
         # Log clip ratio
         is_clipped = (per_token_loss1 < per_token_loss2).float()
         clip_ratio = (is_clipped * completion_mask).sum() / completion_mask.sum()
         log_dict["clip_ratio"] = clip_ratio
+        if "old_per_token_logps" in inputs:
+            log_dict["importance_ratio"] = (coef_1.detach() * completion_mask).sum(dim=1) / completion_mask.sum(dim=1)
         log_dict = self.accelerator.gather_for_metrics(log_dict)
         for k in log_dict.keys():
             self._metrics[mode][k].append(log_dict[k].mean().item())
@@ -858,6 +994,9 @@ class AsyncRLGRPOTrainer(Trainer):
             dataset=train_dataset,
             global_sync_address=self.global_data_dispatch_address,
             world_size=self.accelerator.num_processes,
+            bucket_window=self.args.dispatch_bucket_window,
+            completion_ttl=self.args.multiturn_completion_ttl,
+            completion_spill_dir=self.args.multiturn_completion_spill_dir,
             **dataloader_params
         )
         
@@ -935,7 +1074,7 @@ class AsyncRLGRPOTrainer(Trainer):
         """
         if self.ref_model is not None:
             self.ref_model.cpu()
-        if self.inference_model is not None:
+        if self.inference_model is not None and not self.resident_inference_model:
             self.inference_model.cpu()
         clear_device_cache(True)
         if output_dir is None:
@@ -0,0 +1,307 @@
+import zmq
+import time
+import uuid
+import pickle
+import threading
+from dataclasses import dataclass, asdict
+from collections import defaultdict, OrderedDict
+from typing import Any, Optional
+
+from .utils import logger
+
+
+@dataclass
+class PeerStats:
+    """与单个节点之间的窃取统计"""
+    steals: int = 0
+    chunks: int = 0
+    bytes: int = 0
+    empty: int = 0
+    failures: int = 0
+    bandwidth: Optional[float] = None  # 字节/秒，指数滑动平均
+    latency: Optional[float] = None  # 空响应的往返时间（秒），指数滑动平均
+    cooldown_until: float = 0.0
+
+
+@dataclass
+class StealStatsReport:
+    """节点窃取统计，由本地平衡器定期上报给全局"""
+    addr: str
+    stolen: dict
+    served: dict
+
+
+@dataclass
+class StealAck:
+    """窃取方确认收到数据块，被窃取方收到确认后才释放这些数据块。
+
+    同一 steal_id 的确认可以重试，被窃取方对每个 steal_id 始终给出相同的答复。
+    """
+    steal_id: str
+
+
+class PeerLink:
+    """到其他节点的持久REQ连接，请求超时后重建套接字"""
+
+    def __init__(self, zmqctx: zmq.Context, addr: str, timeout_ms: int):
+        self.zmqctx = zmqctx
+        self.addr = addr
+        self.timeout_ms = timeout_ms
+        self.socket = None
+        self._connect()
+
+    def _connect(self):
+        self.socket = self.zmqctx.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVTIMEO, self.timeout_ms)
+        self.socket.setsockopt(zmq.SNDTIMEO, self.timeout_ms)
+        self.socket.connect(self.addr)
+
+    def request(self, obj: Any) -> Optional[bytes]:
+        """发送请求并返回原始响应，超时返回None"""
+        try:
+            self.socket.send_pyobj(obj)
+            return self.socket.recv()
+        except zmq.Again:
+            # REQ套接字在超时后无法继续使用，重建连接
+            self.close()
+            self._connect()
+            return None
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class WorkStealer:
+    """基于队列深度与传输带宽选择窃取目标的工作窃取器。
+
+    窃取阈值随全局平均队列长度和本地消耗速率自适应：当本地队列低于平均值的一定比例，
+    或预计在下一次窃取完成前耗尽时才会窃取。目标节点按预计的数据块获取速率（块/秒）选择，
+    该速率由测得的带宽和往返延迟估计。
+
+    Args:
+        zmqctx: ZMQ上下文
+        local_addr: 本节点的窃取地址
+        min_threshold: 最小窃取阈值（数据块）
+        relative_threshold: 相对平均队列长度的窃取阈值
+        horizon: 低水位线的预测时长（秒）
+        check_interval: 两次队列广播之间的检查间隔（秒）
+        timeout_ms: 窃取请求超时（毫秒）
+        cooldown: 空响应或超时后对该节点的冷却时间（秒）
+        ewma: 滑动平均系数
+        hold_timeout: 被窃取方保留已发送数据块等待确认的时间（秒），默认为两倍请求超时
+        ack_attempts: 窃取方发送确认的最大尝试次数，均无响应时丢弃窃取的数据块
+        default_bandwidth: 未测量节点的默认带宽（字节/秒）
+        default_chunk_bytes: 未测量时默认的数据块大小（字节）
+    """
+
+    def __init__(
+        self,
+        zmqctx: zmq.Context,
+        local_addr: str,
+        min_threshold: int = 1,
+        relative_threshold: float = 0.25,
+        horizon: float = 3.0,
+        check_interval: float = 0.5,
+        timeout_ms: int = 10000,
+        cooldown: float = 3.0,
+        ewma: float = 0.3,
+        hold_timeout: Optional[float] = None,
+        ack_attempts: int = 5,
+        default_bandwidth: float = 1e8,
+        default_chunk_bytes: int = 8 * 2**20,
+    ):
+        self.zmqctx = zmqctx
+        self.local_addr = local_addr
+        self.min_threshold = min_threshold
+        self.relative_threshold = relative_threshold
+        self.horizon = horizon
+        self.check_interval = check_interval
+        self.timeout_ms = timeout_ms
+        self.cooldown = cooldown
+        self.ewma = ewma
+        self.hold_timeout = hold_timeout if hold_timeout is not None else 2 * timeout_ms / 1000
+        self.ack_attempts = ack_attempts
+        # 已答复的 steal_id 保留到窃取方不会再重试确认为止
+        self.decision_ttl = self.hold_timeout + (ack_attempts + 1) * timeout_ms / 1000
+        self.default_bandwidth = default_bandwidth
+        self.chunk_bytes = default_chunk_bytes
+
+        self.links: dict[str, PeerLink] = {}
+        self.stolen = defaultdict(PeerStats)
+        self.served = defaultdict(lambda: {"chunks": 0, "bytes": 0, "expired": 0})
+        # 已发送但未确认的数据块: steal_id -> (窃取方, 数据块, 字节数, 截止时间)
+        self.held = {}
+        # 已确认或已归还的窃取: steal_id -> (答复, 时间)，保证重试的确认得到相同答复
+        self.decided = OrderedDict()
+        self.lock = threading.Lock()
+
+        # 本地消耗速率（块/秒）
+        self.consume_rate = 0.0
+        self._consumed = 0
+        self._consume_tick = time.monotonic()
+
+    def _smooth(self, old: Optional[float], new: float) -> float:
+        return new if old is None else (1 - self.ewma) * old + self.ewma * new
+
+    def record_consumed(self, n: int = 1):
+        """记录本地被训练进程取走的数据块"""
+        with self.lock:
+            self._consumed += n
+
+    def hold(self, steal_id: str, thief: Optional[str], chunk_datas: list, nbytes: int):
+        """保留已发送给窃取方的数据块，直到收到确认"""
+        self.held[steal_id] = (thief, chunk_datas, nbytes, time.monotonic() + self.hold_timeout)
+
+    def _decide(self, steal_id: str, confirmed: bool):
+        now = time.monotonic()
+        self.decided[steal_id] = (confirmed, now)
+        while self.decided and next(iter(self.decided.values()))[1] < now - self.decision_ttl:
+            self.decided.popitem(last=False)
+
+    def confirm(self, steal_id: str) -> bool:
+        """处理窃取方的确认，数据块已因超时归还时返回False，窃取方应丢弃这些数据块；重复的确认返回相同答复"""
+        if steal_id in self.decided:
+            return self.decided[steal_id][0]
+        held = self.held.pop(steal_id, None)
+        if held is None:
+            return False
+        thief, chunk_datas, nbytes, _ = held
+        with self.lock:
+            self.served[thief]["chunks"] += len(chunk_datas)
+            self.served[thief]["bytes"] += nbytes
+        self._decide(steal_id, True)
+        return True
+
+    def expired(self) -> list:
+        """返回超时未确认的数据块，由被窃取方放回本地队列"""
+        now = time.monotonic()
+        returned = []
+        for steal_id in [steal_id for steal_id, held in self.held.items() if held[3] < now]:
+            thief, chunk_datas, _, _ = self.held.pop(steal_id)
+            self._decide(steal_id, False)
+            returned.extend(chunk_datas)
+            with self.lock:
+                self.served[thief]["expired"] += len(chunk_datas)
+            logger.warning(f"Steal of {len(chunk_datas)} chunks by {thief} was not confirmed, requeue them.")
+        return returned
+
+    def _update_consume_rate(self):
+        now = time.monotonic()
+        with self.lock:
+            elapsed = now - self._consume_tick
+            if elapsed < self.check_interval:
+                return
+            self.consume_rate = self._smooth(self.consume_rate, self._consumed / elapsed)
+            self._consumed = 0
+            self._consume_tick = now
+
+    def _prior_bandwidth(self) -> float:
+        measured = sorted(st.bandwidth for st in self.stolen.values() if st.bandwidth is not None)
+        if not measured:
+            return self.default_bandwidth
+        # 对未测量的节点使用中位数，保证会被探索
+        return measured[len(measured) // 2]
+
+    def plan(self, queue_lengths: dict, current_q: int) -> Optional[tuple[str, int]]:
+        """根据已知的队列长度决定是否窃取，返回 (目标地址, 数量) 或 None"""
+        self._update_consume_rate()
+        peers = {addr: qlen for addr, qlen in queue_lengths.items() if addr != self.local_addr}
+        if not peers:
+            return None
+
+        mean_queue_length = (sum(peers.values()) + current_q) / (len(peers) + 1)
+        starving = mean_queue_length - current_q
+        low_watermark = self.consume_rate * self.horizon
+        threshold = max(self.min_threshold, self.relative_threshold * mean_queue_length)
+        if not (starving > threshold or (current_q < low_watermark and starving > 0)):
+            return None
+        need = max(starving / 2, low_watermark - current_q)
+
+        now = time.monotonic()
+        best = None
+        for addr, qlen in peers.items():
+            st = self.stolen[addr]
+            if st.cooldown_until > now:
+                continue
+            nums_to_steal = int(min(need, (qlen - mean_queue_length) / 2))
+            if nums_to_steal < 1:
+                continue
+            bandwidth = st.bandwidth if st.bandwidth is not None else self._prior_bandwidth()
+            cost = (st.latency or 0.0) + nums_to_steal * self.chunk_bytes / bandwidth
+            rate = nums_to_steal / max(cost, 1e-6)
+            if best is None or rate > best[0]:
+                best = (rate, addr, nums_to_steal)
+
+        if best is None:
+            return None
+        return best[1], best[2]
+
+    def steal(self, addr: str, nums_to_steal: int) -> list:
+        """从目标节点窃取数据块并更新带宽估计"""
+        link = self.links.get(addr, None)
+        if link is None:
+            link = self.links[addr] = PeerLink(self.zmqctx, addr, self.timeout_ms)
+
+        steal_id = uuid.uuid4().hex
+        start = time.monotonic()
+        data = link.request((self.local_addr, nums_to_steal, steal_id))
+        elapsed = max(time.monotonic() - start, 1e-6)
+
+        st = self.stolen[addr]
+        if data is None:
+            st.failures += 1
+            st.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(f"Steal from {addr} timeout.")
+            return []
+
+        stolen = pickle.loads(data)
+        if not stolen:
+            st.empty += 1
+            st.latency = self._smooth(st.latency, elapsed)
+            st.cooldown_until = time.monotonic() + self.cooldown
+            return []
+
+        # 确认收到，被窃取方在确认前保留数据块，超时未确认时放回其队列。
+        # 确认可能在重建套接字时丢失，用同一 steal_id 重试直到得到答复
+        confirmed = None
+        for _ in range(self.ack_attempts):
+            confirmed = link.request(StealAck(steal_id))
+            if confirmed is not None:
+                break
+        if confirmed is None or not pickle.loads(confirmed):
+            # 被窃取方已将数据块放回队列或无法确认，丢弃以免重复训练
+            st.failures += 1
+            st.cooldown_until = time.monotonic() + self.cooldown
+            reason = "expired before confirmation" if confirmed is not None else "could not be confirmed"
+            logger.warning(f"Steal from {addr} {reason}, drop {len(stolen)} chunks.")
+            return []
+
+        st.steals += 1
+        st.chunks += len(stolen)
+        st.bytes += len(data)
+        st.bandwidth = self._smooth(st.bandwidth, len(data) / elapsed)
+        self.chunk_bytes = self._smooth(self.chunk_bytes, len(data) / len(stolen))
+        logger.debug(f"Stole {len(stolen)} chunks ({len(data) / 2**20:.1f} MB) from {addr} in {elapsed:.2f}s.")
+        return stolen
+
+    def report(self) -> StealStatsReport:
+        with self.lock:
+            return StealStatsReport(
+                addr=self.local_addr,
+                stolen={addr: asdict(st) for addr, st in list(self.stolen.items())},
+                served={str(thief): dict(st) for thief, st in list(self.served.items())},
+            )
+
+    def summary(self) -> str:
+        report = self.report()
+        stolen_chunks = sum(st["chunks"] for st in report.stolen.values())
+        stolen_bytes = sum(st["bytes"] for st in report.stolen.values())
+        served_chunks = sum(st["chunks"] for st in report.served.values())
+        served_bytes = sum(st["bytes"] for st in report.served.values())
+        expired = sum(st["expired"] for st in report.served.values())
+        return (f"stole {stolen_chunks} chunks ({stolen_bytes / 2**20:.1f} MB), "
+                f"served {served_chunks} chunks ({served_bytes / 2**20:.1f} MB, {expired} requeued unconfirmed), "
+                f"consume {self.consume_rate:.2f} chunks/s")
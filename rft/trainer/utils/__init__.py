@@ -1,14 +1,24 @@
-from .gui_eval import action_schema_check, action_args_check, action_type_check,react_check
-from .process import _prepare_messages,_process_inputs,_create_inputs
+from .gui_eval import action_schema_check, action_args_check, action_type_check,react_check,RewardEngine,component_engine
+from .process import _prepare_messages,_process_inputs,_create_inputs,_prompt_key,_prepare_prompt,_collate_prompts
 from .dataloader import GlobalDistributed0MQDataLoader
-from .dataset import GUIRFTDataset,GUIMTRFTDataset
+from .cache import CompletionCache,PromptStore,CompletionStore
+from .weight_sync import WeightSyncEngine
+from .generation import CompiledDecoding,reserve_on_device
+from .logps import selective_logps,selective_log_softmax,compute_per_token_logps,SampledLogpsRecorder
+from .shm import SharedChunk,sweep_stale_chunks
+from .trace import tracer,Tracer
+from .dataset import GUIRFTDataset,GUIMTRFTDataset,JsonlRecords,ImageCache
 from .dataloader import GlobalDistributed0MQDataLoader
 
 __all__ = [
-    "GUIRFTDataset","GUIMTRFTDataset",
-    "action_schema_check","action_args_check","action_type_check","react_check",
-    "_prepare_messages","_process_inputs","_create_inputs",
+    "GUIRFTDataset","GUIMTRFTDataset","JsonlRecords","ImageCache",
+    "action_schema_check","action_args_check","action_type_check","react_check","RewardEngine","component_engine",
+    "_prepare_messages","_process_inputs","_create_inputs","_prompt_key","_prepare_prompt","_collate_prompts",
     "GlobalDistributed0MQDataLoader",
+    "CompletionCache","PromptStore","CompletionStore",
+    "WeightSyncEngine","CompiledDecoding","reserve_on_device",
+    "selective_logps","selective_log_softmax","compute_per_token_logps","SampledLogpsRecorder",
+    "SharedChunk","sweep_stale_chunks","tracer","Tracer",
     "no_sync","Timer","logger"
     ]
 
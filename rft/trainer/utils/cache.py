@@ -0,0 +1,535 @@
+import os
+import sys
+import mmap
+import time
+import pickle
+import tempfile
+import threading
+import dataclasses
+from concurrent.futures import Future
+from collections import OrderedDict, deque
+from typing import Any, Callable, Hashable, Optional
+
+import torch
+from PIL import Image
+
+
+def estimate_nbytes(obj: Any) -> int:
+    '''Roughly estimate the host memory held by a (nested) payload.'''
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, Image.Image):
+        return obj.width * obj.height * len(obj.getbands())
+    if isinstance(obj, (str, bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sum(estimate_nbytes(v) for v in obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return sum(estimate_nbytes(getattr(obj, f.name)) for f in dataclasses.fields(obj))
+    return sys.getsizeof(obj)
+
+
+class _SpillSegment:
+    def __init__(self, spill_dir: str, prefix: str):
+        fd, self.path = tempfile.mkstemp(prefix=prefix, dir=spill_dir)
+        self.file = os.fdopen(fd, "w+b")
+        self.size = 0
+        self.live = 0
+        self.mmap = None
+
+    def unmap(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def close(self):
+        self.unmap()
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SpillFile:
+    '''Append-only segment files of pickled records which are read back through `mmap`.
+
+    Records are appended to the current segment until it passes `segment_bytes`, then a new segment is
+    started. A segment is removed once every record written into it has been released, so a straggler only
+    pins its own segment and the spill does not grow without bound on long runs. Records are addressed by
+    `(segment, offset, length)`.
+    '''
+    def __init__(self, spill_dir: str, prefix: str = "arl_spill_", segment_bytes: int = 256 * 2**20):
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = spill_dir
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.segments: dict[int, _SpillSegment] = {}
+        self.current = -1
+        self.lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        '''Bytes on disk over all segments.'''
+        with self.lock:
+            return sum(segment.size for segment in self.segments.values())
+
+    def write(self, obj: Any) -> tuple[int, int, int]:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            segment = self.segments.get(self.current, None)
+            if segment is None or segment.size >= self.segment_bytes:
+                self.current += 1
+                segment = self.segments[self.current] = _SpillSegment(self.spill_dir, self.prefix)
+            offset = segment.size
+            segment.file.seek(offset)
+            segment.file.write(data)
+            segment.file.flush()
+            segment.size += len(data)
+            segment.live += 1
+        return self.current, offset, len(data)
+
+    def read(self, index: int, offset: int, length: int) -> Any:
+        with self.lock:
+            segment = self.segments[index]
+            if segment.mmap is None or len(segment.mmap) < offset + length:
+                segment.unmap()
+                segment.mmap = mmap.mmap(segment.file.fileno(), 0, access=mmap.ACCESS_READ)
+            data = segment.mmap[offset:offset + length]
+        return pickle.loads(data)
+
+    def release(self, record: tuple[int, int, int]):
+        with self.lock:
+            index = record[0]
+            segment = self.segments[index]
+            segment.live -= 1
+            if segment.live > 0:
+                return
+            if index == self.current:
+                # keep appending to the current segment from its start
+                segment.unmap()
+                segment.file.truncate(0)
+                segment.size = 0
+            else:
+                del self.segments[index]
+                segment.close()
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments.clear()
+
+
+@dataclasses.dataclass
+class _CacheEntry:
+    value: Any
+    nbytes: int
+    created: float
+    spilled: Optional[tuple[int, int, int]] = None
+
+
+class CompletionCache:
+    '''Byte-bounded cache for completions waiting for their group advantages.
+
+    Entries are kept in arrival order. When the resident size exceeds `max_bytes` (or an entry is older
+    than `spill_after` seconds) the oldest resident entries are spilled into a memory-mapped file, so
+    host memory stays flat. Entries older than `timeout` seconds are evicted by `expire`.
+
+    Payloads may share data held outside the cache, e.g. interned prompts. `shared_nbytes` reports its size
+    so it counts in the budget, `spill_fn` returns the payload to write when an entry is spilled, e.g. with
+    its shared data attached so that it can be released, and `restore_fn` undoes it when a spilled entry
+    leaves the cache through `pop` or `expire`.
+
+    Args:
+        max_bytes: Budget of the resident payloads and the shared data in bytes. `None` means unbounded.
+        timeout: Seconds after which an entry is considered lost and evicted.
+        spill_dir: Directory of the spill file. Spilling is disabled if `None`.
+        spill_after: Seconds after which a straggler is spilled even under budget.
+        sizeof: Function to estimate the size of a payload.
+        shared_nbytes: Bytes of the data shared by the payloads outside the cache.
+        spill_fn: Payload written in place of a spilled payload.
+        restore_fn: Payload returned in place of a spilled payload leaving the cache.
+    '''
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        timeout: Optional[float] = None,
+        spill_dir: Optional[str] = None,
+        spill_after: Optional[float] = None,
+        sizeof: Callable[[Any], int] = estimate_nbytes,
+        shared_nbytes: Optional[Callable[[], int]] = None,
+        spill_fn: Optional[Callable[[Any], Any]] = None,
+        restore_fn: Optional[Callable[[Any], Any]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.spill_after = spill_after
+        self.sizeof = sizeof
+        self.shared_nbytes = shared_nbytes
+        self.spill_fn = spill_fn
+        self.restore_fn = restore_fn
+        self.spill = SpillFile(spill_dir) if spill_dir is not None else None
+
+        self.entries: OrderedDict[Hashable, _CacheEntry] = OrderedDict()
+        # resident entries in arrival order, used to pick spill victims
+        self.resident: OrderedDict[Hashable, None] = OrderedDict()
+        self.nbytes = 0
+        self.spilled_bytes = 0
+        self.num_spilled = 0
+        self.num_evicted = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self._load(self.entries[key])
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def put(self, key: Hashable, value: Any):
+        with self.lock:
+            if key in self.entries:
+                self._discard(key)
+            entry = _CacheEntry(value=value, nbytes=self.sizeof(value), created=time.monotonic())
+            self.entries[key] = entry
+            self.resident[key] = None
+            self.nbytes += entry.nbytes
+            self._enforce_budget()
+
+    def get(self, key: Hashable, default: Any = None):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return default
+            return self._load(entry)
+
+    def pop(self, key: Hashable, *default):
+        with self.lock:
+            if key not in self.entries:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            entry = self.entries[key]
+            value = self._restore(entry)
+            self._discard(key)
+            return value
+
+    def over_budget(self) -> bool:
+        '''Whether the resident payloads and the shared data exceed the budget and could not be spilled.'''
+        return self.max_bytes is not None and self._total_nbytes() > self.max_bytes
+
+    def oldest(self):
+        '''Return `(key, age_in_seconds)` of the oldest entry, or `None` if empty.'''
+        with self.lock:
+            if not self.entries:
+                return None
+            key, entry = next(iter(self.entries.items()))
+            return key, time.monotonic() - entry.created
+
+    def expire(self) -> list[Any]:
+        '''Evict entries older than `timeout` and return them.'''
+        evicted = []
+        if self.timeout is None:
+            return evicted
+        now = time.monotonic()
+        with self.lock:
+            while self.entries:
+                key, entry = next(iter(self.entries.items()))
+                if now - entry.created <= self.timeout:
+                    break
+                evicted.append(self._restore(entry))
+                self._discard(key)
+            self.num_evicted += len(evicted)
+        return evicted
+
+    def spill_stale(self) -> int:
+        '''Spill resident entries older than `spill_after`, return the number of spilled entries.'''
+        if self.spill is None or self.spill_after is None:
+            return 0
+        now = time.monotonic()
+        count = 0
+        with self.lock:
+            while self.resident:
+                key = next(iter(self.resident))
+                if now - self.entries[key].created <= self.spill_after:
+                    break
+                self._spill(key)
+                count += 1
+        return count
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "resident": len(self.resident),
+                "resident_bytes": self.nbytes,
+                "spilled": len(self.entries) - len(self.resident),
+                "spilled_bytes": self.spilled_bytes,
+                "spill_file_bytes": self.spill.size if self.spill is not None else 0,
+                "evicted": self.num_evicted,
+            }
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+    def _load(self, entry: _CacheEntry):
+        if entry.spilled is None:
+            return entry.value
+        return self.spill.read(*entry.spilled)
+
+    def _restore(self, entry: _CacheEntry):
+        value = self._load(entry)
+        if entry.spilled is not None and self.restore_fn is not None:
+            value = self.restore_fn(value)
+        return value
+
+    def _total_nbytes(self) -> int:
+        return self.nbytes + (self.shared_nbytes() if self.shared_nbytes is not None else 0)
+
+    def _discard(self, key):
+        entry = self.entries.pop(key)
+        if entry.spilled is None:
+            del self.resident[key]
+            self.nbytes -= entry.nbytes
+        else:
+            self.spilled_bytes -= entry.spilled[2]
+            self.spill.release(entry.spilled)
+
+    def _spill(self, key):
+        entry = self.entries[key]
+        entry.spilled = self.spill.write(entry.value if self.spill_fn is None else self.spill_fn(entry.value))
+        entry.value = None
+        del self.resident[key]
+        self.nbytes -= entry.nbytes
+        self.spilled_bytes += entry.spilled[2]
+        self.num_spilled += 1
+
+    def _enforce_budget(self):
+        if self.spill is None or self.max_bytes is None:
+            return
+        while self._total_nbytes() > self.max_bytes and self.resident:
+            self._spill(next(iter(self.resident)))
+
+
+@dataclasses.dataclass
+class _PromptEntry:
+    prompt: Any
+    refs: int = 0
+    processed: Any = None
+    nbytes: int = 0
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+
+
+class PromptStore:
+    '''Interns the prompts shared by sibling completions of a task, with reference counting.
+
+    Each prompt is stored once per key and processed at most once, the processed inputs are shared by
+    all completions referencing the key. `process_fn` may return a `Future`, which is shared as well: its
+    result replaces it when it completes, and if it fails the next access processes the prompt again. The
+    raw prompt is released once processing succeeded and the entry is removed once the last reference is
+    released. `detach` hands the raw prompt of a reference over to its holder, e.g. to spill it along with
+    a completion, and `acquire` with the prompt interns it again.
+    '''
+    def __init__(self, sizeof: Callable[[Any], int] = estimate_nbytes):
+        self.sizeof = sizeof
+        self.entries: dict[Hashable, _PromptEntry] = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def acquire(self, key: Hashable, prompt: Any = None) -> bool:
+        '''Add a reference to `key`, storing `prompt` if the key is new.
+
+        Returns `False` if the key is unknown and no prompt is given.
+        '''
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                if prompt is None:
+                    return False
+                entry = self.entries[key] = _PromptEntry(prompt=prompt, nbytes=self.sizeof(prompt))
+                self.nbytes += entry.nbytes
+            entry.refs += 1
+            return True
+
+    def detach(self, key: Hashable) -> Any:
+        '''Release a reference to `key` and return its raw prompt for the caller to keep.
+
+        Returns `None` and keeps the reference if the key is unknown or its prompt is already processed.
+        '''
+        with self.lock:
+            entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        with entry.lock:
+            if entry.processed is not None:
+                return None
+            with self.lock:
+                if self.entries.get(key, None) is not entry:
+                    return None
+                entry.refs -= 1
+                if entry.refs <= 0:
+                    del self.entries[key]
+                    self.nbytes -= entry.nbytes
+            return entry.prompt
+
+    def processed(self, key: Hashable, process_fn: Callable[[Any], Any]):
+        '''Return the processed prompt of `key`, processing it with `process_fn` on first access.'''
+        with self.lock:
+            entry = self.entries[key]
+        with entry.lock:
+            if isinstance(entry.processed, Future) and entry.processed.done() and \
+                    (entry.processed.cancelled() or entry.processed.exception() is not None):
+                # do not share the failure with the siblings, process the kept prompt again
+                entry.processed = None
+            submitted = entry.processed is None
+            if submitted:
+                entry.processed = process_fn(entry.prompt)
+            processed = entry.processed
+        if submitted:
+            if isinstance(processed, Future):
+                processed.add_done_callback(lambda future: self._resolve(key, entry, future))
+            else:
+                self._resolve(key, entry, processed)
+        return processed
+
+    def _resolve(self, key: Hashable, entry: _PromptEntry, processed: Any):
+        '''Replace a completed `Future` by its result and account for the processed inputs.'''
+        if isinstance(processed, Future):
+            if processed.cancelled() or processed.exception() is not None:
+                return
+            future, processed = processed, processed.result()
+        else:
+            future = processed
+        with entry.lock:
+            if entry.processed is not future:
+                return
+            entry.processed = processed
+            entry.prompt = None
+            nbytes = self.sizeof(processed)
+            with self.lock:
+                if self.entries.get(key, None) is entry:
+                    self.nbytes += nbytes - entry.nbytes
+                entry.nbytes = nbytes
+
+    def release(self, key: Hashable):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs <= 0:
+                del self.entries[key]
+                self.nbytes -= entry.nbytes
+
+
+class CompletionStore:
+    '''History completions of multi-turn tasks, keyed by the dataset index of their step.
+
+    Each key holds a queue of the completions queued for its continuations. `get` without `pop` rotates
+    the queue, so the continuations of a step read different sibling completions. Keys untouched for `ttl`
+    seconds are evicted by `expire`. With `spill_dir`, completions are written into a `SpillFile` and only
+    their offsets stay in memory. History completions are small, so the spill uses segments of
+    `spill_segment_bytes`: a key kept alive by a long multi-turn task only pins its own segment.
+    '''
+    def __init__(self, ttl: Optional[float] = None, spill_dir: Optional[str] = None, spill_segment_bytes: int = 64 * 2**20):
+        self.ttl = ttl
+        self.spill = SpillFile(spill_dir, prefix="arl_history_", segment_bytes=spill_segment_bytes) if spill_dir is not None else None
+        self.entries: dict[Hashable, deque] = {}
+        # keys in order of last access, used to expire untouched keys
+        self.touched: OrderedDict[Hashable, float] = OrderedDict()
+        self.num_evicted = 0
+        self.num_missed = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def put(self, key: Hashable, completion: Any):
+        if self.spill is not None:
+            completion = self.spill.write(completion)
+        self.entries.setdefault(key, deque()).append(completion)
+        self._touch(key)
+
+    def get(self, key: Hashable, pop: bool = False, default: Any = None):
+        '''Return the next completion of `key`, removing it if `pop` else moving it to the back.'''
+        queue = self.entries.get(key, None)
+        if not queue:
+            self.num_missed += 1
+            return default
+        record = queue.popleft()
+        if pop:
+            value = self._load(record)
+            self._release(record)
+            if not queue:
+                del self.entries[key]
+                del self.touched[key]
+                return value
+        else:
+            value = self._load(record)
+            queue.append(record)
+        self._touch(key)
+        return value
+
+    def mget(self, keys: list[Hashable], pop: bool = False, default: Any = None) -> list:
+        return [self.get(key, pop=pop, default=default) for key in keys]
+
+    def expire(self) -> int:
+        '''Evict keys untouched for `ttl` seconds, return the number of evicted completions.'''
+        if self.ttl is None:
+            return 0
+        now = time.monotonic()
+        count = 0
+        while self.touched:
+            key, last = next(iter(self.touched.items()))
+            if now - last <= self.ttl:
+                break
+            del self.touched[key]
+            for record in self.entries.pop(key):
+                self._release(record)
+                count += 1
+        self.num_evicted += count
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self.entries),
+            "completions": sum(len(queue) for queue in self.entries.values()),
+            "evicted": self.num_evicted,
+            "missed": self.num_missed,
+            "spill_file_bytes": self.spill.size if self.spill is not None else 0,
+        }
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+    def _touch(self, key):
+        self.touched[key] = time.monotonic()
+        self.touched.move_to_end(key)
+
+    def _load(self, record):
+        return record if self.spill is None else self.spill.read(*record)
+
+    def _release(self, record):
+        if self.spill is not None:
+            self.spill.release(record)
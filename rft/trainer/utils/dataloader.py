@@ -4,9 +4,101 @@ import multiprocessing
 import queue
 from typing import Iterator, Any, Callable, Optional, List
 import pickle
+import bisect
+import numpy as np
+import torch
+from PIL import Image
 from torch.utils.data import Sampler
 from collections import defaultdict
 import torch.distributed as dist
+from .cache import CompletionStore
+from .trace import tracer
+
+
+class SharedImage:
+    '''Pixels of a PIL image held in a shared memory tensor, pickled as a handle only.'''
+    MODES = ("RGB", "RGBA", "L")
+
+    def __init__(self, image: Image.Image):
+        self.pixels = torch.from_numpy(np.array(image)).share_memory_()
+
+    def to_image(self) -> Image.Image:
+        # the mode follows from the shape. PIL maps L and RGBA pixels onto the shared buffer, but copies RGB
+        # ones since it stores them with a padding byte, so RGB images are copied once in this process
+        return Image.fromarray(self.pixels.numpy())
+
+
+def _to_shared(obj):
+    '''Move the tensors and images of a collated batch into shared memory.'''
+    if isinstance(obj, torch.Tensor):
+        return obj.share_memory_()
+    if isinstance(obj, Image.Image) and obj.mode in SharedImage.MODES:
+        return SharedImage(obj)
+    if isinstance(obj, dict):
+        return {k: _to_shared(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_shared(v) for v in obj)
+    return obj
+
+
+def _from_shared(obj):
+    if isinstance(obj, SharedImage):
+        return obj.to_image()
+    if isinstance(obj, dict):
+        return {k: _from_shared(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_from_shared(v) for v in obj)
+    return obj
+
+
+class TaskBucketer:
+    '''Cut the indices of a sampler into batches of similar prompt cost.
+
+    Indices are drawn `window` batches at a time and sorted by `cost_fn`. Each batch is a contiguous slice of
+    the sorted window, placed around `anchor` if given, e.g. the mean cost of the multiturn continuations
+    already in the batch. Indices left over from a window go into the next batch before a new window is
+    drawn, so no index waits longer than one window.
+    '''
+    def __init__(self, cost_fn: Callable[[int], float], window: int, batch_size: int):
+        self.cost_fn = cost_fn
+        self.window_size = window * batch_size
+        self.costs = []
+        self.pending = []
+
+    def reset(self):
+        self.costs.clear()
+        self.pending.clear()
+
+    def _draw(self, next_index: Callable[[], Any]):
+        window = []
+        for _ in range(self.window_size):
+            index = next_index()
+            window.append((self.cost_fn(index), index))
+        window.sort(key=lambda x: x[0])
+        self.costs = [c for c, _ in window]
+        self.pending = [i for _, i in window]
+
+    def take(self, next_index: Callable[[], Any], n: int, anchor: Optional[float] = None) -> list:
+        tasks = []
+        if n <= 0:
+            return tasks
+        if len(self.pending) < n:
+            # dispatch the rest of the window first, then fill the batch from a new one
+            if self.pending:
+                carried = sum(self.costs) / len(self.costs)
+                anchor = carried if anchor is None else (anchor + carried) / 2
+            tasks.extend(self.pending)
+            n -= len(self.pending)
+            self._draw(next_index)
+        if anchor is None:
+            start = 0
+        else:
+            start = bisect.bisect_left(self.costs, anchor) - n // 2
+            start = max(0, min(start, len(self.pending) - n))
+        tasks.extend(self.pending[start:start + n])
+        del self.pending[start:start + n], self.costs[start:start + n]
+        return tasks
+
 
 class GlobalDistributed0MQDataLoader:
     def __init__(
@@ -20,6 +112,9 @@ class GlobalDistributed0MQDataLoader:
         worker_init_fn: Callable,
         prefetch_factor: int,
         world_size:int,
+        bucket_window: Optional[int] = None,
+        completion_ttl: Optional[float] = None,
+        completion_spill_dir: Optional[str] = None,
         **kwargs: Any
     ):
         self.dataset = dataset
@@ -34,15 +129,21 @@ class GlobalDistributed0MQDataLoader:
         self._init_kwargs = kwargs
         self.world_size = world_size
         self.rank = dist.get_rank()
+        # bucket the dispatched tasks by the prompt cost estimated by the dataset
+        self.bucket_window = bucket_window if hasattr(dataset, "prompt_cost") else None
+        self.completion_ttl = completion_ttl
+        self.completion_spill_dir = completion_spill_dir
 
-        self.index_queue = multiprocessing.Queue(self.num_workers)
+        # workers fetch their own tasks from the master once the first iteration starts
+        self.start_event = multiprocessing.Event()
         self.result_queue = multiprocessing.Queue(self.prefetch_factor)
         
         self.workers = [ multiprocessing.Process(
             target=GlobalDistributed0MQDataLoader._load_data,
             args=(
                 self.dataset,
-                self.index_queue,
+                self.global_sync_address,
+                self.start_event,
                 self.result_queue,
                 self.collate_fn,
                 self.worker_init_fn
@@ -56,7 +157,10 @@ class GlobalDistributed0MQDataLoader:
         if self.rank == 0:
             self.master_proc = multiprocessing.Process(
                 target=GlobalDistributed0MQDataLoader._master_loop,
-                args=(self.global_sync_address, self.batch_size,self.sampler),
+                args=(
+                    self.global_sync_address, self.batch_size, self.sampler, self.dataset, self.bucket_window,
+                    self.completion_ttl, self.completion_spill_dir
+                ),
                 daemon=True
             )
             self.master_proc.start()
@@ -69,49 +173,75 @@ class GlobalDistributed0MQDataLoader:
         global_sync_address: str,
         batch_size: int,
         sampler: Sampler,
+        dataset: Any = None,
+        bucket_window: Optional[int] = None,
+        completion_ttl: Optional[float] = None,
+        completion_spill_dir: Optional[str] = None,
     ):
         '''Master loop to dispatch tasks to workers'''
+        tracer.set_process_name("task_dispatcher")
         zctx = zmq.Context()
         task_dispatcher = zctx.socket(zmq.REP)
         task_dispatcher.bind(global_sync_address)
         
         it = None
         
+        def next_index():
+            nonlocal it
+            while True:
+                try:
+                    return next(it)
+                except StopIteration:
+                    it = iter(sampler)
+                    print("Restart Sampler During Epoch")
+        
+        bucketer = None
+        if bucket_window is not None and bucket_window > 1:
+            bucketer = TaskBucketer(dataset.prompt_cost, bucket_window, batch_size)
+        
         multiturn_cache = queue.PriorityQueue()
-        cached_completions = defaultdict(list)
+        cached_completions = CompletionStore(ttl=completion_ttl, spill_dir=completion_spill_dir)
         
         while True:
             req: str | list[dict] | dict = task_dispatcher.recv_pyobj()
+            if cached_completions.expire():
+                print(f"Evict expired completions: {cached_completions.stats()}")
             if isinstance(req,str):
                 if req == "REQ_TASK":
                     tasks = []
+                    # multiturn continuations always go first
                     for _ in range(min(multiturn_cache.qsize(),batch_size)):
                         tasks.append(multiturn_cache.get()[1])
 
+                    if bucketer is not None:
+                        anchor = sum(map(dataset.prompt_cost, tasks)) / len(tasks) if tasks else None
+                        tasks.extend(bucketer.take(next_index, batch_size - len(tasks), anchor))
                     while len(tasks) < batch_size:
-                        try:
-                            tasks.append(next(it))
-                        except StopIteration:
-                            it = iter(sampler)
-                            print("Restart Sampler During Epoch")
+                        tasks.append(next_index())
                 
                     task_dispatcher.send(pickle.dumps(tasks))
+                    tracer.instant("dispatch", tasks=tasks, multiturn=multiturn_cache.qsize())
                 
                 elif req == "RESTART":
                     it = iter(sampler)
+                    if bucketer is not None:
+                        bucketer.reset()
                     task_dispatcher.send_string("RESTARTED")
                 
                 else:
                     raise NotImplementedError(f"Receive Unknown Request {req}")
             elif isinstance(req,dict):
-                if "get" in req:
+                if "mget" in req:
+                    # history completions of all previous steps of a sample in one request
+                    completions = cached_completions.mget(req["mget"], pop=req["pop"])
+                    for index, d in zip(req["mget"], completions):
+                        if d is None:
+                            print(f"Error: Illegal access of cache completions at index {index}.")
+                    task_dispatcher.send_pyobj(["" if d is None else d for d in completions])
+                elif "get" in req:
                     index = req["get"]
-                    if len(cached_completions[index]) > 0:
-                        d = cached_completions[index].pop(0)
-                        if not req["pop"]:
-                            cached_completions[index].append(d)
-                        # print(f"Cache Completions: {d}")
-                    else:
+                    d = cached_completions.get(index, pop=req["pop"])
+                    if d is None:
                         d = ""
                         print(f"Error: Illegal access of cache completions at index {index}.")
                     task_dispatcher.send_string(d)
@@ -121,7 +251,7 @@ class GlobalDistributed0MQDataLoader:
             elif isinstance(req,list):
                 for d in req:
                     multiturn_cache.put((d["gid"],d["next_id"]))
-                    cached_completions[d["id"]].append(d["completion"])
+                    cached_completions.put(d["id"], d["completion"])
                 task_dispatcher.send_string("Received")
                 
                 # counts = {}
@@ -136,46 +266,51 @@ class GlobalDistributed0MQDataLoader:
     @staticmethod
     def _load_data(
         dataset: Any,
-        index_queue: multiprocessing.Queue,
+        global_sync_address: str,
+        start_event: Any,
         result_queue: multiprocessing.Queue,
         collate_fn: Callable,
         worker_init_fn: Callable,
     ):
         worker_init_fn(None)
+        tracer.set_process_name("data_worker")
+        start_event.wait()
         
+        zctx = zmq.Context()
+        task_receiver = zctx.socket(zmq.REQ)
+        task_receiver.connect(global_sync_address)
+        # keep one request in flight, the master assigns the next tasks while the current ones are loaded
+        task_receiver.send_pyobj("REQ_TASK")
         while True:
-            indices = index_queue.get()
+            tasks = pickle.loads(task_receiver.recv(copy=False))
+            if tasks is None:
+                result_queue.put(None)
+                break
+            task_receiver.send_pyobj("REQ_TASK")
             
-            data = [dataset[index] for index in indices]
-
-            result_queue.put(collate_fn(data))
+            with tracer.span("load", tasks=tasks):
+                data = [dataset[index] for index in tasks]
+                data = _to_shared(collate_fn(data))
+            
+            # only the shared memory handles are pickled through the queue
+            with tracer.span("result_queue_put"):
+                result_queue.put(data)
 
     def __iter__(self):
-        '''Get tasks from the master and load the data into the queue'''
-        zctx = zmq.Context()
-        task_receiver = zctx.socket(zmq.REQ)
-        task_receiver.connect(self.global_sync_address)
-        
-        
+        '''Restart the master and yield the batches loaded by the workers'''
         if self.rank == 0:
+            zctx = zmq.Context()
+            task_receiver = zctx.socket(zmq.REQ)
+            task_receiver.connect(self.global_sync_address)
             task_receiver.send_pyobj("RESTART")
-            task_receiver.recv()        
+            task_receiver.recv()
+            task_receiver.close()
         dist.barrier()
-        
-        def get_task():
-            while True:
-                task_receiver.send_pyobj("REQ_TASK")
-                tasks = pickle.loads(task_receiver.recv(copy=False))
-                if tasks is None:
-                    self.result_queue.put(None)
-                    break
-                self.index_queue.put(tasks)
-        task_get_thd = threading.Thread(target=get_task,daemon=True)
-        task_get_thd.start()
-        
+        self.start_event.set()
         
         while True:
-            data = self.result_queue.get()
+            with tracer.span("result_queue_wait"):
+                data = self.result_queue.get()
             if data is None:
                 break
-            yield data
+            yield _from_shared(data)
@@ -11,16 +11,23 @@ If you want to conduct multi-turn ARL, you should also provide `next_id` that in
 
 
 import os
+import math
 import json
 import re
 import io
 import random
+import hashlib
+import numpy as np
 from tqdm import tqdm
 from torch.utils.data import Dataset
 from PIL import Image
 from typing import Optional
+from collections import OrderedDict
 import zmq
 
+# longest line of the history screenshots of multi-turn prompts
+HISTORY_LINE_RES = 448
+
 def load_resized_image(img_file:str|io.BytesIO, max_line_res: Optional[int] = None):
     origin_img = Image.open(img_file).convert("RGB")
     w,h = origin_img.size
@@ -37,59 +44,234 @@ def load_resized_image(img_file:str|io.BytesIO, max_line_res: Optional[int] = No
         
     return img,origin_img
 
+def estimate_image_tokens(max_line_res: Optional[int] = None, query_num: int = 64, max_slice_nums: int = 9):
+    '''Rough number of prompt tokens of a screenshot resized to `max_line_res`, without loading it.
+
+    The image is encoded as an overview plus about `(max_line_res / 448) ** 2 / 2` slices (screenshots are
+    about twice as tall as wide), each of `query_num` tokens.
+    '''
+    if max_line_res is None:
+        slices = max_slice_nums
+    else:
+        slices = min(max_slice_nums, math.ceil((max_line_res / 448) ** 2 / 2))
+    return query_num * (1 + slices) if slices > 1 else query_num
+
+
+def build_jsonl_index(jsonl_file_path: str) -> np.ndarray:
+    '''Byte offsets of the valid lines of a JSONL file, followed by the size of the file.
+
+    Lines that fail to parse are left out of the index, like the loaders used to skip them.
+    '''
+    offsets = []
+    with open(jsonl_file_path, "rb") as f:
+        offset = 0
+        for line in tqdm(f, desc="Indexing dataset", dynamic_ncols=True):
+            try:
+                json.loads(line)
+                offsets.append(offset)
+            except:
+                print("Error while loading line.")
+            offset += len(line)
+    offsets.append(offset)
+    return np.array(offsets, dtype=np.int64)
+
+
+class JsonlRecords:
+    '''Read-only sequence of the records of a JSONL file, parsed on access through an offset index.
+
+    The index is cached next to the file as `<jsonl_file_path>.index.npy` and rebuilt when the file changes,
+    so only the first run pays for a full pass over the data. Pickling only carries the offsets.
+    '''
+    def __init__(self, jsonl_file_path: str):
+        self.jsonl_file_path = jsonl_file_path
+        index_path = jsonl_file_path + ".index.npy"
+        size = os.path.getsize(jsonl_file_path)
+        offsets = None
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(jsonl_file_path):
+            offsets = np.load(index_path)
+            if len(offsets) == 0 or offsets[-1] != size:
+                offsets = None
+        if offsets is None:
+            offsets = build_jsonl_index(jsonl_file_path)
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, offsets)
+                os.replace(tmp_path, index_path)
+            except OSError:
+                # read-only data directory, keep the index in memory
+                pass
+        self.offsets = offsets
+        self.file = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, index) -> bytes:
+        '''Raw line of the record `index`, without the line break.'''
+        if index < 0:
+            index += len(self)
+        if self.file is None:
+            self.file = open(self.jsonl_file_path, "rb")
+        # positional reads do not share a file offset with forked processes
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        line = os.pread(self.file.fileno(), end - start, start)
+        return line.split(b"\n", 1)[0]
+
+    def __getitem__(self, index):
+        return json.loads(self.line(index))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["file"] = None
+        return state
+
+
+class ImageCache:
+    '''Resized screenshots stored as raw uint8 pixels under `cache_dir/<max_line_res>/`.
+
+    Each entry starts with the original and the resized `(width, height)` as int32, followed by the RGB
+    pixels, which are memory-mapped on load instead of decoding and resizing the screenshot again. Entries
+    are keyed by the path, size and modification time of the screenshot, and written on the first load.
+    '''
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def entry_path(self, img_file: str, max_line_res: Optional[int] = None) -> str:
+        stat = os.stat(img_file)
+        key = f"{os.path.abspath(img_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+        key = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, str(max_line_res or "full"), key[:2], key + ".u8")
+
+    def load(self, img_file: str, max_line_res: Optional[int] = None):
+        '''Return the resized image and the `(width, height)` of the original screenshot.'''
+        path = self.entry_path(img_file, max_line_res)
+        if os.path.exists(path):
+            origin_w, origin_h, w, h = np.fromfile(path, dtype=np.int32, count=4).tolist()
+            pixels = np.memmap(path, dtype=np.uint8, mode="r", offset=16, shape=(h, w, 3))
+            return Image.fromarray(pixels), (origin_w, origin_h)
+        img, origin_img = load_resized_image(img_file, max_line_res)
+        self.store(path, img, origin_img.size)
+        return img, origin_img.size
+
+    def store(self, path: str, img: Image.Image, origin_size: tuple):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.array([*origin_size, *img.size], dtype=np.int32).tofile(f)
+                np.asarray(img, dtype=np.uint8).tofile(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # a full or read-only cache only costs the speedup
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def prepare_record(item: dict, image_root: str) -> dict:
+    '''Pre-parse a single-turn record into the columns used by `GUIRFTDataset`.
+
+    The query is extracted from the question, the action is decoded, the bboxes are normalized to `None`
+    when missing and the screenshot path is resolved. Raises if the conversation is malformed.
+    '''
+    user_query = item["conversations"][-2]["content"]
+    user_query = re.match(r"<Question>(.*?)</Question>", user_query, re.DOTALL).group(1)
+    action = json.loads(item["conversations"][-1]["content"])
+    image = {}
+    for img_id, img_file in item["image"].items():
+        image[img_id] = img_file if os.path.exists(img_file) else os.path.join(image_root, img_file)
+    return {
+        "query": user_query,
+        "action": action,
+        "image": image,
+        "bbox": item.get("bbox", None) or None,
+        "bbox2": item.get("bbox2", None) or None,
+    }
+
+
 class GUIRFTDataset(Dataset):
-    def __init__(self, jsonl_file_path: str, max_line_res: int|None = None, *args, **kwargs):
+    """Single-turn RFT Dataset
+
+    Reads either the raw JSONL with `conversations`, or the records pre-parsed by `prepare_record`, see
+    `preprocess_dataset.py`. Records are parsed on access, see `JsonlRecords`. If `image_cache_dir` is set,
+    resized screenshots are kept in an `ImageCache`. Each worker also keeps the last `image_lru_size`
+    resized screenshots in memory, keyed by path and resolution.
+
+    Invalid records are replaced by another record, unless `strict` is set for data checked by
+    `validate_dataset.py`, in which case they raise a `ValueError`.
+    """
+    def __init__(
+        self,
+        jsonl_file_path: str,
+        max_line_res: int|None = None,
+        image_cache_dir: Optional[str] = None,
+        image_lru_size: int = 32,
+        strict: bool = False,
+        *args, **kwargs
+    ):
         super().__init__()
-        self.data = []
         self.jsonl_file_path = jsonl_file_path
-        with open(jsonl_file_path, "r") as f:
-            for line in tqdm(f.readlines(), desc="Loading dataset",dynamic_ncols=True):
-                try:
-                    self.data.append(json.loads(line))
-                except:
-                    print("Error while loading line.")
-                    continue
+        self.data = JsonlRecords(jsonl_file_path)
         self.image_root = os.path.dirname(os.path.dirname(jsonl_file_path))
         self.max_line_res = max_line_res
+        self.image_cache = ImageCache(image_cache_dir) if image_cache_dir is not None else None
+        self.image_lru_size = image_lru_size
+        self.image_lru = OrderedDict()
+        self.strict = strict
+
+    def load_image(self, img_file: str, max_line_res: Optional[int] = None):
+        '''Return the screenshot resized to `max_line_res` and the `(width, height)` of the original.'''
+        key = (img_file, max_line_res)
+        if key in self.image_lru:
+            self.image_lru.move_to_end(key)
+            return self.image_lru[key]
+        if self.image_cache is not None:
+            result = self.image_cache.load(img_file, max_line_res)
+        else:
+            img, origin_img = load_resized_image(img_file, max_line_res)
+            result = (img, origin_img.size)
+        if self.image_lru_size > 0:
+            self.image_lru[key] = result
+            while len(self.image_lru) > self.image_lru_size:
+                self.image_lru.popitem(last=False)
+        return result
 
 
     def __len__(self):
         return len(self.data)
     
+    def prompt_cost(self, index) -> float:
+        '''Estimated number of prompt tokens of `index` from the metadata, used to bucket dispatched tasks.'''
+        item = self.data[index]
+        query = item["query"] if "query" in item else item["conversations"][-2]["content"]
+        return len(query) + estimate_image_tokens(self.max_line_res)
+    
     def __getitem__(self, index):
         item = self.data[index]
         
         try:
-            # process the conversation
-            user_query = item["conversations"][-2]["content"]
-            user_query = re.match(r"<Question>(.*?)</Question>", user_query,re.DOTALL).group(1)
-            action = json.loads(item["conversations"][-1]['content'])
-        except:
+            # process the conversation, unless it was pre-parsed
+            if "query" not in item:
+                item = prepare_record(item, self.image_root)
+            user_query = item["query"]
+            action = item["action"]
+        except Exception as e:
+            if self.strict:
+                raise ValueError(f"Invalid conversation of record {index} in {self.jsonl_file_path}") from e
             print("Error while processing conversation.")
             return self[index - 53]
         
         for img_id,img_file in item["image"].items():
             try:
-                if os.path.exists(img_file):
-                    origin_img = Image.open(img_file).convert("RGB")
-                else:
-                    origin_img = Image.open(os.path.join(self.image_root,img_file)).convert("RGB")
-            except:
+                # resize the max height and width to max_line_res
+                img, origin_size = self.load_image(img_file, self.max_line_res)
+            except Exception as e:
+                if self.strict:
+                    raise ValueError(f"Failed to load image {img_file} of record {index} in {self.jsonl_file_path}") from e
                 print("Error while loading image: ", img_file)
                 return self[index - 53]
-            w,h = origin_img.size
-            # resize the max height and width to 1000
-            if self.max_line_res is not None:
-                max_line = self.max_line_res
-                if h > max_line:
-                    w = int(w * max_line / h)
-                    h = max_line
-                if w > max_line:
-                    h = int(h * max_line / w)
-                    w = max_line
-            img = origin_img.resize((w,h),resample=Image.Resampling.LANCZOS)
             
-            resolution = (origin_img.size, img.size)
+            resolution = (origin_size, img.size)
             break
         
         conv = []
@@ -102,14 +284,8 @@ class GUIRFTDataset(Dataset):
             f"<Question>{user_query}</Question>\n当前屏幕截图：",
             img, 
         ]})
-        if item.get("bbox",None) is None or len(item.get("bbox",None)) == 0:
-            bbox = None
-        else:
-            bbox = item["bbox"]
-        if item.get("bbox2",None) is None or len(item.get("bbox2",None)) == 0:
-            bbox2 = None
-        else:
-            bbox2 = item["bbox2"]
+        bbox = item["bbox"]
+        bbox2 = item["bbox2"]
         return {
             "id": index,
             "step_id": 0,
@@ -128,11 +304,17 @@ class GUIMTRFTDataset(GUIRFTDataset):
         jsonl_file_path: str, 
         hist_length: int = 3,
         max_line_res: int|None = None, 
+        image_cache_dir: Optional[str] = None,
+        image_lru_size: int = 32,
+        strict: bool = False,
         *args, **kwargs
     ):
         super().__init__(
             jsonl_file_path=jsonl_file_path,
             max_line_res=max_line_res,
+            image_cache_dir=image_cache_dir,
+            image_lru_size=image_lru_size,
+            strict=strict,
             *args, **kwargs
         )
         self.hist_length = hist_length
@@ -149,6 +331,18 @@ class GUIMTRFTDataset(GUIRFTDataset):
     def __len__(self):
         return len(self.data)
     
+    def prompt_cost(self, index) -> float:
+        real_index = index % len(self.data)
+        step_index = index // len(self.data)
+        conversations = self.data[real_index]["conversations"]
+        # the current screenshot, the history screenshots and the history completions
+        num_hist_images = min(step_index, self.hist_length - 1)
+        cost = estimate_image_tokens(self.max_line_res) + num_hist_images * estimate_image_tokens(HISTORY_LINE_RES)
+        for turn in conversations[1:2 + 2 * step_index]:
+            if isinstance(turn["content"], str):
+                cost += len(turn["content"])
+        return cost
+    
     def __getitem__(self, index):
         self.lazy_init()
         
@@ -164,6 +358,8 @@ class GUIMTRFTDataset(GUIRFTDataset):
             user_query = re.match(r"<Question>(.*?)</Question>", user_query,re.DOTALL).group(1)
             action = json.loads(item["conversations"][2+2*step_index]["content"])
         except Exception as e:
+            if self.strict:
+                raise ValueError(f"Invalid conversation at step {step_index} of record {real_index} in {self.jsonl_file_path}") from e
             print("Error while processing conversation: ", e, item["conversations"])
             action = item["conversations"][-1]["content"]
             return {
@@ -179,14 +375,22 @@ class GUIMTRFTDataset(GUIRFTDataset):
         # conv = [{"role":"system","content":SFT_PROMPT}]
         # conv = [{"role":"system","content":random.choice(SYSTEM_PROMPTS)}]
         conv = [{"role":"system","content":THINK_PROMPT}]
+        # gather model's history completions of all previous steps
+        history = []
+        if step_index > 0:
+            self.step_response_receiver.send_pyobj({
+                "mget": [real_index + len(self.data) * step_id for step_id in range(step_index)],
+                "pop": True if next_id is None else False
+            })
+            history = self.step_response_receiver.recv_pyobj()
         # Append history
         for step_id in range(step_index + 1):
             if step_id > step_index - self.hist_length:
                 if step_id != step_index:
-                    line_res = 448
+                    line_res = HISTORY_LINE_RES
                 else:
                     line_res = self.max_line_res
-                img,ori_img = load_resized_image(item["image"][f"<image_{step_id:02}>"],max_line_res=line_res)
+                img,origin_size = self.load_image(item["image"][f"<image_{step_id:02}>"],max_line_res=line_res)
                 conv.append({"role":"user","content":[
                     "当前屏幕截图：",
                     img
@@ -195,13 +399,7 @@ class GUIMTRFTDataset(GUIRFTDataset):
                 conv.append({"role":"user","content":"// 历史图像，无法显示"})
                 
             if step_index > 0 and step_id != step_index:
-                # gather model's history completions
-                self.step_response_receiver.send_pyobj({
-                    "get": real_index + len(self.data) * step_id,
-                    "pop": True if next_id is None else False
-                })
-                res = self.step_response_receiver.recv_string()
-                conv.append({"role":"assistant","content":res})
+                conv.append({"role":"assistant","content":history[step_id]})
 
             
         # add user query
@@ -210,7 +408,7 @@ class GUIMTRFTDataset(GUIRFTDataset):
         else:
             conv[-1]["content"] = f"<Question>{user_query}</Question>\n" + conv[-1]["content"]
         
-        resolution = (ori_img.size,img.size)
+        resolution = (origin_size,img.size)
         
         try:
             bbox1 = item["bbox"][step_id]
@@ -0,0 +1,59 @@
+import logging
+import torch
+from torch import nn
+
+try:
+    from transformers.generation.configuration_utils import CompileConfig
+except ImportError:
+    CompileConfig = None
+
+logger = logging.getLogger("ARL")
+
+
+def reserve_on_device(model: nn.Module, device: torch.device):
+    '''Move `model` to `device`, allocating its weights from a dedicated memory pool when supported.
+
+    Keeping the resident weights out of the default pool avoids fragmenting the memory used by training.
+    Returns the pool, which must be kept alive as long as the weights.
+    '''
+    pool = None
+    if torch.cuda.is_available() and hasattr(torch.cuda, "MemPool") and hasattr(torch.cuda, "use_mem_pool"):
+        pool = torch.cuda.MemPool()
+        with torch.cuda.use_mem_pool(pool):
+            model.to(device=device)
+    else:
+        model.to(device=device)
+    return pool
+
+
+class CompiledDecoding:
+    '''Generation arguments which compile the decoding step for a fixed batch shape.
+
+    Batches of `batch_size` decode on a static KV cache with the step compiled by `torch.compile`
+    (`reduce-overhead` captures it into CUDA graphs). Batches of other shapes, e.g. evaluation or a
+    partial last batch, fall back to eager decoding with a dynamic cache and never trigger recompilation.
+    The weights must stay on the same device while compiled, see `reserve_on_device`.
+    '''
+    def __init__(self, batch_size: int, mode: str = "reduce-overhead"):
+        self.batch_size = batch_size
+        self.mode = mode
+        self.enabled = CompileConfig is not None
+        self.compiled_calls = 0
+        self.eager_calls = 0
+        if not self.enabled:
+            logger.warning("Compiled decoding requires a transformers version providing `CompileConfig`, decode eagerly.")
+
+    def generation_kwargs(self, batch_size: int) -> dict:
+        if not self.enabled or batch_size != self.batch_size:
+            self.eager_calls += 1
+            return {}
+        self.compiled_calls += 1
+        return {
+            "cache_implementation": "static",
+            "compile_config": CompileConfig(fullgraph=False, dynamic=False, mode=self.mode),
+        }
+
+    def disable(self, reason: Exception):
+        '''Fall back to eager decoding for the rest of the run.'''
+        logger.warning(f"Disable compiled decoding due to: {reason}")
+        self.enabled = False
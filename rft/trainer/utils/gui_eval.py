@@ -4,8 +4,16 @@ import json5
 import jsonschema
 import difflib
 import math
-from concurrent.futures import ProcessPoolExecutor
+import time
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from .dataset import SCHEMA
+from .validator import loads_action, validate_action
+from .scoring import calculate_dist_scores, bboxes_to_array
 
 def load_and_validate_action(res:str,):
     action_str = re.search(r'```json(.*?)```', res, re.DOTALL)
@@ -13,7 +21,7 @@ def load_and_validate_action(res:str,):
         action_str = action_str.group(1).strip()
     else:
         action_str = res
-    action = json5.loads(action_str,allow_duplicate_keys=False)
+    action = loads_action(action_str)
     # if isinstance(res, str):
     #     action_str = res
     #     action = json5.loads(action_str,allow_duplicate_keys=False)
@@ -21,40 +29,90 @@ def load_and_validate_action(res:str,):
     #     action = res
     
     # action = json5.loads(res,allow_duplicate_keys=False)
-    jsonschema.validate(action, SCHEMA)
+    validate_action(action)
     return action
 
-global_executor = ProcessPoolExecutor(max_workers=8)
+_busy_since = None
+_worker_slot = None
 
-def _action_schema_check(res:str,solution: dict):
+def _init_reward_worker(busy_since, slots):
+    global _busy_since, _worker_slot
+    with slots.get_lock():
+        _worker_slot = slots.value
+        slots.value += 1
+    _busy_since = busy_since
+
+class RewardExecutor(ProcessPoolExecutor):
+    '''Process pool whose workers publish since when they evaluate their current chunk.
+
+    Chunks waiting in the call queue of a `ProcessPoolExecutor` already count as running and can not be
+    cancelled, so only the workers can tell a chunk still queued behind a slow batch from a hung one.
+    '''
+    def __init__(self, max_workers: int):
+        self.busy_since = multiprocessing.Array("d", max_workers, lock=False)
+        super().__init__(
+            max_workers=max_workers,
+            initializer=_init_reward_worker,
+            initargs=(self.busy_since, multiprocessing.Value("i", 0)),
+        )
+
+    def hung_workers(self, timeout: float) -> int:
+        '''Number of workers evaluating the same chunk for more than `timeout` seconds.'''
+        now = time.time()
+        return sum(since > 0 and now - since > timeout for since in self.busy_since)
+
+global_executor = RewardExecutor(max_workers=8)
+
+def recycle_executor(executor: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    '''Kill the workers of a hung or broken pool and return a fresh pool of the same size.'''
+    processes = list((getattr(executor, "_processes", None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.kill()
+    return type(executor)(max_workers=executor._max_workers)
+
+def _parse_action(res:str):
+    '''Parse and validate the action of a completion once, return `(action, error)`.'''
+    try:
+        return load_and_validate_action(res), None
+    except Exception as e:
+        return None, e
+
+def _parse_react_action(res:str):
+    '''Parse and validate the action inside `<act>` of a ReAct completion, return `(action, error)`.'''
     try:
-        action:dict = load_and_validate_action(res)
+        act_str = re.search(r'<act>(.*?)</act>', res, re.DOTALL).group(1).strip()
+    except Exception as e:
+        return None, e
+    return _parse_action(act_str)
+
+def _dist_score(dist_scores, key, pred_loc, gt_loc, reso, bbox):
+    # scores computed for the whole chunk by `_batch_dist_scores`
+    if dist_scores is not None and key in dist_scores:
+        return dist_scores[key]
+    return calculate_dist_score(pred_loc, gt_loc, reso, bbox)
+
+def _action_schema_check(res:str,solution: dict = None, parsed=None):
+    action, error = parsed if parsed is not None else _parse_action(res)
+    if error is None:
         if "```json" in res:
             return 0.5
         return 1.0
-    except jsonschema.ValidationError as e:
+    if isinstance(error, jsonschema.ValidationError):
         return 0.3
-    except Exception as e:
-        return 0.0
+    return 0.0
 
 def action_schema_check(completions, **kwargs):
-    global global_executor
-    futures = [global_executor.submit(_action_schema_check,completion[0]["content"],) for completion in completions]
-    scores = []
-    for future in futures:
-        try:
-            scores.append(future.result(timeout=5)*0.3)
-        except TimeoutError as e:
-            print("Timeout while checking schema.")
-            scores.append(0.0)
-
-    return scores
-
-def _action_type_check(res:str, solution: dict):
+    return component_engine("schema")(completions, **kwargs)[:, 0].tolist()
+
+def _action_type_check(res:str, solution: dict, parsed=None):
     if isinstance(solution,str):
         return difflib.SequenceMatcher(None, res,solution).ratio()
     try:
-        action = load_and_validate_action(res)
+        action, error = parsed if parsed is not None else _parse_action(res)
+        if error is not None:
+            raise error
         # if not ("thought" in action or "think" in action or res.startswith("//") or res.startswith("/*")):
         #     raise Exception("No think.")
         action_keys = set(action.keys())
@@ -89,23 +147,15 @@ def _action_type_check(res:str, solution: dict):
     
 
 def action_type_check(completions, solution: list[dict], **kwargs):
-    global global_executor
-    futures = [global_executor.submit(_action_type_check,completion[0]["content"],sol) for completion,sol in zip(completions,solution)]
-    scores = []
-    for future in futures:
-        try:
-            scores.append(future.result(timeout=5))
-        except TimeoutError as e:
-            print("Timeout while checking type.")
-            scores.append(0.0)
-
-    return scores
-
-def _action_args_check(res:str, solution: dict, reso: tuple, bbox: list[list]):
+    return component_engine("type")(completions, solution=solution, **kwargs)[:, 0].tolist()
+
+def _action_args_check(res:str, solution: dict, reso: tuple, bbox: list[list], parsed=None, dist_scores=None):
     if isinstance(solution,str):
         return difflib.SequenceMatcher(None, res,solution).ratio()
     try:
-        action = load_and_validate_action(res)
+        action, error = parsed if parsed is not None else _parse_action(res)
+        if error is not None:
+            raise error
         # if not ("thought" in action or "think" in action or res.startswith("//") or res.startswith("/*")):
         #     raise Exception("No think.")
         action_keys = set(action.keys())
@@ -151,7 +201,7 @@ def _action_args_check(res:str, solution: dict, reso: tuple, bbox: list[list]):
         sub_score = 0
         match k:
             case "POINT":
-                sub_score += calculate_dist_score(action[k], solution[k], reso, bbox[0])
+                sub_score += _dist_score(dist_scores, k, action[k], solution[k], reso, bbox[0])
             
             case "duration":
                 if action[k] > 150 and action[k] <= 5000:
@@ -169,7 +219,7 @@ def _action_args_check(res:str, solution: dict, reso: tuple, bbox: list[list]):
                 if isinstance(solution[k], list):
                     # point direction
                     if isinstance(action[k],list):
-                        sub_score += calculate_dist_score(action[k], solution[k], reso, bbox[1])
+                        sub_score += _dist_score(dist_scores, k, action[k], solution[k], reso, bbox[1])
                     else:
                         sub_score -= 0
                         # print(f"Invalid to for direction {solution[k]}: ", action[k])
@@ -208,20 +258,9 @@ def _action_args_check(res:str, solution: dict, reso: tuple, bbox: list[list]):
     
 
 def action_args_check(completions, solution: list[dict], resolution, bboxs,**kwargs):
-    global global_executor
-    futures = [global_executor.submit(_action_args_check,completion[0]["content"],sol,reso,bbox) for completion,sol,reso,bbox in zip(completions,solution,resolution,bboxs)]
-
-    scores = []
-    for future in futures:
-        try:
-            scores.append(future.result(timeout=5))
-        except TimeoutError as e:
-            print("Timeout while checking type.")
-            scores.append(0.0)
-
-    return scores
+    return component_engine("args")(completions, solution=solution, resolution=resolution, bboxs=bboxs, **kwargs)[:, 0].tolist()
 
-def _react_check(res:str, solution: dict, reso: tuple, bbox: list[list], step_id):
+def _react_check(res:str, solution: dict, reso: tuple, bbox: list[list], step_id, parsed=None, dist_scores=None):
     if isinstance(solution,str):
         return difflib.SequenceMatcher(None, res,solution).ratio()
     
@@ -253,8 +292,9 @@ def _react_check(res:str, solution: dict, reso: tuple, bbox: list[list], step_id
     
     # check the action
     try:
-        act_str = re.search(r'<act>(.*?)</act>', res, re.DOTALL).group(1).strip()
-        action = load_and_validate_action(act_str)
+        action, error = parsed if parsed is not None else _parse_react_action(res)
+        if error is not None:
+            raise error
     except:
         return - 1.0
     
@@ -274,7 +314,7 @@ def _react_check(res:str, solution: dict, reso: tuple, bbox: list[list], step_id
         sub_score = 0
         match k:
             case "POINT":
-                sub_score += calculate_dist_score(action[k], solution[k], reso, bbox[0])
+                sub_score += _dist_score(dist_scores, k, action[k], solution[k], reso, bbox[0])
             
             case "duration":
                 if action[k] > 150 and action[k] <= 5000:
@@ -292,7 +332,7 @@ def _react_check(res:str, solution: dict, reso: tuple, bbox: list[list], step_id
                 if isinstance(solution[k], list):
                     # point direction
                     if isinstance(action[k],list):
-                        sub_score += calculate_dist_score(action[k], solution[k], reso, bbox[1])
+                        sub_score += _dist_score(dist_scores, k, action[k], solution[k], reso, bbox[1])
                     else:
                         sub_score -= 0
                         # print(f"Invalid to for direction {solution[k]}: ", action[k])
@@ -332,68 +372,264 @@ def _react_check(res:str, solution: dict, reso: tuple, bbox: list[list], step_id
     
 
 def react_check(completions, solution: list[dict], resolution, bboxs, step_id, **kwargs):
-    global global_executor
-    futures = [global_executor.submit(_react_check,completion[0]["content"],sol,reso,bbox,step) for completion,sol,reso,bbox,step in zip(completions,solution,resolution,bboxs,step_id)]
+    return component_engine("react")(
+        completions, solution=solution, resolution=resolution, bboxs=bboxs, step_id=step_id, **kwargs
+    )[:, 0].tolist()
+
+action_schema_check.reward_name = "schema"
+action_type_check.reward_name = "type"
+action_args_check.reward_name = "args"
+react_check.reward_name = "react"
+
+# score of each reward component when its evaluation times out
+REWARD_TIMEOUT_SCORES = {"schema": 0.0, "type": 0.0, "args": 0.0, "react": -1.0}
 
-    scores = []
-    for future in futures:
-        try:
-            scores.append(future.result(timeout=5))
-        except TimeoutError as e:
-            print("Timeout while checking type.")
-            scores.append(-1.0)
+# engines of the per-function API, kept across calls for their memo and stats
+_component_engines = {}
+
+def component_engine(name: str) -> "RewardEngine":
+    '''The `RewardEngine` scoring the single component `name`, built on first use and shared by all callers.'''
+    engine = _component_engines.get(name, None)
+    if engine is None:
+        engine = _component_engines[name] = RewardEngine([name])
+    return engine
+
+def _point_pairs(action, solution, reso, bbox):
+    '''The `(key, pred, gt, size, bbox)` point sub-scores of an action, see `_action_args_check`.'''
+    if not isinstance(action, dict) or not isinstance(solution, dict) or reso is None:
+        return []
+    pairs = []
+    if "POINT" in solution and "POINT" in action:
+        pairs.append(("POINT", action["POINT"], solution["POINT"], reso[0], bbox[0]))
+    if isinstance(solution.get("to", None), list) and isinstance(action.get("to", None), list):
+        pairs.append(("to", action["to"], solution["to"], reso[0], bbox[1]))
+    return pairs
+
+def _batch_dist_scores(samples, parsed):
+    '''Distance scores of the point sub-scores of a chunk in one vectorized call, a dict per sample.'''
+    dist_scores = [{} for _ in samples]
+    index, preds, gts, sizes, bboxes = [], [], [], [], []
+    for idx, ((res, solution, reso, bbox, step_id), p) in enumerate(zip(samples, parsed)):
+        if p is None or p[1] is not None:
+            continue
+        for key, pred, gt, size, b in _point_pairs(p[0], solution, reso, bbox):
+            index.append((idx, key))
+            preds.append(pred)
+            gts.append(gt)
+            sizes.append(size)
+            bboxes.append(b)
+    if not index:
+        return dist_scores
+    try:
+        scores = calculate_dist_scores(preds, gts, sizes, bboxes_to_array(bboxes))
+    except (TypeError, ValueError):
+        # malformed ground truth, score the points one by one where they are needed
+        return dist_scores
+    for (idx, key), score in zip(index, scores.tolist()):
+        dist_scores[idx][key] = score
+    return dist_scores
+
+def _evaluate_chunk(names, samples):
+    '''Scores of a chunk of samples, together with the seconds spent in parsing and in each component.'''
+    if _busy_since is None:
+        return _evaluate_samples(names, samples)
+    _busy_since[_worker_slot] = time.time()
+    try:
+        return _evaluate_samples(names, samples)
+    finally:
+        _busy_since[_worker_slot] = 0.0
+
+def _evaluate_samples(names, samples):
+    timings = dict.fromkeys(["parse", *names], 0.0)
+    start = time.perf_counter()
+    # the actions are parsed and validated once for all components
+    parsed = [
+        _parse_action(res)
+        if "schema" in names or (not isinstance(solution, str) and ("type" in names or "args" in names)) else None
+        for res, solution, *_ in samples
+    ]
+    react_parsed = [
+        _parse_react_action(res.strip()) if "react" in names and not isinstance(solution, str) else None
+        for res, solution, *_ in samples
+    ]
+    dist_scores = _batch_dist_scores(samples, parsed) if "args" in names else [None] * len(samples)
+    react_dist_scores = _batch_dist_scores(samples, react_parsed) if "react" in names else [None] * len(samples)
+    timings["parse"] = time.perf_counter() - start
+
+    results = []
+    for idx, (res, solution, reso, bbox, step_id) in enumerate(samples):
+        scores = []
+        for name in names:
+            start = time.perf_counter()
+            match name:
+                case "schema":
+                    scores.append(_action_schema_check(res, solution, parsed[idx]) * 0.3)
+                case "type":
+                    scores.append(_action_type_check(res, solution, parsed[idx]))
+                case "args":
+                    scores.append(_action_args_check(res, solution, reso, bbox, parsed[idx], dist_scores[idx]))
+                case "react":
+                    scores.append(_react_check(res, solution, reso, bbox, step_id, react_parsed[idx], react_dist_scores[idx]))
+                case _:
+                    raise ValueError(f"Unknown reward component {name}")
+            timings[name] += time.perf_counter() - start
+        results.append(scores)
+    return results, timings
+
+def _sample_key(sample) -> bytes:
+    '''Hash of the completion text together with the solution, resolution, bbox and step of a sample.'''
+    return hashlib.blake2b(json.dumps(sample, sort_keys=True, default=str).encode(), digest_size=16).digest()
+
+class RewardEngine:
+    '''Evaluates several reward components of a batch of completions in one pass.
+
+    Each completion is parsed and validated once and shared by the components, and the batch is sent to
+    the worker pool in chunks of `chunk_size` samples instead of one future per completion and reward.
+
+    All chunks share a single deadline of `timeout` seconds, so a batch never waits longer than that for
+    its rewards. Chunks missing the deadline get the timeout scores. With a `RewardExecutor`, a pool with a
+    worker evaluating the same chunk for more than `hang_timeout` seconds is considered hung: its workers are
+    killed and the pool replaced, while chunks merely queued behind a slow batch are left to finish. Other
+    pools are replaced whenever a chunk past the deadline can not be cancelled. After each call `stats` holds the
+    latency of the batch, the seconds spent in each component and the number of timed out samples.
+
+    Identical samples, e.g. byte-identical completions of a group, are scored once: the scores are memoized
+    in an LRU of `cache_size` entries keyed by `_sample_key`, and `stats` holds the hit rate of the batch.
+    Timeout scores are never memoized.
+
+    Args:
+        names: Reward components, any of `schema`, `type`, `args` and `react`.
+        executor: Pool evaluating the chunks, defaults to the module pool.
+        chunk_size: Number of samples sent to a worker at once.
+        timeout: Seconds to wait for the whole batch before assigning the timeout scores to the missing samples.
+        cache_size: Number of memoized sample scores, 0 disables the memoization.
+        hang_timeout: Seconds a worker may spend on one chunk before its pool is recycled, defaults to `timeout`.
+    '''
+    def __init__(
+        self,
+        names: list[str],
+        executor: ProcessPoolExecutor = None,
+        chunk_size: int = 8,
+        timeout: float = 10,
+        cache_size: int = 4096,
+        hang_timeout: float = None,
+    ):
+        for name in names:
+            if name not in REWARD_TIMEOUT_SCORES:
+                raise ValueError(f"Unknown reward component {name}")
+        self.names = list(names)
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.hang_timeout = hang_timeout if hang_timeout is not None else timeout
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.stats = {}
+
+    def _recycle(self):
+        global global_executor
+        if self.executor is not None:
+            self.executor = recycle_executor(self.executor)
+        else:
+            global_executor = recycle_executor(global_executor)
+
+    def __call__(self, completions, solution=None, resolution=None, bboxs=None, step_id=None, **kwargs) -> np.ndarray:
+        '''Return the `[B, len(names)]` scores of the completions.'''
+        start_time = time.perf_counter()
+        num = len(completions)
+        samples = list(zip(
+            [completion[0]["content"] for completion in completions],
+            solution if solution is not None else [None] * num,
+            resolution if resolution is not None else [None] * num,
+            bboxs if bboxs is not None else [[None, None]] * num,
+            step_id if step_id is not None else [0] * num,
+        ))
+        keys = [_sample_key(sample) for sample in samples] if self.cache_size > 0 else list(range(num))
+        # scores of every distinct sample, evaluating only the ones missing from the memo
+        known, pending = {}, {}
+        for key, sample in zip(keys, samples):
+            if key in known or key in pending:
+                continue
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                known[key] = self.cache[key]
+            else:
+                pending[key] = sample
+
+        stats = {}
+        evaluated, timed_out = self._evaluate(list(pending.values()), stats)
+        for key, scores, missing in zip(pending, evaluated, timed_out):
+            known[key] = scores
+            if self.cache_size > 0 and not missing:
+                self.cache[key] = scores
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        timed_out = {key for key, missing in zip(pending, timed_out) if missing}
+        self.stats = {
+            "rewards/latency": time.perf_counter() - start_time,
+            "rewards/timeouts": sum(key in timed_out for key in keys),
+            "rewards/memo_hit_rate": 1 - len(pending) / num if num > 0 else 0.0,
+            **stats,
+        }
+        return np.array([known[key] for key in keys], dtype=np.float64).reshape(num, len(self.names))
+
+    def _evaluate(self, samples: list, stats: dict):
+        '''Scores of the samples on the pool, and whether each sample got the timeout scores.'''
+        executor = self.executor if self.executor is not None else global_executor
+        num = len(samples)
+        futures = {
+            executor.submit(_evaluate_chunk, self.names, samples[start:start + self.chunk_size]): start
+            for start in range(0, num, self.chunk_size)
+        }
+        done, not_done = wait(futures, timeout=self.timeout) if futures else (set(), set())
+
+        scores = np.empty((num, len(self.names)), dtype=np.float64)
+        timed_out = np.zeros(num, dtype=bool)
+        timings = dict.fromkeys(["parse", *self.names], 0.0)
+        broken = False
+        error = None
+        for future, start in futures.items():
+            end = min(start + self.chunk_size, num)
+            exception = future.exception() if future in done else None
+            if future in done and exception is None:
+                chunk_scores, chunk_timings = future.result()
+                scores[start:end] = chunk_scores
+                for name, seconds in chunk_timings.items():
+                    timings[name] += seconds
+                continue
+            if isinstance(exception, BrokenProcessPool):
+                broken = True
+            elif exception is not None:
+                error = exception
+            scores[start:end] = [REWARD_TIMEOUT_SCORES[name] for name in self.names]
+            timed_out[start:end] = True
+
+        # pending chunks are dropped, chunks already handed to the workers are left to finish unless a worker hangs
+        uncancelled = [future for future in not_done if not future.cancel()]
+        if isinstance(executor, RewardExecutor):
+            hung = executor.hung_workers(self.hang_timeout)
+        else:
+            hung = len(uncancelled)
+        if hung or broken:
+            print(f"Reward workers hung or died on {timed_out.sum()} samples, recycling the pool.")
+            self._recycle()
+        elif timed_out.any() and error is None:
+            print(f"Timeout while evaluating rewards of {timed_out.sum()} samples.")
+
+        stats["rewards/recycled"] = float(bool(hung or broken))
+        stats.update({f"rewards/latency/{name}": seconds for name, seconds in timings.items()})
+        if error is not None:
+            raise error
+        return scores, timed_out
 
-    return scores
 
 def calculate_manhattan_distance(x1, y1, x2, y2):
     return abs(x1 - x2) + abs(y1 - y2)
 
-def calculate_dist_score(pred_loc: list[list[int,int]], gt_loc: list[int,int], res: tuple[int,int], bbox: list[int]):    
-    x_ratio = pred_loc[0]/1000
-    y_ratio = pred_loc[1]/1000
-    
-    gt_x, gt_y = gt_loc
-    gt_x_ratio = gt_x /1000
-    gt_y_ratio = gt_y /1000
-    
+def calculate_dist_score(pred_loc: list[list[int,int]], gt_loc: list[int,int], res: tuple[int,int], bbox: list[int]):
     origin_res, now_res = res
-    origin_w, origin_h = origin_res
-    now_w, now_h = now_res
-    
-    abs_x = int(x_ratio * origin_w)
-    abs_y = int(y_ratio * origin_h)
-    gt_abs_x = int(gt_x_ratio * origin_w)
-    gt_abs_y = int(gt_y_ratio * origin_h)
-    tolerance = 0.05
-    
-    if bbox is None or not isinstance(bbox, list):
-        # print("No bbox provided.")
-        # let assume the bbox is 1%x1% windows
-        if ((gt_x_ratio - 1e-2) <= x_ratio <= (gt_x_ratio + 1e-2)) and ((gt_y_ratio - 1e-2) <= y_ratio <= (gt_y_ratio + 1e-2)):
-            dist_score =  1.0
-        # elif ((gt_x_ratio - tolerance) <= x_ratio <= (gt_x_ratio + tolerance)) and ((gt_y_ratio - tolerance) <= y_ratio <= (gt_y_ratio + tolerance)):
-        #     dist_score =  0.3
-        else:
-            # dist_score = -1
-            dist_score = 1 - calculate_manhattan_distance(x_ratio, y_ratio, gt_x_ratio, gt_y_ratio) / 2
-    
-    else:
-        left_top = bbox[0]
-        right_bottom = bbox[1]
-        
-        if (left_top[0] <= abs_x <= right_bottom[0]) and (left_top[1] <= abs_y <= right_bottom[1]):
-            dist_score = 0.95
-            # remain 0.1 for centering
-            max_delta = max(abs(abs_x - (left_top[0] + right_bottom[0]) / 2), abs(abs_y - (left_top[1] + right_bottom[1]) / 2))
-            dist_score += 0.05 * ((1 - max_delta / 1000)**3)
-        # elif ((left_top[0] - tolerance*origin_w) <= abs_x <= (right_bottom[0] + tolerance*origin_w )) and ((left_top[1] - tolerance*origin_h) <= abs_y <= right_bottom[1] + tolerance*origin_h):
-        #     dist_score = 0.3
-        else:
-            # print(f"Point {(x_ratio,y_ratio)} {[abs_x,abs_y]} out of Bbox {[left_top, right_bottom]}, GT: {(gt_x_ratio,gt_y_ratio)} {[gt_abs_x,gt_abs_y]}")
-            # dist_score = -1
-            dist_score = 1 - calculate_manhattan_distance(x_ratio, y_ratio, gt_x_ratio, gt_y_ratio) / 2
-    
-    return dist_score
+    return calculate_dist_scores([pred_loc], [gt_loc], [origin_res], bboxes_to_array([bbox]))[0].item()
     
     # origin_res, now_res = res
     # origin_w, origin_h = origin_res
@@ -0,0 +1,219 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+from types import MethodType
+from typing import Optional
+from contextlib import contextmanager
+from torch.utils.checkpoint import checkpoint
+from transformers import LogitsProcessor
+
+
+def _chunk_logps(hidden_states, weight, bias, target_ids):
+    logits = F.linear(hidden_states, weight, bias).float()
+    target_logits = logits.gather(dim=-1, index=target_ids.unsqueeze(-1)).squeeze(-1)
+    return target_logits - logits.logsumexp(dim=-1)
+
+
+def selective_log_softmax(hidden_states, weight, bias, target_ids, chunk_size: int = 64):
+    '''Log-probabilities of `target_ids` under `F.linear(hidden_states, weight, bias)`.
+
+    The logits are computed in chunks of `chunk_size` positions and recomputed during backward, so at most
+    one `[B, chunk_size, V]` logits tensor is alive at any time.
+
+    Args:
+        hidden_states: `[B, T, H]` hidden states of the positions predicting `target_ids`.
+        weight, bias: Parameters of the output projection.
+        target_ids: `[B, T]` token ids.
+    '''
+    per_token_logps = []
+    for start in range(0, target_ids.size(1), chunk_size):
+        args = (hidden_states[:, start:start + chunk_size], weight, bias, target_ids[:, start:start + chunk_size])
+        if torch.is_grad_enabled():
+            per_token_logps.append(checkpoint(_chunk_logps, *args, use_reentrant=False))
+        else:
+            per_token_logps.append(_chunk_logps(*args))
+    return torch.cat(per_token_logps, dim=1)
+
+
+class SampledLogpsRecorder(LogitsProcessor):
+    '''Records the logprobs of the sampled tokens during `generate`, without changing the scores.
+
+    Logits processors run before sampling, so the token sampled at a step is only known at the next call, as
+    the last column of `input_ids`. Only the scores of the previous step are kept until then, instead of the
+    `[B, V]` logits of every step kept by `output_logits=True`. Put it before the other processors to record
+    the unprocessed logits, and call `finish` with the generated sequences to record the last step.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.step_logps = []
+        self.last_scores = None
+        self.last_logsumexp = None
+
+    def _record(self, tokens: torch.Tensor):
+        target_scores = self.last_scores.gather(dim=-1, index=tokens[:, None]).squeeze(-1).float()
+        self.step_logps.append(target_scores - self.last_logsumexp)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.last_scores is not None:
+            self._record(input_ids[:, -1])
+        # the following processors may update the scores in place
+        self.last_scores = scores.clone()
+        self.last_logsumexp = scores.float().logsumexp(dim=-1)
+        return scores
+
+    def finish(self, sequences: torch.Tensor) -> torch.Tensor:
+        '''Return the `[B, T]` logprobs of the last `T` tokens of `sequences`, one per recorded step.'''
+        if self.last_scores is not None:
+            self._record(sequences[:, -1])
+        logps = torch.stack(self.step_logps, dim=1)
+        self.reset()
+        return logps
+
+
+def get_lm_head(model: nn.Module) -> nn.Module:
+    '''Find the output projection of a (wrapped) causal or vision-language model.'''
+    while hasattr(model, "module") and not hasattr(model, "get_output_embeddings"):
+        model = model.module
+    llm = getattr(model, "llm", model)
+    return llm.get_output_embeddings()
+
+
+@contextmanager
+def selective_logps(model: nn.Module, target_ids: torch.Tensor, chunk_size: int = 64, positions: Optional[torch.Tensor] = None):
+    '''Make the forward of `model` return the log-probabilities of `target_ids` in place of the logits.
+
+    The output projection is replaced to project only the `T = target_ids.size(1)` positions predicting
+    the targets, i.e. the hidden states `[-T-1:-1]` or `positions` if given, in chunks. The projection still
+    runs inside the forward of the model, so sharded parameters are gathered by the usual FSDP hooks. The
+    `logits` of the output are `[B, T]` log-probabilities.
+    '''
+    lm_head = get_lm_head(model)
+    num_targets = target_ids.size(1)
+
+    def forward(self, hidden_states):
+        if positions is None:
+            hidden_states = hidden_states[:, -num_targets - 1:-1]
+        else:
+            hidden_states = hidden_states[:, positions]
+        return selective_log_softmax(hidden_states, self.weight, self.bias, target_ids, chunk_size)
+
+    patched = lm_head.__dict__.get("forward", None)
+    lm_head.forward = MethodType(forward, lm_head)
+    try:
+        yield
+    finally:
+        if patched is None:
+            del lm_head.forward
+        else:
+            lm_head.forward = patched
+
+
+def _pack_inputs(inputs: dict, logits_to_keep: int):
+    '''Pack the unpadded sequences of a batch into a single row for varlen flash attention.
+
+    Returns the packed model inputs, the flash attention arguments, and the indices `(sample, completion
+    position)` of the completion tokens together with the positions in the row predicting them.
+    '''
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"].bool()
+    prompt_len = input_ids.size(1) - logits_to_keep
+    lengths = attention_mask.sum(dim=1)
+    cu_seqlens = F.pad(lengths.cumsum(dim=0), (1, 0)).to(torch.int32)
+    # position of every kept token in the packed row
+    positions_in_sample = attention_mask.long().cumsum(dim=1) - 1
+    packed_index = positions_in_sample + cu_seqlens[:-1, None].long()
+
+    image_bound, tgt_sizes, images = [], [], []
+    vision_key = "vision_hidden_states" if "vision_hidden_states" in inputs else "pixel_values"
+    for idx, bound in enumerate(inputs["image_bound"]):
+        if len(bound) > 0:
+            bound = bound.to(packed_index.device)
+            # bounds are `[start, end)`, map the last image token to keep the end exclusive
+            image_bound.append(torch.stack([packed_index[idx, bound[:, 0]], packed_index[idx, bound[:, 1] - 1] + 1], dim=1))
+        if isinstance(inputs["tgt_sizes"][idx], torch.Tensor) and len(inputs["tgt_sizes"][idx]) > 0:
+            tgt_sizes.append(inputs["tgt_sizes"][idx])
+        images.append(inputs[vision_key][idx])
+    if vision_key == "pixel_values":
+        images = [pixel_values for sample in images for pixel_values in sample]
+    else:
+        images = [v for v in images if len(v) > 0]
+        images = torch.cat(images) if images else []
+    data = {
+        "input_ids": input_ids[attention_mask][None],
+        "image_bound": [torch.cat(image_bound) if image_bound else torch.zeros((0, 2), dtype=torch.long)],
+        "tgt_sizes": [torch.cat(tgt_sizes) if tgt_sizes else []],
+        vision_key: [images],
+        "position_ids": positions_in_sample[attention_mask][None],
+    }
+    max_length = int(lengths.max())
+    flash_attn_kwargs = {
+        "cu_seq_lens_q": cu_seqlens,
+        "cu_seq_lens_k": cu_seqlens,
+        "max_length_q": max_length,
+        "max_length_k": max_length,
+    }
+
+    sample_idx, completion_idx = attention_mask[:, prompt_len:].nonzero(as_tuple=True)
+    target_positions = packed_index[sample_idx, prompt_len + completion_idx] - 1
+    return data, flash_attn_kwargs, (sample_idx, completion_idx), target_positions
+
+
+def compute_per_token_logps(
+    model: nn.Module,
+    inputs: dict,
+    logits_to_keep: int,
+    chunk_size: int = 64,
+    prepare_inputs=None,
+    pack: bool = False,
+):
+    '''Log-probabilities of the last `logits_to_keep` tokens (the completion) of `inputs["input_ids"]`.
+
+    Args:
+        model: A MiniCPM-V style model taking `data` in its forward.
+        inputs: Processed prompt inputs with the completion appended, see `_create_inputs`.
+        prepare_inputs: Optional function moving the model inputs to the device.
+        pack: Whether to run the forward on the sequences packed into a single row without padding, see
+            `_pack_inputs`. Requires flash attention. The padded positions of the output are zero.
+    '''
+    if pack:
+        return _compute_packed_logps(model, inputs, logits_to_keep, chunk_size, prepare_inputs)
+
+    attention_mask = inputs["attention_mask"]
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    data = {
+        "input_ids": inputs["input_ids"],
+        "image_bound": inputs["image_bound"],
+        "tgt_sizes": inputs["tgt_sizes"],
+        "attention_mask": attention_mask,
+        "position_ids": position_ids,
+    }
+    if "vision_hidden_states" in inputs:
+        # outputs of the frozen vision encoder cached at sampling time
+        data["vision_hidden_states"] = inputs["vision_hidden_states"]
+    else:
+        data["pixel_values"] = inputs["pixel_values"]
+    if prepare_inputs is not None:
+        data = prepare_inputs(data)
+
+    target_ids = data["input_ids"][:, -logits_to_keep:]
+    with selective_logps(model, target_ids, chunk_size=chunk_size):
+        return model(data=data, use_cache=False).logits
+
+
+def _compute_packed_logps(model, inputs, logits_to_keep, chunk_size, prepare_inputs):
+    data, flash_attn_kwargs, (sample_idx, completion_idx), target_positions = _pack_inputs(inputs, logits_to_keep)
+    if prepare_inputs is not None:
+        data = prepare_inputs(data)
+    device = data["input_ids"].device
+    flash_attn_kwargs["cu_seq_lens_q"] = flash_attn_kwargs["cu_seq_lens_k"] = flash_attn_kwargs["cu_seq_lens_q"].to(device)
+    sample_idx, completion_idx, target_positions = sample_idx.to(device), completion_idx.to(device), target_positions.to(device)
+
+    target_ids = data["input_ids"][:, target_positions + 1]
+    with selective_logps(model, target_ids, chunk_size=chunk_size, positions=target_positions):
+        packed_logps = model(data=data, use_cache=False, **flash_attn_kwargs).logits[0]
+    # back to `[B, logits_to_keep]`, the loss keeps normalizing each sample over its own completion
+    per_token_logps = packed_logps.new_zeros((inputs["input_ids"].size(0), logits_to_keep))
+    return per_token_logps.index_put((sample_idx, completion_idx), packed_logps)
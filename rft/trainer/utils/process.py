@@ -1,5 +1,6 @@
 import torch
 import copy
+import hashlib
 from PIL import Image
 
 def _prepare_messages(
@@ -45,6 +46,64 @@ def _prepare_messages(
         **ret
     }
 
+def _prompt_key(task_id, prompt):
+    '''Key of a prompt shared by the sibling completions of a task.
+
+    Multi-turn prompts of the same task may carry different history completions, so the text
+    content is hashed together with the task id. Images are determined by the task id.
+    '''
+    h = hashlib.sha1()
+    for msg in prompt:
+        content = msg["content"]
+        if isinstance(content, str):
+            content = [content]
+        h.update(msg["role"].encode())
+        for c in content:
+            if isinstance(c, str):
+                h.update(c.encode())
+            else:
+                h.update(b"<image>")
+    return (task_id, h.hexdigest())
+
+def _prepare_prompt(
+    prompt,
+    processing_class,
+    max_prompt_length
+):
+    '''Process a single prompt into unpadded model inputs, see `_collate_prompts`.
+
+    A prompt sent with the outputs of the vision encoder, i.e. `{"messages": ..., "vision_hidden_states": ...}`,
+    keeps them in place of the `pixel_values`, so the model does not encode its images again.
+    '''
+    vision_hidden_states = None
+    if isinstance(prompt, dict) and "vision_hidden_states" in prompt:
+        vision_hidden_states = prompt["vision_hidden_states"]
+        prompt = prompt["messages"]
+    ret = _prepare_messages([prompt], processing_class, max_prompt_length)
+    ret = {k: v[0] for k, v in ret.items()}
+    if vision_hidden_states is not None:
+        ret.pop("pixel_values", None)
+        ret["vision_hidden_states"] = vision_hidden_states
+    return ret
+
+def _collate_prompts(prepared):
+    '''Left pad the outputs of `_prepare_prompt` into a batch, the same way the processor pads.'''
+    max_len = max(p["input_ids"].size(0) for p in prepared)
+    input_ids = torch.zeros((len(prepared), max_len), dtype=prepared[0]["input_ids"].dtype)
+    attention_mask = torch.zeros((len(prepared), max_len), dtype=prepared[0]["attention_mask"].dtype)
+    ret = {"input_ids": input_ids, "attention_mask": attention_mask}
+    for idx, p in enumerate(prepared):
+        length = p["input_ids"].size(0)
+        input_ids[idx, max_len - length:] = p["input_ids"]
+        attention_mask[idx, max_len - length:] = p["attention_mask"]
+        for k, v in p.items():
+            if k in ("input_ids", "attention_mask"):
+                continue
+            if k == "image_bound":
+                v = v + (max_len - length)
+            ret.setdefault(k, []).append(v)
+    return ret
+
 def _create_inputs(
     processing_class,
     prompt_inputs,
@@ -77,7 +136,8 @@ def _create_inputs(
 def _process_inputs(
     inputs, 
     processing_class,
-    max_prompt_length
+    max_prompt_length,
+    prepared_prompts = None
 ):
     prompts = []
     completions = []
@@ -85,27 +145,44 @@ def _process_inputs(
     rewards = []
     ids = []
     step_ids = []
+    policy_versions = []
+    behavior_logps = []
     for inp in inputs:
         ids.append(inp["id"])
-        prompts.append(inp["prompt"])
+        prompts.append(inp.get("prompt", None))
         completions.append(inp["completion_ids"])
         advantages.append(inp["advantage"])
         rewards.append(inp["reward"])
         step_ids.append(inp.get("step_id",0))
+        policy_versions.append(inp.get("policy_version", None))
+        behavior_logps.append(inp.get("behavior_logps", None))
         
     ids = torch.tensor(ids)
     advantages = torch.tensor(advantages)
     step_ids = torch.tensor(step_ids)
 
-    prompt_inputs = _prepare_messages(prompts,processing_class,max_prompt_length)
+    if prepared_prompts is None:
+        prompt_inputs = _prepare_messages(prompts,processing_class,max_prompt_length)
+    else:
+        # prompts are processed once and shared between sibling completions
+        prompt_inputs = _collate_prompts(prepared_prompts)
     prompt_len = prompt_inputs["input_ids"].size(1)
     prompt_inputs["rewards"] = torch.tensor(rewards)
 
     prompt_inputs,completion_mask = _create_inputs(processing_class,prompt_inputs,completions)
-    return {
+    ret = {
         "prompt_inputs": prompt_inputs,
         "completion_mask": completion_mask,
         "advantages": advantages,
         "prompt_len": prompt_len,
         "step_ids": step_ids
-    }
\ No newline at end of file
+    }
+    if all(v is not None for v in policy_versions):
+        ret["policy_versions"] = torch.tensor(policy_versions)
+    if all(logps is not None for logps in behavior_logps):
+        # logprobs of the sampling policy, aligned with the padded completions
+        old_per_token_logps = torch.zeros(completion_mask.shape, dtype=torch.float32)
+        for idx, logps in enumerate(behavior_logps):
+            old_per_token_logps[idx, :len(logps)] = logps
+        ret["old_per_token_logps"] = old_per_token_logps
+    return ret
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""Vectorized point scoring kernels of the RFT rewards.
+
+The offline evaluator keeps a copy of `points_in_boxes` in `eval/utils/scoring.py`, keep both in sync.
+"""
+import numpy as np
+
+
+def points_in_boxes(points, boxes) -> np.ndarray:
+    '''Whether each point lies inside each box, borders included.
+
+    Args:
+        points: `[N, 2]` points as `(x, y)`.
+        boxes: `[M, 4]` boxes shared by all points or `[N, M, 4]` boxes per point, as `(left, top, right, bottom)`.
+            Boxes with NaN coordinates contain no point.
+
+    Returns:
+        `[N, M]` boolean array.
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if boxes.ndim == 2:
+        boxes = boxes[None]
+    x = points[:, 0, None]
+    y = points[:, 1, None]
+    return (boxes[..., 0] <= x) & (x <= boxes[..., 2]) & (boxes[..., 1] <= y) & (y <= boxes[..., 3])
+
+
+def bboxes_to_array(bboxes) -> np.ndarray:
+    '''Stack `[[left, top], [right, bottom]]` bboxes into `[N, 4]`, with NaN rows for missing bboxes.'''
+    array = np.full((len(bboxes), 4), np.nan, dtype=np.float64)
+    for idx, bbox in enumerate(bboxes):
+        if bbox is not None and isinstance(bbox, list):
+            (left, top), (right, bottom) = bbox
+            array[idx] = (left, top, right, bottom)
+    return array
+
+
+def calculate_dist_scores(pred_points, gt_points, origin_sizes, bboxes) -> np.ndarray:
+    '''Distance scores of a batch of predicted points, in one pass.
+
+    A point inside its ground truth bbox scores 0.95 plus up to 0.05 for being close to the bbox center. A
+    point without bbox scores 1.0 within 1% of the ground truth point. Otherwise the score is one minus half
+    the Manhattan distance to the ground truth point, in screen ratios.
+
+    Args:
+        pred_points: `[N, 2]` predicted points, scaled to 0~1000.
+        gt_points: `[N, 2]` ground truth points, scaled to 0~1000.
+        origin_sizes: `[N, 2]` sizes `(width, height)` of the original screenshots.
+        bboxes: `[N, 4]` ground truth bboxes in pixels of the original screenshot, see `bboxes_to_array`.
+
+    Returns:
+        `[N]` float64 scores.
+    '''
+    pred_ratio = np.asarray(pred_points, dtype=np.float64).reshape(-1, 2) / 1000
+    gt_ratio = np.asarray(gt_points, dtype=np.float64).reshape(-1, 2) / 1000
+    origin_sizes = np.asarray(origin_sizes, dtype=np.float64).reshape(-1, 2)
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+
+    # absolute pixels are truncated like `int()`
+    abs_points = np.trunc(pred_ratio * origin_sizes)
+    has_bbox = ~np.isnan(bboxes).any(axis=1)
+    inside = points_in_boxes(abs_points, bboxes[:, None])[:, 0] & has_bbox
+
+    centers = np.stack([(bboxes[:, 0] + bboxes[:, 2]) / 2, (bboxes[:, 1] + bboxes[:, 3]) / 2], axis=1)
+    max_delta = np.abs(abs_points - centers).max(axis=1)
+    inside_score = 0.95 + 0.05 * ((1 - max_delta / 1000) ** 3)
+
+    near_gt = ((gt_ratio - 1e-2 <= pred_ratio) & (pred_ratio <= gt_ratio + 1e-2)).all(axis=1) & ~has_bbox
+    dist_score = 1 - np.abs(pred_ratio - gt_ratio).sum(axis=1) / 2
+
+    return np.where(inside, inside_score, np.where(near_gt, 1.0, dist_score))
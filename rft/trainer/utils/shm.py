@@ -0,0 +1,100 @@
+import os
+import glob
+import uuid
+import torch
+
+
+class _TensorRef:
+    '''Location of a tensor inside the file of a `SharedChunk`.'''
+    __slots__ = ("offset", "dtype", "shape")
+
+    def __init__(self, offset: int, dtype: torch.dtype, shape: torch.Size):
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+
+    def __getstate__(self):
+        return (self.offset, self.dtype, tuple(self.shape))
+
+    def __setstate__(self, state):
+        self.offset, self.dtype, self.shape = state
+
+
+class SharedChunk:
+    '''A chunk of training data whose tensors are written once into a file on a tmpfs such as `/dev/shm`.
+
+    Pickling only carries the structure of the chunk and the offsets of its tensors. Each process calling
+    `load` maps the file privately and gets the tensors as zero-copy views of the mapping, which lives as
+    long as any of them. The file can be unlinked by its owner once every reader has loaded it.
+    '''
+    ALIGNMENT = 64
+
+    def __init__(self, chunk, shm_dir: str = "/dev/shm"):
+        tensors = []
+        self.nbytes = 0
+        self.structure = self._flatten(chunk, tensors)
+        # the pid of the owner lets `sweep_stale_chunks` find the files of dead processes
+        self.path = os.path.join(shm_dir, f"arl_chunk_{os.getpid()}_{uuid.uuid4().hex}")
+        buffer = torch.from_file(self.path, shared=True, size=max(self.nbytes, 1), dtype=torch.uint8)
+        for ref, tensor in tensors:
+            self._view(buffer, ref).copy_(tensor)
+
+    def _flatten(self, obj, tensors: list):
+        if isinstance(obj, torch.Tensor):
+            ref = _TensorRef(self.nbytes, obj.dtype, obj.shape)
+            tensors.append((ref, obj.detach()))
+            size = obj.numel() * obj.element_size()
+            self.nbytes += (size + self.ALIGNMENT - 1) // self.ALIGNMENT * self.ALIGNMENT
+            return ref
+        if isinstance(obj, dict):
+            return {k: self._flatten(v, tensors) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._flatten(v, tensors) for v in obj)
+        return obj
+
+    @staticmethod
+    def _view(buffer: torch.Tensor, ref: _TensorRef) -> torch.Tensor:
+        size = torch.Size(ref.shape).numel() * torch.empty((), dtype=ref.dtype).element_size()
+        return buffer[ref.offset:ref.offset + size].view(ref.dtype).view(ref.shape)
+
+    def _unflatten(self, obj, buffer: torch.Tensor):
+        if isinstance(obj, _TensorRef):
+            return self._view(buffer, obj)
+        if isinstance(obj, dict):
+            return {k: self._unflatten(v, buffer) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._unflatten(v, buffer) for v in obj)
+        return obj
+
+    def load(self):
+        '''Map the file and return the chunk. Writes to the tensors stay private to this process.'''
+        buffer = torch.from_file(self.path, shared=False, size=max(self.nbytes, 1), dtype=torch.uint8)
+        return self._unflatten(self.structure, buffer)
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def sweep_stale_chunks(shm_dir: str) -> int:
+    '''Remove the chunk files left in `shm_dir` by processes which are not running anymore, e.g. killed ones.'''
+    removed = 0
+    for path in glob.glob(os.path.join(shm_dir, "arl_chunk_*")):
+        try:
+            pid = int(os.path.basename(path).split("_")[2])
+            os.kill(pid, 0)
+            continue
+        except (IndexError, ValueError, ProcessLookupError):
+            # files of older versions do not carry a pid
+            pass
+        except PermissionError:
+            # alive, owned by another user
+            continue
+        try:
+            os.unlink(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
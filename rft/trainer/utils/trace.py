@@ -0,0 +1,118 @@
+"""Structured tracing of the trainer, the balancers and the data loaders.
+
+Tracing is enabled by setting `ARL_TRACE_DIR`. Each process then appends its events to
+`<ARL_TRACE_DIR>/<host>-<pid>.trace.json` in the Chrome trace event format (an open JSON array, one event per
+line), which can be opened in Perfetto or `chrome://tracing` and is summarized by `analyze_trace.py`.
+Timestamps are wall clock microseconds, so the files of all processes and hosts line up.
+"""
+import os
+import json
+import time
+import atexit
+import socket
+import threading
+import multiprocessing.util
+from contextlib import contextmanager
+
+
+def _now_us() -> int:
+    return time.time_ns() // 1000
+
+
+class Tracer:
+    '''Buffered writer of Chrome trace events for the current process.
+
+    Does nothing unless `trace_dir` is set. Events are flushed every `flush_every` events or `flush_interval`
+    seconds, and at exit. A forked child starts with an empty buffer and its own file.
+    '''
+    def __init__(self, trace_dir: str = None, flush_every: int = 1024, flush_interval: float = 5.0):
+        self.trace_dir = trace_dir
+        self.enabled = trace_dir is not None
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.host = socket.gethostname()
+        self._reset()
+        if self.enabled:
+            os.makedirs(trace_dir, exist_ok=True)
+            atexit.register(self.flush)
+            os.register_at_fork(after_in_child=self._reset)
+            # forked `multiprocessing` children leave through `os._exit` and skip `atexit`
+            multiprocessing.util.register_after_fork(self, Tracer._register_finalizer)
+
+    def _reset(self):
+        # the lock may have been held by another thread of the parent when it forked
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.buffer = []
+        self.file = None
+        self.named_threads = set()
+        self.last_flush = time.monotonic()
+
+    def _register_finalizer(self):
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=0)
+
+    def set_process_name(self, name: str):
+        '''Name the current process in the trace, e.g. `rank3` or `local_balancer`.'''
+        if self.enabled:
+            self._emit({"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": name}})
+            self._emit({"name": "process_labels", "ph": "M", "pid": self.pid, "tid": 0, "args": {"labels": self.host}})
+
+    def _emit(self, event: dict):
+        tid = threading.get_native_id()
+        with self.lock:
+            if tid not in self.named_threads:
+                self.named_threads.add(tid)
+                self.buffer.append({
+                    "name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                })
+            event.setdefault("tid", tid)
+            self.buffer.append(event)
+            if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush > self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        if self.file is None:
+            self.file = open(os.path.join(self.trace_dir, f"{self.host}-{self.pid}.trace.json"), "a")
+            if self.file.tell() == 0:
+                self.file.write("[\n")
+        self.file.write("".join(json.dumps(event, separators=(",", ":"), default=str) + ",\n" for event in self.buffer))
+        self.file.flush()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    @contextmanager
+    def span(self, name: str, **args):
+        '''Record the duration of the block. Yields `args`, which can be updated with the outcome.'''
+        if not self.enabled:
+            yield args
+            return
+        start = _now_us()
+        try:
+            yield args
+        finally:
+            self._emit({"name": name, "ph": "X", "pid": self.pid, "ts": start, "dur": _now_us() - start, "args": args})
+
+    def complete(self, name: str, start: float, end: float = None, **args):
+        '''Record a span between two `time.time()` timestamps.'''
+        if self.enabled:
+            start = int(start * 1e6)
+            end = _now_us() if end is None else int(end * 1e6)
+            self._emit({"name": name, "ph": "X", "pid": self.pid, "ts": start, "dur": end - start, "args": args})
+
+    def instant(self, name: str, **args):
+        if self.enabled:
+            self._emit({"name": name, "ph": "i", "s": "t", "pid": self.pid, "ts": _now_us(), "args": args})
+
+    def counter(self, name: str, **values):
+        if self.enabled:
+            self._emit({"name": name, "ph": "C", "pid": self.pid, "ts": _now_us(), "args": values})
+
+
+tracer = Tracer(os.environ.get("ARL_TRACE_DIR", None))
@@ -0,0 +1,100 @@
+import json
+import math
+import json5
+import jsonschema
+from .dataset import SCHEMA
+
+
+class _DuplicateKey(ValueError):
+    pass
+
+
+def _no_duplicate_pairs(pairs):
+    obj = dict(pairs)
+    if len(obj) != len(pairs):
+        raise _DuplicateKey()
+    return obj
+
+
+def loads_action(action_str: str):
+    '''Same as `json5.loads(action_str, allow_duplicate_keys=False)`, but tries the much faster `json.loads` first.
+
+    Strict JSON is a subset of JSON5, so anything `json.loads` accepts parses to the same value. Everything
+    else, including duplicated keys, goes through `json5` which raises the same errors as before.
+    '''
+    try:
+        return json.loads(action_str, object_pairs_hook=_no_duplicate_pairs)
+    except ValueError:
+        return json5.loads(action_str, allow_duplicate_keys=False)
+
+
+def _is_integer(value) -> bool:
+    # same as the `integer` type of jsonschema, which accepts integral floats but not booleans
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return True
+    return isinstance(value, float) and math.isfinite(value) and value.is_integer()
+
+
+class ActionValidator:
+    '''Precompiled check of the fixed action `SCHEMA`, equivalent to `jsonschema.validate(action, SCHEMA)`.
+
+    The constraints are read from the schema once. Only the outcome is the same as jsonschema, the
+    `ValidationError` raised on invalid actions carries a shorter message.
+    '''
+    def __init__(self, schema: dict = SCHEMA):
+        properties = schema["properties"]
+        location = schema["$defs"]["Location"]
+        self.allowed_keys = frozenset(properties)
+        self.additional_properties = schema.get("additionalProperties", True)
+        self.location_size = (location["minItems"], location["maxItems"])
+        self.location_range = (location["items"]["minimum"], location["items"]["maximum"])
+        self.directions = tuple(properties["to"]["oneOf"][0]["enum"])
+        self.min_duration = properties["duration"]["minimum"]
+        self.enums = {key: tuple(properties[key]["enum"]) for key in ("PRESS", "STATUS")}
+        self.checks = {
+            "thought": self._check_string,
+            "POINT": self._check_location,
+            "to": self._check_to,
+            "duration": self._check_duration,
+            "PRESS": self._check_enum,
+            "TYPE": self._check_string,
+            "STATUS": self._check_enum,
+        }
+
+    def __call__(self, action):
+        if not isinstance(action, dict):
+            raise jsonschema.ValidationError(f"{action!r} is not of type 'object'")
+        for key, value in action.items():
+            check = self.checks.get(key, None)
+            if check is None:
+                if self.additional_properties is False:
+                    raise jsonschema.ValidationError(f"Additional properties are not allowed ({key!r} was unexpected)")
+                continue
+            if not check(key, value):
+                raise jsonschema.ValidationError(f"{value!r} is not valid under the schema of {key!r}")
+
+    def _check_string(self, key, value) -> bool:
+        return isinstance(value, str)
+
+    def _check_enum(self, key, value) -> bool:
+        return isinstance(value, str) and value in self.enums[key]
+
+    def _check_location(self, key, value) -> bool:
+        if not isinstance(value, list) or not self.location_size[0] <= len(value) <= self.location_size[1]:
+            return False
+        low, high = self.location_range
+        return all(_is_integer(v) and low <= v <= high for v in value)
+
+    def _check_to(self, key, value) -> bool:
+        # `oneOf` a direction or a location, which can never both match
+        if isinstance(value, str):
+            return value in self.directions
+        return self._check_location(key, value)
+
+    def _check_duration(self, key, value) -> bool:
+        return _is_integer(value) and value >= self.min_duration
+
+
+validate_action = ActionValidator()
@@ -0,0 +1,111 @@
+import time
+import torch
+from torch import nn
+from torch.distributed.tensor import DTensor, Replicate
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+
+_WRAPPER_PREFIXES = ("_fsdp_wrapped_module.", "_checkpoint_wrapped_module.", "_orig_mod.")
+
+
+def _clean_name(name: str) -> str:
+    for prefix in _WRAPPER_PREFIXES:
+        name = name.replace(prefix, "")
+    return name
+
+
+class WeightSyncEngine:
+    '''Streams the weights of the training model into the parameters of the inference model.
+
+    Parameters are gathered one at a time and copied into the existing (preallocated) parameters of the
+    inference model, so the full state dict is never materialized. Frozen parameters are skipped, since they
+    are identical to the copy the inference model was created from. On FSDP2 the all-gather of the next
+    parameter is issued before the current one is copied, overlapping communication with the copies. On FSDP1
+    the parameters are gathered per FSDP unit with `summon_full_params`.
+
+    Args:
+        inference_model: The model used for generation, must hold regular (non-distributed) tensors.
+        device: Device on which the sharded parameters are gathered.
+        sync_every: Only sync every `sync_every` optimizer steps.
+        skip_frozen: Whether to skip parameters which do not require gradients.
+    '''
+    def __init__(
+        self,
+        inference_model: nn.Module,
+        device: torch.device,
+        sync_every: int = 1,
+        skip_frozen: bool = True,
+    ):
+        self.inference_model = inference_model
+        self.device = device
+        self.sync_every = max(1, sync_every)
+        self.skip_frozen = skip_frozen
+        self.targets = {_clean_name(name): param for name, param in inference_model.named_parameters()}
+        self.synced_step = None
+        self.last_sync_bytes = 0
+        self.last_sync_time = 0.0
+
+    @property
+    def supported(self) -> bool:
+        '''Whether the inference model can be synced in place.'''
+        return not any(isinstance(param, DTensor) for param in self.targets.values())
+
+    def should_sync(self, step: int) -> bool:
+        return self.synced_step is None or step - self.synced_step >= self.sync_every
+
+    @torch.no_grad()
+    def sync(self, model: nn.Module, step: int):
+        '''Copy the weights of `model` into the inference model. Collective, must be called on all ranks.'''
+        start = time.perf_counter()
+        if isinstance(model, FSDP):
+            nbytes = self._sync_fsdp(model)
+        else:
+            nbytes = self._sync_fsdp2(model)
+        self.synced_step = step
+        self.last_sync_bytes = nbytes
+        self.last_sync_time = time.perf_counter() - start
+
+    def _copy(self, target: torch.Tensor, tensor: torch.Tensor) -> int:
+        target.data.copy_(tensor, non_blocking=target.is_cuda)
+        return target.numel() * target.element_size()
+
+    def _gather(self, tensor: DTensor) -> torch.Tensor:
+        '''Issue the all-gather of a sharded parameter, the returned tensor waits for it on first use.'''
+        tensor = tensor.to(device=self.device)
+        return tensor.redistribute(placements=[Replicate()] * tensor.device_mesh.ndim, async_op=True).to_local()
+
+    def _sync_fsdp2(self, model: nn.Module) -> int:
+        nbytes = 0
+        pending = None
+        for name, param in model.state_dict(keep_vars=True).items():
+            target = self.targets.get(_clean_name(name), None)
+            if target is None or (self.skip_frozen and not param.requires_grad):
+                continue
+            tensor = param.detach()
+            if isinstance(tensor, DTensor):
+                # issued before the previous parameter is copied, the copy of this one waits for it
+                tensor = self._gather(tensor)
+            if pending is not None:
+                nbytes += self._copy(*pending)
+            pending = (target, tensor)
+        if pending is not None:
+            nbytes += self._copy(*pending)
+        return nbytes
+
+    def _sync_fsdp(self, model: FSDP) -> int:
+        nbytes = 0
+        synced = set()
+        for prefix, unit in model.named_modules():
+            if not isinstance(unit, FSDP):
+                continue
+            with FSDP.summon_full_params(unit, recurse=False, writeback=False):
+                for name, param in unit.named_parameters():
+                    name = _clean_name(f"{prefix}.{name}" if prefix else name)
+                    target = self.targets.get(name, None)
+                    # parameters of nested units stay sharded and are synced by their own unit
+                    if target is None or name in synced or param.shape != target.shape:
+                        continue
+                    if self.skip_frozen and not param.requires_grad:
+                        continue
+                    nbytes += self._copy(target, param.detach())
+                    synced.add(name)
+        return nbytes
@@ -7,13 +7,20 @@ from typing import Optional,Any
 import numpy as np
 import pickle
 import os
+import sys
 import time
-from .utils import logger,_process_inputs,Timer
+from .utils import logger,_process_inputs,_prepare_prompt,Timer,CompletionCache,PromptStore,compute_per_token_logps,SharedChunk,sweep_stale_chunks,tracer
+from .stealing import WorkStealer, StealStatsReport, StealAck
 import threading
 import queue
-from transformers import AutoProcessor
+import multiprocessing
+import multiprocessing.util
+import torch
+from concurrent.futures import ProcessPoolExecutor, Future, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from transformers import AutoProcessor, AutoModelForCausalLM
 import socket
-import random
+import signal
 from urllib.parse import urlparse
 
 @dataclass
@@ -33,6 +40,10 @@ class TaskAndContent:
 class SyncAdvantagesRequest:
     gid: int
 
+@dataclass
+class EvictTasksRequest:
+    completions: list[TaskStatus]
+
 DEFAULT_THRESHOLD = 0.90
 
 def global_sync_proc(
@@ -47,6 +58,10 @@ def local_balance_proc(
 ):
     """Balance data and tasks created in local machine, sync with global."""
     manager = LocalBalanceManager(*args,**kwargs)
+    # multiprocessing子进程退出时不执行atexit，被终止时不做任何清理：
+    # 将SIGTERM转为正常退出，退出时删除共享内存数据块文件
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    multiprocessing.util.Finalize(manager, manager._unlink_shared_chunks, exitpriority=0)
     manager.start()
     
 class GlobalSyncManager:
@@ -90,6 +105,12 @@ class GlobalSyncManager:
         self.sync_count = defaultdict(int)
         self.task_collection = defaultdict(list)
         self.node_queue_lengths = {}
+        self.dropped_gids = set()
+        self.evict_count = 0
+        # 已驱逐的任务组中尚未到达的完成结果数，到达后直接丢弃
+        self.evicted_tasks = defaultdict(int)
+        self.filtered_count = 0
+        self.node_steal_stats = {}
         
         # 初始化ZMQ
         self.zmqctx = zmq.Context(self.num_machines*2)
@@ -113,7 +134,15 @@ class GlobalSyncManager:
         while True:
             last_count = self.recv_count
             time.sleep(interval)
-            logger.info(f"[ Global GID: {self.current_gid} | SyncPool Size: {len(self.sync_pool)} | {self.total_ack} acked / {self.recv_count} total ] Current {self.send_count} sent, {self.ack_advantages} ack. Speed {(self.recv_count-last_count)/interval:.2f}/s.")
+            logger.info(f"[ Global GID: {self.current_gid} | SyncPool Size: {len(self.sync_pool)} | {self.total_ack} acked / {self.recv_count} total ] Current {self.send_count} sent, {self.ack_advantages} ack. Speed {(self.recv_count-last_count)/interval:.2f}/s. Evicted {self.evict_count}, filtered {self.filtered_count} groups.")
+            if self.node_steal_stats:
+                summary = []
+                for addr, report in self.node_steal_stats.items():
+                    stolen_chunks = sum(st["chunks"] for st in report.stolen.values())
+                    stolen_bytes = sum(st["bytes"] for st in report.stolen.values())
+                    served_chunks = sum(st["chunks"] for st in report.served.values())
+                    summary.append(f"{addr} stole {stolen_chunks} ({stolen_bytes / 2**20:.1f} MB) served {served_chunks}")
+                logger.info("[ Work Stealing ] " + " | ".join(summary))
     
     def _sync_node_queue(self):
         """节点队列同步线程"""
@@ -128,6 +157,7 @@ class GlobalSyncManager:
     
     def start(self):
         """启动同步管理器"""
+        tracer.set_process_name("global_sync")
         # 启动监控线程
         monitor_thd = threading.Thread(target=self._monitor, daemon=True)
         monitor_thd.start()
@@ -152,6 +182,7 @@ class GlobalSyncManager:
                     b"SYNC_FOR_UPDATE",
                     pickle.dumps(self.sync_steps)
                 ])
+            tracer.instant("sync_broadcast", sync_steps=self.sync_steps)
             self.ack_advantages -= self.num_to_sync
             self.send_count -= self.num_to_sync # 假设send_count在发送时增加
 
@@ -164,6 +195,7 @@ class GlobalSyncManager:
             # 所有节点已确认此任务
             del self.sync_count[request.gid]
             del self.sync_pool[request.gid]
+            self.dropped_gids.discard(request.gid)
             logger.debug(f"Sync advantages for {request.gid} completed")
 
     def _handle_queue_update(self, queue_lengths: dict):
@@ -171,10 +203,22 @@ class GlobalSyncManager:
         self.node_queue_lengths.update(queue_lengths)
         self.task_collect.send_string("Recived node queue lengths")
 
+    def _handle_steal_stats(self, report: StealStatsReport):
+        """处理节点窃取统计 (StealStatsReport)"""
+        self.node_steal_stats[report.addr] = report
+        self.task_collect.send_string("Recived steal stats")
+
     def _handle_task_status(self, task_status: TaskStatus):
         """处理任务状态 (TaskStatus)"""
         self.task_collect.send_string(f"Recived completion {task_status.completion_id}")
         self.recv_count += 1
+        if self.evicted_tasks.get(task_status.task_id, 0) > 0:
+            # 所属任务组已因驱逐被丢弃
+            self.evicted_tasks[task_status.task_id] -= 1
+            if self.evicted_tasks[task_status.task_id] == 0:
+                del self.evicted_tasks[task_status.task_id]
+            self._drop_completions([task_status.completion_id])
+            return
         self.task_collection[task_status.task_id].append(task_status)
         
         # 如果任务完成，计算并同步优势值
@@ -207,11 +251,47 @@ class GlobalSyncManager:
             if scores.mean() > DEFAULT_THRESHOLD or len(set(advantages)) == 1:
                 # 这些任务将被丢弃，减少发送计数
                 self.send_count -= self.num_generations * self.tp_size
+                self.dropped_gids.add(gid_to_sync)
+                self.filtered_count += 1
                 logger.debug(f"Group {gid_to_sync} tasks likely dropped due to high score or uniform advantage.")
             else:
                 logger.debug(f"Group {gid_to_sync} advantages calculated and ready for sync.")
 
 
+    def _handle_evict_request(self, request: EvictTasksRequest):
+        """处理本地节点超时驱逐的任务 (EvictTasksRequest)，保持任务组计数一致"""
+        self.task_collect.send_string(f"Recived {len(request.completions)} evicted completions")
+        self.evict_count += len(request.completions)
+        
+        for status in request.completions:
+            group = self.task_collection.get(status.task_id, None)
+            if group is not None and any(ts.completion_id == status.completion_id for ts in group):
+                # 任务组尚未完成且不会被重新生成，无法再凑齐num_generations个结果，
+                # 整组丢弃，通知各节点释放其余完成结果，之后到达的同组结果也直接丢弃
+                del self.task_collection[status.task_id]
+                self.evicted_tasks[status.task_id] += self.num_generations - len(group)
+                self._drop_completions([ts.completion_id for ts in group if ts.completion_id != status.completion_id])
+                logger.debug(f"Drop pending group of task {status.task_id} with {len(group)} completions due to eviction.")
+                continue
+            
+            for gid, completed_task_group in self.sync_pool.items():
+                if any(ts.completion_id == status.completion_id for ts in completed_task_group):
+                    # 任务组已完成但该结果不会再被训练，修正发送计数
+                    if gid not in self.dropped_gids:
+                        self.send_count -= self.tp_size
+                    break
+        logger.debug(f"Evicted {len(request.completions)} completions, {len(self.task_collection)} groups pending.")
+
+    def _drop_completions(self, completion_ids: list):
+        """通知各节点丢弃缓存中的完成结果"""
+        if not completion_ids:
+            return
+        with self.sync_lock:
+            self.sync_sender.send_multipart([
+                b"DROP_COMPLETIONS",
+                pickle.dumps(completion_ids)
+            ])
+
     def _run_main_loop(self):
         """主事件循环，接收消息并分发给相应的处理函数"""
         while True:
@@ -227,6 +307,10 @@ class GlobalSyncManager:
                 self._handle_queue_update(message)
             elif isinstance(message, TaskStatus):
                 self._handle_task_status(message)
+            elif isinstance(message, EvictTasksRequest):
+                self._handle_evict_request(message)
+            elif isinstance(message, StealStatsReport):
+                self._handle_steal_stats(message)
             elif isinstance(message, str):
                 # 处理字符串消息（如果需要）
                 logger.warning(f"Received unexpected string message: {message}")
@@ -244,6 +328,61 @@ class GlobalSyncManager:
                 except zmq.ZMQError as e:
                     logger.error(f"Error sending reply for unknown message type: {e}")
 
+_reprocess_processor = None
+_reprocess_max_prompt_length = None
+
+def _init_reprocess_worker(processing_class_name_or_path: str, max_prompt_length: int):
+    """初始化提示处理进程"""
+    global _reprocess_processor, _reprocess_max_prompt_length
+    torch.set_num_threads(1)
+    _reprocess_processor = AutoProcessor.from_pretrained(processing_class_name_or_path, trust_remote_code=True)
+    _reprocess_max_prompt_length = max_prompt_length
+
+def _share_memory(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.share_memory_()
+    if isinstance(obj, list):
+        return [_share_memory(o) for o in obj]
+    return obj
+
+def _reprocess_prompt(prompt):
+    """在处理进程中处理单个提示，结果张量写入共享内存，仅传递句柄"""
+    prepared = _prepare_prompt(prompt, _reprocess_processor, _reprocess_max_prompt_length)
+    return {k: _share_memory(v) for k, v in prepared.items()}
+
+_ref_model = None
+_ref_device = None
+_ref_chunk_size = 64
+
+def _init_ref_worker(name_or_path: str, model_init_kwargs: dict, device: str, memory_fraction: Optional[float], chunk_size: int):
+    """初始化参考模型进程，参考模型常驻在指定设备上"""
+    global _ref_model, _ref_device, _ref_chunk_size
+    _ref_device = torch.device(device)
+    if _ref_device.type == "cuda":
+        torch.cuda.set_device(_ref_device)
+        if memory_fraction is not None:
+            torch.cuda.set_per_process_memory_fraction(memory_fraction, _ref_device)
+    _ref_model = AutoModelForCausalLM.from_pretrained(name_or_path, **(model_init_kwargs or {}))
+    _ref_model.to(device=_ref_device).eval()
+    _ref_chunk_size = chunk_size
+
+def _to_ref_device(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device=_ref_device, non_blocking=True)
+    if isinstance(obj, list):
+        return [_to_ref_device(o) for o in obj]
+    if isinstance(obj, dict):
+        return {k: _to_ref_device(v) for k, v in obj.items()}
+    return obj
+
+@torch.no_grad()
+def _ref_logps(prompt_inputs: dict, logits_to_keep: int):
+    """计算数据块补全部分的参考模型对数概率，以fp16写入共享内存"""
+    ref_per_token_logps = compute_per_token_logps(
+        _ref_model, prompt_inputs, logits_to_keep, chunk_size=_ref_chunk_size, prepare_inputs=_to_ref_device
+    )
+    return ref_per_token_logps.to(device="cpu", dtype=torch.float16).share_memory_()
+
 class LocalBalanceManager:
     """平衡本地机器创建的数据和任务，并与全局同步。"""
     
@@ -260,9 +399,20 @@ class LocalBalanceManager:
         max_cache_size: int,
         processing_class_name_or_path: str,
         max_prompt_length: int,
-        steal_threshold: int = 16,
+        steal_threshold: int = 1,
         tp_size: int = 1,
-        timeout: int = 3600
+        timeout: int = 3600,
+        reprocess_workers: int = 4,
+        max_cache_bytes: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        spill_after: Optional[int] = None,
+        steal_address: Optional[str] = None,
+        ref_model_name_or_path: Optional[str] = None,
+        ref_model_init_kwargs: Optional[dict] = None,
+        ref_device: Optional[str] = None,
+        ref_memory_fraction: Optional[float] = None,
+        ref_chunk_size: int = 64,
+        tp_shm_dir: Optional[str] = None
     ):
         """初始化本地平衡管理器。
         
@@ -278,9 +428,21 @@ class LocalBalanceManager:
             max_cache_size: 最大缓存大小
             processing_class_name_or_path: 处理器类名或路径
             max_prompt_length: 最大提示长度
-            steal_threshold: 窃取阈值
+            steal_threshold: 最小窃取阈值，实际阈值随全局平均队列长度和本地消耗速率自适应
             tp_size: 张量并行大小
-            timeout: 超时时间
+            timeout: 超时时间，超时的缓存任务会被驱逐并通知全局
+            reprocess_workers: 提示处理进程数，为0时在线程中处理
+            max_cache_bytes: 缓存任务在内存中的最大字节数
+            spill_dir: 溢出缓存文件目录，为None时不溢出到磁盘
+            spill_after: 缓存任务超过该时间后溢出到磁盘
+            steal_address: 窃取监听地址，为None时使用本机IP和local_steal_port
+            ref_model_name_or_path: 参考模型路径，不为None时由本地平衡器计算参考对数概率
+            ref_model_init_kwargs: 参考模型加载参数
+            ref_device: 参考模型所在设备
+            ref_memory_fraction: 参考模型进程可使用的显存比例
+            ref_chunk_size: 计算对数概率时每次投影的位置数
+            tp_shm_dir: 张量并行时数据块共享内存文件目录（如/dev/shm），数据块只写入一次，
+                组内各设备零拷贝映射；为None时向每个设备发送各自的序列化副本
         """
         self.local_collect_address = local_collect_address
         self.local_provider_address = local_provider_address
@@ -296,6 +458,19 @@ class LocalBalanceManager:
         self.steal_threshold = steal_threshold
         self.tp_size = tp_size
         self.timeout = timeout
+        self.reprocess_workers = reprocess_workers
+        self.max_cache_bytes = max_cache_bytes
+        self.spill_dir = spill_dir
+        self.spill_after = spill_after
+        self.steal_address = steal_address
+        self.ref_model_name_or_path = ref_model_name_or_path
+        self.tp_shm_dir = tp_shm_dir if tp_size > 1 else None
+        # 共享内存数据块: TP组 -> 接收序号 -> (数据块, 已映射的设备)
+        self.shared_chunks = defaultdict(dict)
+        if self.tp_shm_dir is not None:
+            removed = sweep_stale_chunks(self.tp_shm_dir)
+            if removed:
+                logger.warning(f"Removed {removed} chunk files left in {self.tp_shm_dir} by previous runs.")
         
         # 初始化ZMQ上下文
         self.zmqctx = zmq.Context(16)
@@ -304,14 +479,35 @@ class LocalBalanceManager:
         self._init_sockets()
         
         # 初始化缓存和队列
-        self.cached_tasks = {}
+        # 驻留的提示计入缓存预算，随最后一个驻留的同组完成结果一起溢出到磁盘
+        self.prompt_store = PromptStore()
+        self.cached_tasks = CompletionCache(
+            max_bytes=max_cache_bytes,
+            timeout=timeout,
+            spill_dir=spill_dir,
+            spill_after=spill_after,
+            shared_nbytes=lambda: self.prompt_store.nbytes,
+            spill_fn=self._spill_completion,
+            restore_fn=self._restore_completion,
+        )
         self.global_ready_queue_length = {self.steal_addr: 0}
         self.valid_tasks = queue.Queue(max_cache_size // 4 * 3)
         self.ready_queue = queue.Queue(max_cache_size // 4)
+        self.reprocess_pending = queue.Queue(max(2, 2 * reprocess_workers))
+        self.ref_pending = queue.Queue(4)
+        self.ready_queue_starved = 0
         self.local_gid = 0
         
         # 加载处理器
-        self.processor = AutoProcessor.from_pretrained(processing_class_name_or_path, trust_remote_code=True)
+        self.processor = self._load_processor()
+        
+        # 提示处理进程池
+        self.pool_lock = threading.Lock()
+        self.reprocess_pool = self._make_reprocess_pool() if reprocess_workers > 0 else None
+        
+        # 参考模型对数概率服务，参考模型常驻在独立进程和设备上
+        self.ref_initargs = (ref_model_name_or_path, ref_model_init_kwargs, ref_device, ref_memory_fraction, ref_chunk_size)
+        self.ref_pool = self._make_ref_pool() if ref_model_name_or_path is not None else None
     
     def _init_sockets(self):
         """初始化所有ZMQ套接字和网络连接"""
@@ -319,17 +515,20 @@ class LocalBalanceManager:
         self.queue_syncer = self.zmqctx.socket(zmq.REQ)
         self.queue_syncer.connect(self.global_result_collect_address)
         
-        # 获取本机IP地址
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        parsed = urlparse(self.global_result_collect_address)
-        try:
-            s.connect((parsed.hostname, parsed.port))
-            node_ip = s.getsockname()[0]
-        finally:
-            s.close()
+        if self.steal_address is None:
+            # 获取本机IP地址
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            parsed = urlparse(self.global_result_collect_address)
+            try:
+                s.connect((parsed.hostname, parsed.port))
+                node_ip = s.getsockname()[0]
+            finally:
+                s.close()
+            self.steal_addr = f"tcp://{node_ip}:{self.local_steal_port}"
+        else:
+            self.steal_addr = self.steal_address
         
         # 设置窃取地址和套接字
-        self.steal_addr = f"tcp://{node_ip}:{self.local_steal_port}"
         self.steal_recv = self.zmqctx.socket(zmq.REP)
         self.steal_recv.bind(self.steal_addr)
         logger.info(f"Listen for stealing at {self.steal_addr}")
@@ -337,6 +536,7 @@ class LocalBalanceManager:
         # 同步信号订阅者
         self.sync_signal = self.zmqctx.socket(zmq.SUB)
         self.sync_signal.setsockopt(zmq.SUBSCRIBE, b"SYNC_ADVANTAGES")
+        self.sync_signal.setsockopt(zmq.SUBSCRIBE, b"DROP_COMPLETIONS")
         self._set_tcp_keepalive(self.sync_signal)
         self.sync_signal.connect(self.global_sync_address)
         
@@ -358,6 +558,10 @@ class LocalBalanceManager:
         self.advantage_syncer = self.zmqctx.socket(zmq.REQ)
         self.advantage_syncer.connect(self.global_result_collect_address)
         
+        # 驱逐通知者
+        self.evict_notifier = self.zmqctx.socket(zmq.REQ)
+        self.evict_notifier.connect(self.global_result_collect_address)
+        
         # 平衡收集器
         self.balance_collect = self.zmqctx.socket(zmq.REP)
         self.balance_collect.bind(self.local_collect_address)
@@ -365,6 +569,9 @@ class LocalBalanceManager:
         # 平衡提供者
         self.balance_provider = self.zmqctx.socket(zmq.REP)
         self.balance_provider.bind(self.local_provider_address)
+        
+        # 工作窃取器，保持到其他节点的持久连接
+        self.stealer = WorkStealer(self.zmqctx, self.steal_addr, min_threshold=self.steal_threshold)
     
     def _set_tcp_keepalive(self, socket):
         """设置TCP保持连接选项"""
@@ -373,23 +580,178 @@ class LocalBalanceManager:
         socket.setsockopt(zmq.TCP_KEEPALIVE_CNT, 5)
         socket.setsockopt(zmq.TCP_KEEPALIVE_INTVL, 10)
     
+    def _load_processor(self):
+        """加载提示处理器"""
+        return AutoProcessor.from_pretrained(self.processing_class_name_or_path, trust_remote_code=True)
+    
+    def _build_chunk(self, collected: list[dict], prepared: list[dict]) -> dict:
+        """将处理后的提示与完成结果组装为训练数据块"""
+        return _process_inputs(collected, self.processor, self.max_prompt_length, prepared)
+    
+    def _make_reprocess_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.reprocess_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_reprocess_worker,
+            initargs=(self.processing_class_name_or_path, self.max_prompt_length)
+        )
+    
+    @staticmethod
+    def _shutdown_pool(pool: ProcessPoolExecutor):
+        """关闭已损坏的进程池并结束其残留的工作进程"""
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+    
+    def _restart_reprocess_pool(self):
+        """重建损坏的提示处理进程池，多个失败同时发现损坏时只重建一次"""
+        with self.pool_lock:
+            if getattr(self.reprocess_pool, "_broken", False):
+                logger.error("Prompt processing pool is broken, restart it.")
+                self._shutdown_pool(self.reprocess_pool)
+                self.reprocess_pool = self._make_reprocess_pool()
+    
+    def _make_ref_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_ref_worker,
+            initargs=self.ref_initargs
+        )
+    
+    def _restart_ref_pool(self):
+        """重建损坏的参考模型进程（如参考设备显存溢出），等待中的数据块只重建一次"""
+        with self.pool_lock:
+            if getattr(self.ref_pool, "_broken", False):
+                logger.error("Reference model process is broken, restart it.")
+                self._shutdown_pool(self.ref_pool)
+                self.ref_pool = self._make_ref_pool()
+    
+    def _submit_ref_logps(self, chunk_data: dict) -> Future:
+        try:
+            return self.ref_pool.submit(_ref_logps, chunk_data["prompt_inputs"], chunk_data["completion_mask"].size(1))
+        except BrokenProcessPool:
+            self._restart_ref_pool()
+            return self.ref_pool.submit(_ref_logps, chunk_data["prompt_inputs"], chunk_data["completion_mask"].size(1))
+    
+    def _prepare_prompt_in_thread(self, prompt):
+        return _prepare_prompt(prompt, self.processor, self.max_prompt_length)
+    
+    def _resolve_prepared(self, collected: list[dict], prepared: list) -> list[dict]:
+        """等待提示处理结果，进程池损坏时重建进程池并在当前线程重新处理受影响的提示"""
+        resolved = []
+        for d, p in zip(collected, prepared):
+            if isinstance(p, Future):
+                try:
+                    p = p.result()
+                except (BrokenProcessPool, CancelledError):
+                    self._restart_reprocess_pool()
+                    if d.get("prompt_key", None) is None:
+                        p = self._prepare_prompt_in_thread(d["prompt"])
+                    else:
+                        # 失败的Future不会被共享，提示在处理成功前一直保留
+                        p = self.prompt_store.processed(d["prompt_key"], self._prepare_prompt_in_thread)
+                        p = p.result() if isinstance(p, Future) else p
+            resolved.append(p)
+        return resolved
+    
+    def _process_prompt(self, prompt):
+        """处理单个提示，使用进程池时返回Future"""
+        if self.reprocess_pool is None:
+            return _prepare_prompt(prompt, self.processor, self.max_prompt_length)
+        try:
+            return self.reprocess_pool.submit(_reprocess_prompt, prompt)
+        except BrokenProcessPool:
+            self._restart_reprocess_pool()
+            return self.reprocess_pool.submit(_reprocess_prompt, prompt)
+    
     def reprocess(self):
-        """处理任务并生成处理后的数据块"""
+        """收集待处理的任务并提交提示处理"""
+        while True:
+            tasks = [self.valid_tasks.get() for _ in range(self.chunk_size)]
+            collected = [task.data for task in tasks]
+            if tracer.enabled:
+                # 训练时记录数据块中的完成结果，用于统计端到端延迟
+                for task in tasks:
+                    task.data["completion_uuid"] = task.status.completion_id.hex
+            del tasks
+            # 同组的完成结果共享提示，每个提示只处理一次
+            prepared = []
+            for d in collected:
+                if d.get("prompt_key", None) is None:
+                    prepared.append(self._process_prompt(d["prompt"]))
+                else:
+                    prepared.append(self.prompt_store.processed(d["prompt_key"], self._process_prompt))
+            self.reprocess_pending.put((collected, prepared))
+    
+    def collect_reprocessed(self):
+        """按提交顺序组装处理后的数据块，保证各TP组的数据顺序一致"""
+        while True:
+            collected, prepared = self.reprocess_pending.get()
+            try:
+                with tracer.span("build_chunk", size=len(collected)):
+                    prepared = self._resolve_prepared(collected, prepared)
+                    chunk_data = self._build_chunk(collected, prepared)
+                if tracer.enabled:
+                    chunk_data["completion_uuids"] = [d.get("completion_uuid", None) for d in collected]
+            except Exception as e:
+                # 丢弃数据块会使全局的发送与确认计数不一致，直接报错
+                logger.error(f"Failed to build chunk of {len(collected)} tasks: {e!r}")
+                raise
+            for d in collected:
+                self.prompt_store.release(d.get("prompt_key", None))
+            del prepared, collected
+            if self.ref_pool is None:
+                self.ready_queue.put(chunk_data)
+            else:
+                self.ref_pending.put((chunk_data, self._submit_ref_logps(chunk_data)))
+    
+    def collect_ref_logps(self):
+        """按提交顺序为数据块附加参考模型对数概率"""
         while True:
-            collected = [self.valid_tasks.get().data for _ in range(self.chunk_size)]
-            chunk_data = _process_inputs(collected, self.processor, self.max_prompt_length)
+            chunk_data, future = self.ref_pending.get()
+            try:
+                try:
+                    chunk_data["ref_per_token_logps"] = future.result()
+                except (BrokenProcessPool, CancelledError):
+                    # 重建参考模型进程后重试一次，再次失败说明无法恢复
+                    self._restart_ref_pool()
+                    chunk_data["ref_per_token_logps"] = self._submit_ref_logps(chunk_data).result()
+            except Exception as e:
+                # 丢弃数据块会使训练进程饥饿且全局计数不一致，直接报错
+                logger.error(f"Failed to compute reference logprobs: {e!r}")
+                raise
             self.ready_queue.put(chunk_data)
     
     def provider(self):
         """为工作进程提供数据"""
         cached_group_data = defaultdict(dict)
         visited_counts = defaultdict(dict)
+        shared_chunks = self.shared_chunks
         
         while True:
             tp_gid, rank, recv_idx = self.balance_provider.recv_pyobj()
+            # 设备请求下一块数据时，之前的数据块一定已经映射完成
+            for idx in [idx for idx in shared_chunks[tp_gid] if idx < recv_idx]:
+                chunk, loaded_ranks = shared_chunks[tp_gid][idx]
+                loaded_ranks.add(rank)
+                if len(loaded_ranks) == self.tp_size:
+                    chunk.unlink()
+                    del shared_chunks[tp_gid][idx]
+            
             if cached_group_data[tp_gid].get(recv_idx, None) is None:
                 # 该组的新数据
-                chunk_data = self.ready_queue.get()
+                if self.ready_queue.empty():
+                    self.ready_queue_starved += 1
+                with tracer.span("ready_queue_wait", tp_gid=tp_gid, recv_idx=recv_idx):
+                    chunk_data = self.ready_queue.get()
+                self.stealer.record_consumed()
+                if self.tp_shm_dir is not None:
+                    # 只写入一次共享内存，组内设备只接收数据块的位置
+                    chunk_data = SharedChunk(chunk_data, self.tp_shm_dir)
+                    shared_chunks[tp_gid][recv_idx] = (chunk_data, set())
                 cached_group_data[tp_gid][recv_idx] = pickle.dumps(chunk_data)
                 visited_counts[tp_gid][recv_idx] = 0
             
@@ -406,74 +768,87 @@ class LocalBalanceManager:
             self.balance_provider.send(chunk_data)
     
     def reporter(self):
-        """报告队列状态"""
+        """报告队列状态和窃取统计"""
+        tick = 0
         while True:
             time.sleep(3)
             self.queue_syncer.send_pyobj({self.steal_addr: self.ready_queue.qsize()})
+            tracer.counter("queues", ready=self.ready_queue.qsize(), valid=self.valid_tasks.qsize(), cached=len(self.cached_tasks))
             self.queue_syncer.recv()
+            
+            tick += 1
+            if tick % 10 == 0:
+                self.queue_syncer.send_pyobj(self.stealer.report())
+                self.queue_syncer.recv()
     
     def serve_stealing(self):
         """处理其他节点的任务窃取请求"""
+        poller = zmq.Poller()
+        poller.register(self.steal_recv, zmq.POLLIN)
         while True:
-            nums_to_steal = self.steal_recv.recv_pyobj()
-            mean_queue_length = sum(self.global_ready_queue_length.values()) / len(self.global_ready_queue_length)
-            
-            # 确定要发送多少
-            nums_to_offer = max(int(min((self.ready_queue.qsize() - mean_queue_length) / 2, nums_to_steal)), 0)
-            
-            if nums_to_offer <= 0:
-                self.steal_recv.send_pyobj(None)
-            else:
-                chunk_datas = []
-                try:
-                    for _ in range(nums_to_offer):
-                        chunk_datas.append(self.ready_queue.get_nowait())
-                except:
-                    pass
-                self.steal_recv.send_pyobj(chunk_datas)
+            # 先处理已到达的请求和确认，再归还超时未确认的数据块
+            if poller.poll(timeout=int(self.stealer.check_interval * 1000)):
+                self._serve_steal_request(self.steal_recv.recv_pyobj())
+            for chunk_data in self.stealer.expired():
+                self.ready_queue.put(chunk_data)
+    
+    def _serve_steal_request(self, req):
+        """响应一次窃取请求或确认"""
+        if isinstance(req, StealAck):
+            self.steal_recv.send_pyobj(self.stealer.confirm(req.steal_id))
+            return
+        thief, nums_to_steal, steal_id = req
+        mean_queue_length = sum(self.global_ready_queue_length.values()) / len(self.global_ready_queue_length)
+        
+        # 确定要发送多少
+        nums_to_offer = max(int(min((self.ready_queue.qsize() - mean_queue_length) / 2, nums_to_steal)), 0)
+        
+        if nums_to_offer <= 0:
+            self.steal_recv.send_pyobj(None)
+        else:
+            chunk_datas = []
+            try:
+                for _ in range(nums_to_offer):
+                    chunk_datas.append(self.ready_queue.get_nowait())
+            except queue.Empty:
+                pass
+            data = pickle.dumps(chunk_datas)
+            if chunk_datas:
+                # 窃取方可能在收到响应前超时，确认前保留这些数据块
+                self.stealer.hold(steal_id, thief, chunk_datas, len(data))
+            self.steal_recv.send(data)
     
     def work_stealing(self):
-        """从其他节点窃取任务"""
+        """从其他节点窃取任务，在队列长度广播之间也会根据本地队列的变化进行窃取"""
+        poller = zmq.Poller()
+        poller.register(self.sync_queue, zmq.POLLIN)
+        
         while True:
-            parts = self.sync_queue.recv_multipart()
-            if len(parts) != 2:
-                logger.error(f"Invalid message parts: {len(parts)}, parts: {parts}")
-                continue
+            socks = dict(poller.poll(timeout=int(self.stealer.check_interval * 1000)))
+            if self.sync_queue in socks:
+                parts = self.sync_queue.recv_multipart()
+                if len(parts) != 2:
+                    logger.error(f"Invalid message parts: {len(parts)}, parts: {parts}")
+                    continue
+                
+                _, d = parts
+                self.global_ready_queue_length.update(pickle.loads(d))
             
-            _, d = parts
-            self.global_ready_queue_length.update(pickle.loads(d))
             if len(self.global_ready_queue_length) == 1:
                 continue
             
-            current_q = self.ready_queue.qsize()
-            mean_queue_length = sum(self.global_ready_queue_length.values()) / len(self.global_ready_queue_length)
-            
-            starving = mean_queue_length - current_q
-            if starving > self.steal_threshold:
-                nums_to_steal = int(starving / 2)
-            else:
-                nums_to_steal = 0
+            # 根据队列深度和测得的带宽选择目标
+            plan = self.stealer.plan(self.global_ready_queue_length, self.ready_queue.qsize())
+            if plan is None:
+                continue
             
-            if nums_to_steal > 0:
-                # 选择目标
-                items = [(addr, qlen) for addr, qlen in self.global_ready_queue_length.items() 
-                         if addr != self.steal_addr and qlen > mean_queue_length]
-                if not items:
-                    continue
-                
-                addr, remote_q = random.choice(items)
-                # 随机选择
-                nums_to_steal = min(nums_to_steal, int((remote_q - mean_queue_length) / 2))
-                
-                # 进行窃取
-                with self.zmqctx.socket(zmq.REQ) as steal_req:
-                    steal_req.connect(addr)
-                    steal_req.send_pyobj(nums_to_steal)
-                    stealed = steal_req.recv_pyobj()
-                
-                if stealed:
-                    for chunk_data in stealed:
-                        self.ready_queue.put(chunk_data)
+            addr, nums_to_steal = plan
+            stealed = self.stealer.steal(addr, nums_to_steal)
+            if stealed:
+                # 在下次广播前修正目标节点的队列长度，避免重复窃取
+                self.global_ready_queue_length[addr] = max(0, self.global_ready_queue_length[addr] - len(stealed))
+                for chunk_data in stealed:
+                    self.ready_queue.put(chunk_data)
     
     def sync_handler(self):
         """处理同步信号并更新任务状态"""
@@ -484,6 +859,14 @@ class LocalBalanceManager:
                 continue
             
             topic, d = parts
+            if topic == b"DROP_COMPLETIONS":
+                # 所属任务组因驱逐无法完成
+                for completion_id in pickle.loads(d):
+                    tac = self.cached_tasks.pop(completion_id, None)
+                    if tac is not None:
+                        self.prompt_store.release(tac.data.get("prompt_key", None))
+                        logger.debug(f"Drop completion {completion_id} of evicted group of task {tac.status.task_id}")
+                continue
             latest_gid = pickle.loads(d)
             
             while self.local_gid <= latest_gid:
@@ -505,10 +888,9 @@ class LocalBalanceManager:
                 
                 # 检查是否可能有进一步的任务
                 for status in task_status:
-                    if status.completion_id in self.cached_tasks:
-                        d = self.cached_tasks[status.completion_id]
-                        if (d.data.get("next_id", None) is not None and 
-                            d.status.completion_id in valid_next_task_completions):
+                    if status.completion_id in valid_next_task_completions:
+                        d = self.cached_tasks.get(status.completion_id, None)
+                        if d is not None and d.data.get("next_id", None) is not None:
                             # 考虑将下一轮任务添加到任务队列
                             next_new_tasks.append(d)
                 
@@ -553,7 +935,9 @@ class LocalBalanceManager:
                     drop = []
                     for status in task_status:
                         if status.completion_id in self.cached_tasks:
-                            drop.append(self.cached_tasks.pop(status.completion_id))
+                            d = self.cached_tasks.pop(status.completion_id)
+                            self.prompt_store.release(d.data.get("prompt_key", None))
+                            drop.append(d.status)
                     
                     if drop:
                         logger.debug(f"Drop {len(drop)} tasks in Group {self.local_gid}, "
@@ -564,8 +948,8 @@ class LocalBalanceManager:
                     pre_len = len(self.cached_tasks)
                     for status in task_status:
                         if status.completion_id in self.cached_tasks:
-                            self.cached_tasks[status.completion_id].status.advantage = status.advantage
                             d = self.cached_tasks.pop(status.completion_id)
+                            d.status.advantage = status.advantage
                             d.data["advantage"] = d.status.advantage
                             self.valid_tasks.put(d)
                             
@@ -578,38 +962,86 @@ class LocalBalanceManager:
                 
                 self.local_gid += 1
     
+    def _spill_completion(self, tac: TaskAndContent) -> TaskAndContent:
+        """溢出完成结果时带上其提示并释放引用，最后一个引用释放后提示不再占用内存"""
+        prompt_key = tac.data.get("prompt_key", None)
+        prompt = self.prompt_store.detach(prompt_key) if prompt_key is not None else None
+        if prompt is None:
+            return tac
+        return TaskAndContent(data={**tac.data, "prompt": prompt}, status=tac.status)
+    
+    def _restore_completion(self, tac: TaskAndContent) -> TaskAndContent:
+        """溢出的完成结果离开缓存时重新驻留其提示"""
+        prompt = tac.data.pop("prompt", None)
+        if prompt is not None:
+            self.prompt_store.acquire(tac.data["prompt_key"], prompt)
+        return tac
+    
     def monitor(self):
-        """检查缓存中是否有超时的任务"""
+        """驱逐缓存中超时的任务，并将滞留的任务溢出到磁盘"""
         interval = int(os.environ.get("LOCAL_MONITOR_INTERVAL", "300"))
         while True:
             time.sleep(interval)
-            oldest_task = None
             
-            for k, v in list(self.cached_tasks.items()):
-                if oldest_task is None or v.status.created_time < oldest_task.status.created_time:
-                    oldest_task = v
-                
-                if (datetime.datetime.now() - v.status.created_time).total_seconds() > self.timeout:
-                    logger.warning(f"Task {v.status.task_id}, completion {k} is out of time.")
-                    # del self.cached_tasks[k]
+            evicted = self.cached_tasks.expire()
+            if evicted:
+                for tac in evicted:
+                    self.prompt_store.release(tac.data.get("prompt_key", None))
+                    logger.warning(f"Task {tac.status.task_id}, completion {tac.status.completion_id} is out of time, evicted.")
+                # 通知全局，保持任务组计数一致
+                self.evict_notifier.send_pyobj(EvictTasksRequest([tac.status for tac in evicted]))
+                self.evict_notifier.recv()
+            del evicted
             
-            if oldest_task is not None:
-                logger.info(f"[ Local GID: {self.local_gid} | Cached: {len(self.cached_tasks)}, "
-                            f"Reprocessing: {self.valid_tasks.qsize()} | Queued: {self.ready_queue.qsize()} ] "
-                            f"The oldest task id {oldest_task.status.task_id}, "
-                            f"create time: {oldest_task.status.created_time}")
+            spilled = self.cached_tasks.spill_stale()
+            if spilled:
+                logger.debug(f"Spill {spilled} stale tasks to disk.")
+            
+            oldest = self.cached_tasks.oldest()
+            if oldest is not None:
+                stats = self.cached_tasks.stats()
+                logger.info(f"[ Local GID: {self.local_gid} | Cached: {stats['entries']} "
+                            f"({stats['resident_bytes'] / 2**20:.1f} MB in memory, {stats['spilled']} spilled, {stats['spill_file_bytes'] / 2**20:.1f} MB on disk), "
+                            f"Prompts: {len(self.prompt_store)} ({self.prompt_store.nbytes / 2**20:.1f} MB), "
+                            f"Reprocessing: {self.valid_tasks.qsize()} + {self.reprocess_pending.qsize()} | "
+                            f"Queued: {self.ready_queue.qsize()}, starved {self.ready_queue_starved} times ] "
+                            f"The oldest completion {oldest[0]}, age: {oldest[1]:.0f}s, evicted: {stats['evicted']}")
+            logger.info(f"[ Local Work Stealing ] {self.stealer.summary()}")
+    
+    def _unlink_shared_chunks(self):
+        """删除尚未被所有设备确认的共享内存数据块文件"""
+        for group in list(self.shared_chunks.values()):
+            for chunk, _ in list(group.values()):
+                chunk.unlink()
+    
+    def _fatal_on_error(self, target):
+        """线程异常退出时结束本地平衡器进程，避免训练进程在数据流中断后静默等待"""
+        def run():
+            try:
+                target()
+            except BaseException:
+                logger.exception(f"Local balancer thread {target.__name__} failed, exit.")
+                self._unlink_shared_chunks()
+                os._exit(1)
+        return run
     
     def start(self):
         """启动所有线程并运行主循环"""
+        tracer.set_process_name("local_balancer")
         # 启动所有线程
         threads = [
-            threading.Thread(target=self.reprocess, daemon=True),
-            threading.Thread(target=self.provider, daemon=True),
-            threading.Thread(target=self.reporter, daemon=True),
-            threading.Thread(target=self.serve_stealing, daemon=True),
-            threading.Thread(target=self.work_stealing, daemon=True),
-            threading.Thread(target=self.sync_handler, daemon=True),
-            threading.Thread(target=self.monitor, daemon=True)
+            threading.Thread(target=self._fatal_on_error(target), name=target.__name__, daemon=True)
+            for target in [
+                self.reprocess,
+                self.collect_reprocessed,
+                self.collect_ref_logps,
+                self.provider,
+                self.reporter,
+                self.serve_stealing,
+                self.work_stealing,
+                self.sync_handler,
+                self.monitor,
+            ]
         ]
         
         for thread in threads:
@@ -618,6 +1050,13 @@ class LocalBalanceManager:
         # 主循环
         while True:
             tac: TaskAndContent = self.balance_collect.recv_pyobj()
+            prompt_key = tac.data.get("prompt_key", None)
+            if prompt_key is not None:
+                # 按任务驻留提示，同组的完成结果只保存一份
+                if not self.prompt_store.acquire(prompt_key, tac.data.pop("prompt", None)):
+                    # 提示已被释放，要求发送方重新发送完整数据
+                    self.balance_collect.send_string("PROMPT_MISSING")
+                    continue
             self.cached_tasks[tac.status.completion_id] = tac
             self.balance_collect.send_string("Received")
             
@@ -625,8 +1064,157 @@ class LocalBalanceManager:
             self.result_sender.send_pyobj(tac.status)
             self.result_sender.recv_string()
             
-            if len(self.cached_tasks) >= self.max_cache_size:
+            if len(self.cached_tasks) >= self.max_cache_size or self.cached_tasks.over_budget():
                 logger.warning(f"Too many cached tasks. [ Local GID: {self.local_gid} | "
                                f"Cached: {len(self.cached_tasks)}, Reprocessing: {self.valid_tasks.qsize()} | "
                                f"Queued: {self.ready_queue.qsize()} ]")
                 time.sleep(3)  # 缓存过多
+
+
+class BatchGatherer:
+    """训练 rank 一侧的批次收集：在本地生成与接收本地平衡器的训练数据之间轮询，直到收到全局同步信号。"""
+
+    def __init__(
+        self,
+        sync_signal: zmq.Socket,
+        balance_recv: zmq.Socket,
+        ack: zmq.Socket,
+        tp_group_id: int,
+        rank: int,
+        chunk_size: int,
+        num_iterations: int,
+        max_items_to_cache: int,
+        greedy_gather_wait_time: int,
+    ):
+        """初始化批次收集器。
+
+        Args:
+            sync_signal: 订阅全局 SYNC_FOR_UPDATE 信号的 SUB 套接字
+            balance_recv: 向本地平衡器请求训练数据的 REQ 套接字
+            ack: 向全局管理器确认已接收数据的 REQ 套接字
+            tp_group_id: 张量并行组编号
+            rank: 当前 rank
+            chunk_size: 每个数据块的大小
+            num_iterations: 每个数据块重复训练的次数
+            max_items_to_cache: 批次已满时最多缓存的数据块数量
+            greedy_gather_wait_time: 收到数据后继续等待更多数据的初始超时（毫秒）
+        """
+        self.sync_signal = sync_signal
+        self.balance_recv = balance_recv
+        self.ack = ack
+        self.tp_group_id = tp_group_id
+        self.rank = rank
+        self.chunk_size = chunk_size
+        self.num_iterations = num_iterations
+        self.max_items_to_cache = max_items_to_cache
+        self.greedy_gather_wait_time = greedy_gather_wait_time
+
+        self.cached_data = []
+        self.recv_idx = 0
+        self.poller = zmq.Poller()
+        self.poller.register(self.sync_signal, zmq.POLLIN)
+        self.poller.register(self.balance_recv, zmq.POLLIN)
+        self.poller.register(self.ack, zmq.POLLIN)
+
+    def gather(self, epoch_iterator, num_batches: int, sample_step) -> list:
+        """收集 `num_batches` 个数据块，空闲时从 `epoch_iterator` 取任务并调用 `sample_step(inputs)` 生成。"""
+        # initial batch fill
+        current_batch = [self.cached_data.pop() for _ in range(min(num_batches, len(self.cached_data)))]
+        # since when the batch is complete and the rank only waits for the sync signal
+        batch_full_since = time.time() if len(current_batch) == num_batches else None
+        if len(current_batch) < num_batches:
+            # first send sync request
+            self.balance_recv.send_pyobj((self.tp_group_id,self.rank,self.recv_idx))
+
+        waiting_for_ack = False
+        # `wait_time_ms` will hold our dynamic timeout (in milliseconds)
+        wait_time_ms = 0
+
+        while True:
+            # poll with the current wait_time
+            with tracer.span("poll", timeout_ms=wait_time_ms) as span_args:
+                socks = dict(self.poller.poll(timeout=wait_time_ms))
+                span_args["events"] = len(socks)
+
+            # 1) handle ack-only sockets if we’re waiting for one
+            if waiting_for_ack and self.ack in socks:
+                self.ack.recv()
+                waiting_for_ack = False
+
+            # 2) if we successfully received backward data, reset wait_time and refill cache
+            if self.balance_recv in socks and not waiting_for_ack:
+                data: dict = self.balance_recv.recv_pyobj()
+                if isinstance(data, SharedChunk):
+                    # chunk written once by the local balancer for the whole TP group
+                    data = data.load()
+                batch_samples = [data] * self.num_iterations
+                tracer.instant("recv_chunk", recv_idx=self.recv_idx)
+                self.recv_idx += 1
+                self.ack.send_pyobj(self.chunk_size)
+                waiting_for_ack = True
+                logger.debug("Worker {} Received backward data".format(self.rank))
+
+                wait_time_ms = self.greedy_gather_wait_time
+
+                if len(current_batch) < num_batches:
+                    needed = num_batches - len(current_batch)
+                    current_batch.extend(batch_samples[:needed])
+                    if len(current_batch) == num_batches:
+                        batch_full_since = time.time()
+                    self.cached_data.extend(batch_samples[needed:])
+                    # if still short, ask for more
+                    if len(current_batch) < num_batches and len(self.cached_data) < self.max_items_to_cache:
+                        self.balance_recv.send_pyobj((self.tp_group_id,self.rank,self.recv_idx))
+                    else:
+                        wait_time_ms = 0 # reset wait_time_ms to 0 to avoid waiting for more data
+                else:
+                    self.cached_data.extend(batch_samples)
+                    wait_time_ms = 0 # reset wait_time_ms to 0 to avoid waiting for more data
+
+                # immediately go back to polling (no sampling yet)
+                continue
+
+            # 3) if we get the sync signal, verify and break out
+            if self.sync_signal in socks:
+                try:
+                    parts = self.sync_signal.recv_multipart()
+                    wid, d = parts
+                    sync_steps = pickle.loads(d)
+                    tracer.instant("sync", sync_steps=sync_steps)
+                    if batch_full_since is not None:
+                        tracer.complete("wait_sync", batch_full_since, sync_steps=sync_steps)
+                except:
+                    logger.error(f"Receive Undcodeable Sync singal: {parts}")
+                    sync_steps = "UNKNOWN"
+                    wid = "UNKNOWN".encode()
+
+                assert len(current_batch) == num_batches, (
+                    f"INVALID SYNC at step {sync_steps} with "
+                    f"{len(current_batch)} + {len(self.cached_data)} backward data"
+                )
+                logger.debug(
+                    f"Worker {self.rank} Received sync signal {wid.decode()} "
+                    f"with {len(current_batch)} + {len(self.cached_data)} backward data"
+                )
+                break
+
+            # 4) no backward data arrived within wait_time_ms
+            if wait_time_ms > 0:
+                # exponential back‐off: halve the wait time, but don’t go below zero
+                wait_time_ms = int(max(0, wait_time_ms / 2))
+                # skip sampling until wait_time_ms decays to 0
+                continue
+
+            # 5) wait_time_ms has decayed to zero → do a sample step
+            try:
+                inputs = next(epoch_iterator)
+                with tracer.span("sample_step"):
+                    sample_step(inputs)
+            except StopIteration:
+                # iterator is exhausted
+                continue
+
+        if waiting_for_ack:
+            self.ack.recv()
+
+        return current_batch
@@ -0,0 +1,138 @@
+"""Validate an RFT dataset offline and write the valid records to a clean, indexed JSONL.
+
+Every record is checked in parallel the way the datasets read it: the question and the action of each
+step must parse, and every screenshot must exist and decode. Valid lines are copied verbatim, so relative
+screenshot paths keep working as long as the clean file stays in the directory of the original one. A
+report counts the failures by kind and keeps a few examples of each.
+
+Train on the clean file with `--strict_dataset true`, so a bad record raises instead of being silently
+replaced by another one inside the data workers.
+
+    python validate_dataset.py --jsonl_file train.jsonl --hist_length 3 --num_workers 32
+"""
+import os
+import re
+import json
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from tqdm import tqdm
+
+from trainer.utils.dataset import JsonlRecords, prepare_record
+
+_records = None
+
+
+def _init_worker(jsonl_file):
+    global _records
+    _records = JsonlRecords(jsonl_file)
+
+
+def check_single_turn(item, image_root):
+    '''Failures of a record read by `GUIRFTDataset`, as `(kind, message)`.'''
+    try:
+        item = item if "query" in item else prepare_record(item, image_root)
+    except Exception as e:
+        return [("conversation", repr(e))]
+    return [failure for img_file in item["image"].values() for failure in check_image(img_file)]
+
+
+def check_multi_turn(item):
+    '''Failures of a record read by `GUIMTRFTDataset`, as `(kind, message)`.'''
+    failures = []
+    conversations = item["conversations"]
+    step_index = 0
+    while 2 + 2 * step_index < len(conversations):
+        try:
+            user_query = conversations[1 + 2 * step_index]["content"]
+            re.match(r"<Question>(.*?)</Question>", user_query, re.DOTALL).group(1)
+            json.loads(conversations[2 + 2 * step_index]["content"])
+        except Exception as e:
+            failures.append(("conversation", f"step {step_index}: {e!r}"))
+        img_file = item["image"].get(f"<image_{step_index:02}>", None)
+        if img_file is None:
+            failures.append(("missing_image", f"step {step_index}: no screenshot"))
+        else:
+            failures.extend(check_image(img_file))
+        step_index += 1
+    return failures
+
+
+def check_image(img_file):
+    if not os.path.exists(img_file):
+        return [("missing_image", img_file)]
+    try:
+        with Image.open(img_file) as img:
+            img.convert("RGB")
+    except Exception as e:
+        return [("corrupt_image", f"{img_file}: {e!r}")]
+    return []
+
+
+def check_record(index, image_root, multiturn):
+    try:
+        item = _records[index]
+        if multiturn:
+            return index, check_multi_turn(item)
+        return index, check_single_turn(item, image_root)
+    except Exception as e:
+        return index, [("record", repr(e))]
+
+
+def main(args):
+    records = JsonlRecords(args.jsonl_file)
+    image_root = os.path.dirname(os.path.dirname(args.jsonl_file))
+    output_file = args.output_file or os.path.splitext(args.jsonl_file)[0] + ".clean.jsonl"
+    report_file = args.report_file or os.path.splitext(output_file)[0] + ".report.json"
+    # lines which do not parse are already left out of the index
+    with open(args.jsonl_file, "rb") as f:
+        unparsable = sum(1 for _ in f) - len(records)
+
+    multiturn = args.hist_length > 1
+    failures = defaultdict(list)
+    valid = 0
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_worker, initargs=(args.jsonl_file,)) as executor, \
+            open(output_file, "wb") as output:
+        results = executor.map(
+            check_record,
+            range(len(records)),
+            [image_root] * len(records),
+            [multiturn] * len(records),
+            chunksize=64,
+        )
+        for index, record_failures in tqdm(results, total=len(records), desc="Validating", dynamic_ncols=True):
+            for kind, message in record_failures:
+                failures[kind].append({"index": index, "message": message})
+            if not record_failures:
+                output.write(records.line(index) + b"\n")
+                valid += 1
+    # index the clean records right away
+    JsonlRecords(output_file)
+
+    report = {
+        "jsonl_file": args.jsonl_file,
+        "output_file": output_file,
+        "records": len(records) + unparsable,
+        "valid": valid,
+        "invalid": len(records) + unparsable - valid,
+        "failures": {"unparsable_line": unparsable, **{kind: len(items) for kind, items in failures.items()}},
+        "examples": {kind: items[:args.num_examples] for kind, items in failures.items()},
+    }
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps({key: report[key] for key in ("records", "valid", "invalid", "failures")}))
+    print(f"Wrote {valid} valid records to {output_file} and the report to {report_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jsonl_file", type=str, required=True)
+    parser.add_argument("--output_file", type=str, default=None, help="Defaults to `<jsonl_file>.clean.jsonl`.")
+    parser.add_argument("--report_file", type=str, default=None, help="Defaults to `<output_file>.report.json`.")
+    parser.add_argument("--hist_length", type=int, default=1,
+                        help="Same as the training `hist_length`, records are checked as multi-turn episodes if > 1.")
+    parser.add_argument("--num_examples", type=int, default=20, help="Failures kept in the report for each kind.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    main(parser.parse_args())